@@ -0,0 +1,28 @@
+# tests/conftest.py
+
+import os
+import sys
+
+import pytest
+
+
+# Workflow scripts import each other as top-level modules, as when run by Snakemake
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "workflow", "scripts"))
+sys.path.insert(0, SCRIPTS_DIR)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture
+def no_network(monkeypatch):
+    """Fail any attempt to reach the network through requests or sockets"""
+    import socket
+
+    import requests
+
+    def blocked(*args, **kwargs):
+        raise AssertionError("Network access in an offline test")
+
+    monkeypatch.setattr(requests, "get", blocked)
+    monkeypatch.setattr(requests.Session, "request", blocked)
+    monkeypatch.setattr(socket.socket, "connect", blocked)
@@ -0,0 +1,66 @@
+# tests/test_gene_converter.py
+
+import os
+import shutil
+import subprocess
+
+import pytest
+from conftest import FIXTURES_DIR, SCRIPTS_DIR
+
+from gene_converter import GeneMapping, build_gene_mapping, create_gene_converter
+
+
+REPO_DIR = os.path.abspath(os.path.join(SCRIPTS_DIR, "..", ".."))
+ORGDB_EXPORT = os.path.join(FIXTURES_DIR, "orgdb.hsa.ENSEMBL.csv")
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_convert_as_bitr(tmp_path):
+    """One row per identifier and gene in input order, unmapped IDs dropped, written like write.csv in R"""
+    mapping_dir = str(tmp_path / "gene_mapping")
+    build_gene_mapping(ORGDB_EXPORT, mapping_dir, fmt="orgdb")
+    assert GeneMapping(mapping_dir).keytypes == ["ENTREZID", "SYMBOL", "ENSEMBL"]
+
+    outfile = str(tmp_path / "gene_converter.csv")
+    create_gene_converter(os.path.join(FIXTURES_DIR, "gene_converter.input.csv"), "ENSEMBL", outfile, mapping_dir)
+    assert read_bytes(outfile) == read_bytes(os.path.join(FIXTURES_DIR, "gene_converter.expected.csv"))
+
+
+def test_convert_symbols(tmp_path):
+    mapping_dir = str(tmp_path / "gene_mapping")
+    build_gene_mapping(ORGDB_EXPORT, mapping_dir, fmt="orgdb")
+    df = GeneMapping(mapping_dir).convert(["ADA", "UNKNOWN", "SNORD116-1"], "SYMBOL")
+    assert df.columns.tolist() == ["SYMBOL", "ENTREZID"]
+    assert df.values.tolist() == [["ADA", "100"], ["SNORD116-1", "100008587"]]
+
+
+def _r_packages_available() -> bool:
+    if shutil.which("Rscript") is None:
+        return False
+    check = "suppressMessages({library(clusterProfiler); library(org.Hs.eg.db)})"
+    return subprocess.run(["Rscript", "-e", check], capture_output=True).returncode == 0
+
+
+@pytest.mark.skipif(not _r_packages_available(), reason="needs Rscript with clusterProfiler and org.Hs.eg.db")
+def test_same_as_bitr_on_testdata(tmp_path):
+    """gene_converter.py on the default org DB export writes the same file as the former run_geneconverter.R rule"""
+    input_file = os.path.join(REPO_DIR, "resources", "testdata", "BRCA.N3.qlf.csv")
+    orgdb_export = str(tmp_path / "orgdb.hsa.ENSEMBL.csv")
+    subprocess.run(
+        ["Rscript", os.path.join(SCRIPTS_DIR, "export_orgdb.R"), "hsa", orgdb_export, "ENSEMBL", "ENSEMBL"], check=True
+    )
+    mapping_dir = str(tmp_path / "gene_mapping")
+    build_gene_mapping(orgdb_export, mapping_dir, fmt="orgdb")
+    outfile = str(tmp_path / "gene_converter.csv")
+    create_gene_converter(input_file, "ENSEMBL", outfile, mapping_dir)
+
+    r_outfile = str(tmp_path / "gene_converter.R.csv")
+    subprocess.run(
+        ["Rscript", os.path.join(SCRIPTS_DIR, "run_geneconverter.R"), input_file, "ENSEMBL", "hsa", r_outfile],
+        check=True,
+    )
+    assert read_bytes(outfile) == read_bytes(r_outfile)
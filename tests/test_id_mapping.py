@@ -0,0 +1,79 @@
+# tests/test_id_mapping.py
+
+import pandas as pd
+import pytest
+
+from id_mapping import IdMappingStore, LocalGeneInfo, map_ids
+
+
+GENES = pd.DataFrame(
+    {
+        "species": ["human"] * 5 + ["mouse"],
+        "ENSP": ["ENSP1", "ENSP2", "ENSP3", "ENSP4", "ENSP5", "ENSMUSP1"],
+        "SYMBOL": ["TP53", "BAX", "CASP3", "BCL2", None, "Trp53"],
+    }
+)
+
+
+class BatchRecorder(LocalGeneInfo):
+    """LocalGeneInfo that also records the IDs of every request"""
+
+    def __init__(self, table: pd.DataFrame) -> None:
+        super().__init__(table)
+        self.batches = []
+
+    def querymany(self, qterms, *args, **kwargs):
+        self.batches.append(list(qterms))
+        return super().querymany(qterms, *args, **kwargs)
+
+
+def values(series: pd.Series) -> list:
+    """Values of a mapping result with None for missing IDs"""
+    return [None if pd.isna(v) else v for v in series]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return IdMappingStore(str(tmp_path / "id_mapping.sqlite"))
+
+
+def test_only_missing_ids_are_queried(store, no_network):
+    client = LocalGeneInfo(GENES)
+    symbols = map_ids(["ENSP1", "ENSP2", "ENSP1"], "human", "ENSP", "SYMBOL", store=store, client=client)
+    assert symbols.tolist() == ["TP53", "BAX", "TP53"]
+    assert client.queries == ["ENSP1", "ENSP2"]
+
+    # Known IDs are not queried again, nor are IDs that were not found
+    symbols = map_ids(["ENSP2", "ENSP5", "ENSP3", "ENSMUSP1"], "human", "ENSP", "SYMBOL", store=store, client=client)
+    assert values(symbols) == ["BAX", None, "CASP3", None]
+    assert client.queries == ["ENSP1", "ENSP2", "ENSP5", "ENSP3", "ENSMUSP1"]
+    symbols = map_ids(["ENSP5", "ENSMUSP1"], "human", "ENSP", "SYMBOL", store=store, client=client)
+    assert symbols.isna().all()
+    assert len(client.queries) == 5
+
+
+def test_mappings_persist(store, no_network):
+    map_ids(["ENSP1", "ENSMUSP1"], "human", "ENSP", "SYMBOL", store=store, client=LocalGeneInfo(GENES))
+    map_ids(["ENSMUSP1"], "mouse", "ENSP", "SYMBOL", store=store, client=LocalGeneInfo(GENES))
+
+    reopened = IdMappingStore(store.path)
+    human = reopened.table("human", "ENSP", "SYMBOL")
+    assert dict(zip(human.index, values(human))) == {"ENSP1": "TP53", "ENSMUSP1": None}
+    assert reopened.table("mouse", "ENSP", "SYMBOL").to_dict() == {"ENSMUSP1": "Trp53"}
+
+    # Answered from the store alone, without any client
+    offline = LocalGeneInfo(GENES.iloc[:0])
+    symbols = map_ids(["ENSMUSP1"], "mouse", "ENSP", "SYMBOL", store=reopened, client=offline)
+    assert symbols.tolist() == ["Trp53"]
+    assert offline.queries == []
+
+
+def test_batches(store, no_network):
+    client = BatchRecorder(GENES)
+    ids = ["ENSP1", "ENSP2", "ENSP3", "ENSP4", "ENSP5"]
+    symbols = map_ids(ids, "human", "ENSP", "SYMBOL", store=store, client=client, batch_size=2, workers=2)
+    assert values(symbols) == ["TP53", "BAX", "CASP3", "BCL2", None]
+    assert sorted(client.batches) == [["ENSP1", "ENSP2"], ["ENSP3", "ENSP4"], ["ENSP5"]]
+
+    with pytest.raises(Exception, match="Invalid identifier type"):
+        map_ids(ids, "human", "ENSP", "UNIPROT", store=store, client=client)
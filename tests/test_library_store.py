@@ -0,0 +1,60 @@
+# tests/test_library_store.py
+
+import os
+import shutil
+
+import pytest
+from conftest import FIXTURES_DIR
+
+import library_store
+from library_store import get_library, get_library_file, import_library, read_manifest
+
+
+LIBRARY = "Test_Library_2024"
+FIXTURE = os.path.join(FIXTURES_DIR, f"{LIBRARY}.txt")
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    """Library store populated from the Enrichr-format fixture"""
+    store = str(tmp_path / "enrichr")
+    import_library(LIBRARY, FIXTURE, store)
+    return store
+
+
+def test_resolve_from_store_offline(store_dir, no_network):
+    index = get_library(LIBRARY, store_dir)
+    assert list(index.ids) == ["Apoptosis", "Cell cycle", "DNA repair"]
+    assert index.to_dict()["Apoptosis"] == ["TP53", "BAX", "CASP3", "BCL2"]  # gene weights dropped
+    assert get_library_file(LIBRARY, store_dir) == os.path.join(store_dir, f"{LIBRARY}.gmt")
+
+    manifest = read_manifest(store_dir)
+    assert manifest[LIBRARY]["n_terms"] == 3
+    assert manifest[LIBRARY]["n_genes"] == 10
+
+
+def test_missing_library_offline(store_dir, no_network):
+    with pytest.raises(Exception, match="downloads are disabled"):
+        get_library_file("Missing_Library_2024", store_dir, download=False)
+    with pytest.raises(AssertionError, match="Network access"):
+        get_library_file("Missing_Library_2024", store_dir)
+
+
+def test_download_library(tmp_path, monkeypatch):
+    class Response:
+        url = library_store.ENRICHR_URL + "?mode=text&libraryName=" + LIBRARY
+        with open(FIXTURE) as f:
+            text = f.read()
+
+        def raise_for_status(self):
+            pass
+
+    monkeypatch.setattr(library_store.requests, "get", lambda *args, **kwargs: Response())
+    store = str(tmp_path / "enrichr")
+    path = library_store.download_library(LIBRARY, store)
+    assert read_manifest(store)[LIBRARY]["url"] == Response.url
+
+    shutil.rmtree(os.path.join(store, ".index"))
+    assert get_library(LIBRARY, store, download=False).to_dict() == get_library(LIBRARY, store_dir=store).to_dict()
+    with open(path) as f:
+        assert f.readline() == "Apoptosis\t\tTP53\tBAX\tCASP3\tBCL2\n"
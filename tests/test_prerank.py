@@ -0,0 +1,85 @@
+# tests/test_prerank.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from combine_results import combine_results
+from prerank import prerank
+
+
+@pytest.fixture
+def ranking():
+    """Sorted ranking metric of 300 genes and gene sets from strongly enriched to random"""
+    rng = np.random.default_rng(1)
+    genes = [f"G{i}" for i in range(300)]
+    rnk = pd.Series(np.sort(rng.normal(size=300))[::-1], index=genes)
+    gene_sets = {
+        "Top": genes[:40:2],
+        "Bottom": genes[-60::3],
+        "Mixed": genes[::15],
+        "Random": list(rng.choice(genes, 25, replace=False)),
+    }
+    return rnk, gene_sets
+
+
+def test_matches_gseapy(ranking):
+    gseapy = pytest.importorskip("gseapy")
+    rnk, gene_sets = ranking
+    expected = gseapy.prerank(
+        rnk=rnk, gene_sets=gene_sets, outdir=None, min_size=5, permutation_num=1000, seed=123, threads=1, verbose=False
+    ).res2d.set_index("Term")
+    res = prerank(rnk, gene_sets, min_size=5, permutation_num=1000, seed=123).set_index("Term").loc[expected.index]
+
+    np.testing.assert_allclose(res["ES"].astype(float), expected["ES"].astype(float))
+    for col in ["Tag %", "Gene %", "Lead_genes"]:
+        assert res[col].tolist() == expected[col].tolist()
+    # NES depends on the random permutations, which gseapy draws differently
+    np.testing.assert_allclose(res["NES"].astype(float), expected["NES"].astype(float), rtol=0.1)
+
+
+def test_permutation_counts(ranking):
+    rnk, gene_sets = ranking
+    res = prerank(rnk, gene_sets, min_size=5, permutation_num=500).set_index("Term")
+    assert (res["Permutations"] == 500).all()
+
+    res = prerank(rnk, gene_sets, min_size=5, pval_method="multilevel", permutation_num=500).set_index("Term")
+    assert (res["Permutations"] == 500).all()
+    assert (res["NOM p-val"] > 0).all()
+
+
+def test_adaptive_stopping(ranking):
+    rnk, gene_sets = ranking
+    fixed = prerank(rnk, gene_sets, min_size=5, permutation_num=800).set_index("Term")
+    res = prerank(
+        rnk, gene_sets, min_size=5, pval_method="adaptive", min_permutations=100, max_permutations=800
+    ).set_index("Term")
+
+    # Rounds double in size: 100, 100, 200, 400
+    assert set(res["Permutations"]) <= {100, 200, 400, 800}
+    # Strongly enriched sets stop once known to be significant, without any null score as extreme; their p-values
+    # are never zero
+    for term in ["Top", "Bottom"]:
+        assert fixed.loc[term, "NOM p-val"] == 0
+        assert res.loc[term, "Permutations"] < 800
+        assert 0 < res.loc[term, "NOM p-val"] < 0.05
+    # A set far from significance stops once 10 null scores were at least as extreme
+    assert res.loc["Mixed", "Permutations"] == 100
+    assert res.loc["Mixed", "NOM p-val"] > 0.5
+    np.testing.assert_allclose(res["ES"], fixed["ES"])
+
+
+def test_combine_zero_pvalues():
+    terms = ["T1", "T2"]
+    gseapy = pd.DataFrame(
+        {"enrichmentScore": [0.9, 0.5], "pvalue": [0.0, 0.1], "Description": terms, "Permutations": [1000, 1000]},
+        index=terms,
+    )
+    cluster_profiler = pd.DataFrame(
+        {"enrichmentScore": [0.8, 0.4], "pvalue": [0.0, 0.1], "Description": terms}, index=terms
+    )
+    store = combine_results({"gseapy.logFC": gseapy, "clusterProfiler.logFC": cluster_profiler})
+
+    # Zeros are set to 1e-30 for every tool, whether or not it reports permutations
+    np.testing.assert_allclose(store.combined["Combined pvalue"], [1e-30, 0.1])
+    assert "Permutations" in store.values
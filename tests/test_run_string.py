@@ -0,0 +1,110 @@
+# tests/test_run_string.py
+
+import asyncio
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pandas as pd
+import pytest
+
+import run_string
+from run_string import StringClient, check_api_key, prepare_string_input, run_metrics
+from utils import read_result_table, write_ranks
+
+
+STRING_TABLE = (
+    "category\tterm ID\tterm description\tenrichment score\tdirection\tfalse discovery rate\n"
+    "GO Process\tGO:0006915\tApoptotic process\t1.5\ttop\t0.001\n"
+    "GO Function\tGO:0003677\tDNA binding\t0.8\tbottom\t0.01\n"
+    "KEGG\thsa04110\tCell cycle\t1.2\tboth ends\t0.02\n"
+)
+
+
+class StubString(BaseHTTPRequestHandler):
+    """STRING values/ranks API: jobs are running for the first two status checks, then succeed"""
+
+    requests = []
+
+    def _reply(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        method = self.path.rsplit("/", 1)[-1]
+        self.requests.append((method, data))
+        match method:
+            case "valuesranks_enrichment_submit":
+                response = {"job_id": "job1"}
+            case "valuesranks_enrichment_status":
+                polls = sum(m == method for m, _ in self.requests)
+                response = {"status": "running", "message": "running"}
+                if polls > 2:
+                    url = f"http://{self.headers['Host']}/download/{data['job_id'][0]}.tsv"
+                    response = {"status": "success", "message": "done", "download_url": url}
+        self._reply(json.dumps([response]).encode(), "application/json")
+
+    def do_GET(self):
+        self.requests.append(("download", self.path))
+        self._reply(STRING_TABLE.encode(), "text/tab-separated-values")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_url():
+    StubString.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubString)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_run_metrics_against_stub(tmp_path, stub_url):
+    ranks_file = str(tmp_path / "ranks.logFC.parquet")
+    ranks = pd.DataFrame({"ENSEMBL": ["E1", "E2", "E2"], "SYMBOL": ["A", "B", "B"], "logFC": [2.0, -1.0, -1.0]})
+    write_ranks(ranks, ranks_file)
+    outfile = str(tmp_path / "syn.string.logFC._PLACEHOLDER_.csv")
+    job = {
+        "input_path": prepare_string_input(ranks_file, "logFC"),
+        "outfile": outfile,
+        "species": 9606,
+        "fdr": 0.05,
+        "cache_dir": str(tmp_path / "cache"),
+    }
+    (tmp_path / "cache").mkdir()
+    client = StringClient("key", stub_url, poll_interval=0.01, max_poll_interval=0.02, timeout=10)
+    asyncio.run(run_metrics(client, [job]))
+
+    methods = [m for m, _ in StubString.requests]
+    assert methods == ["valuesranks_enrichment_submit"] + ["valuesranks_enrichment_status"] * 3 + ["download"]
+    submitted = StubString.requests[0][1]
+    assert submitted["identifiers"] == ["E1\t2.0\nE2\t-1.0\n"]  # duplicated identifiers sent once
+    assert submitted["api_key"] == ["key"]
+
+    go = read_result_table(outfile.replace("_PLACEHOLDER_", "GO"))
+    assert list(go.index) == ["GO:0006915", "GO:0003677"]
+    assert list(go["ONTOLOGY"]) == ["BP", "MF"]
+    assert list(go["enrichmentScore"]) == [-1.5, 0.8]  # top is down-regulated
+    kegg = read_result_table(outfile.replace("_PLACEHOLDER_", "KEGG"))
+    assert list(kegg.index) == ["hsa04110"]
+
+    # A second run is served from the cache without contacting the API
+    StubString.requests = []
+    asyncio.run(run_metrics(StringClient("key", stub_url), [job]))
+    assert StubString.requests == []
+
+
+def test_missing_api_key_without_terminal(monkeypatch):
+    monkeypatch.setattr(run_string.sys, "stdin", io.StringIO(""))
+    with pytest.raises(Exception, match="No STRING API key supplied"):
+        check_api_key("_")
@@ -0,0 +1,161 @@
+# scripts/benchmark.py
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from gene_set_index import GeneSetIndex, compile_gmt
+from prerank import enrichment_scores, permutation_null, prerank, running_sum
+from run_gseapy import run_gseapy
+from utils import read_gmt
+
+
+def synthetic_ranks(n_genes: int, rng: np.random.Generator) -> pd.Series:
+    """Ranking metric with heavy tails (t-distributed), indexed by synthetic gene symbols"""
+    return pd.Series(rng.standard_t(df=3, size=n_genes), index=[f"GENE{i}" for i in range(n_genes)])
+
+
+def synthetic_gmt(
+    gmt_file: str, genes: pd.Index, n_sets: int, rng: np.random.Generator, min_size: int = 10, max_size: int = 500
+) -> None:
+    """Write a gmt file (ID, Category, Description, genes...) with log-uniform gene set sizes"""
+    sizes = np.exp(rng.uniform(np.log(min_size), np.log(max_size + 1), size=n_sets)).astype(int)
+    genes = genes.to_numpy()
+    with open(gmt_file, "w") as f:
+        for i, size in enumerate(sizes):
+            members = genes[rng.choice(len(genes), size=min(size, len(genes)), replace=False)]
+            f.write("\t".join([f"SET:{i:07d}", "BENCH", f"Synthetic gene set {i}"] + members.tolist()) + "\n")
+
+
+def measure(func: Callable, *args, **kwargs) -> Tuple[Any, float, float]:
+    """Run func once and return its result, wall time (s) and peak traced memory (MB)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2**20
+
+
+def benchmark_case(
+    n_genes: int,
+    n_sets: int,
+    permutation_num: int,
+    workdir: str,
+    seed: int = 0,
+    full: bool = False,
+    gseapy_engine: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Time and memory-profile the stages of the GSEA hot path on one synthetic rank vector and library
+    :param full: Also time a complete native prerank
+    :param gseapy_engine: Also time run_gseapy with the gseapy engine (slow for large libraries)
+    """
+    rng = np.random.default_rng(seed)
+    rnk = synthetic_ranks(n_genes, rng)
+    gmt_file = os.path.join(workdir, f"bench.{n_genes}.{n_sets}.gmt")
+    synthetic_gmt(gmt_file, rnk.index, n_sets, rng)
+    index_dir = os.path.join(workdir, f"bench.{n_genes}.{n_sets}.index")
+
+    stages = {}
+    _, *stages["parse_gmt"] = measure(read_gmt, gmt_file)
+    _, *stages["compile_index"] = measure(compile_gmt, gmt_file, index_dir)
+    index, *stages["open_index"] = measure(GeneSetIndex, index_dir)
+
+    def rank():
+        ranked = rnk.sort_values(ascending=False, kind="mergesort")
+        return ranked, index.membership(pd.Index(ranked.index))
+
+    (ranked, (indptr, positions)), *stages["rank"] = measure(rank)
+    weights = np.abs(ranked.to_numpy())
+
+    def es():
+        after, before = running_sum(positions, weights[positions], indptr, n_genes)
+        return enrichment_scores(after, before, indptr)
+
+    _, *stages["enrichment_score"] = measure(es)
+    _, *stages["permutation"] = measure(
+        permutation_null, weights, positions, indptr, permutation_num, np.random.default_rng(seed)
+    )
+    if full:
+        _, *stages["prerank"] = measure(
+            prerank, rnk, index, min_size=1, max_size=n_genes, permutation_num=permutation_num, seed=seed
+        )
+    if gseapy_engine:
+        _, *stages["run_gseapy"] = measure(
+            run_gseapy,
+            rnk,
+            gmt_file,
+            workdir,
+            min_size=1,
+            max_size=n_genes,
+            permutation_num=permutation_num,
+            engine="gseapy",
+            seed=seed,
+        )
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.remove(gmt_file)
+    return [
+        {
+            "n_genes": n_genes,
+            "n_sets": n_sets,
+            "n_memberships": int(indptr[-1]),
+            "permutation_num": permutation_num,
+            "stage": stage,
+            "seconds": seconds,
+            "peak_mb": peak_mb,
+        }
+        for stage, (seconds, peak_mb) in stages.items()
+    ]
+
+
+def machine_info() -> Dict[str, Any]:
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing, ranking, ES and permutations on synthetic data.")
+    parser.add_argument("--genes", type=int, nargs="+", default=[5_000, 20_000, 60_000], help="Rank vector lengths")
+    parser.add_argument("--sets", type=int, nargs="+", default=[100, 1_000, 10_000, 30_000], help="Library sizes")
+    parser.add_argument("--permutations", type=int, default=100, help="Permutations per case")
+    parser.add_argument("--full", action="store_true", help="Also time the complete native prerank")
+    parser.add_argument("--gseapy", action="store_true", help="Also time run_gseapy with the gseapy engine (slow)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--outfile", default="", help="Write results to this json file (default: stdout)")
+
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_genes in args.genes:
+            for n_sets in args.sets:
+                print(f"Benchmarking {n_genes} genes x {n_sets} gene sets", file=sys.stderr)
+                results += benchmark_case(
+                    n_genes, n_sets, args.permutations, workdir, args.seed, args.full, args.gseapy
+                )
+
+    report = {"machine": machine_info(), "results": results}
+    print(pd.DataFrame(results).to_string(index=False), file=sys.stderr)
+    if args.outfile:
+        with open(args.outfile, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
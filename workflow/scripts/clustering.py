@@ -10,8 +10,8 @@ from sklearn.metrics import silhouette_score
 # import rpy2.robjects as ro
 # from rpy2.robjects import pandas2ri
 
-import pickle
-from utils import pickler
+from summary_store import SummaryStore, summary_store_path
+from utils import read_result_table, write_result_table
 
 from plots import save_empty
 
@@ -180,6 +180,7 @@ if __name__ == "__main__":
     qval = config.get("qval")
     go_sem_sim_max_distance = 100  # config.get("go_sem_sim_max_distance")
     organismKEGG = config.get("organismKEGG")
+    result_format = config.get("result_format", "csv")
     match organismKEGG:
         case "mmu":
             org = "Org.Mm.eg.db"
@@ -195,8 +196,8 @@ if __name__ == "__main__":
     for lib in lib_names:
         if not lib.startswith("GO"):
             continue
-        depth_df_file = os.path.join(savepath, f"syn.depth.{lib}.{project_name}.csv")
-        depth_df = pd.read_csv(depth_df_file, index_col=0)
+        depth_df_file = os.path.join(savepath, f"syn.depth.{lib}.{project_name}.{result_format}")
+        depth_df = read_result_table(depth_df_file)
 
         if len(depth_df) < 2:
             for subont in ["BP", "CC", "MF"]:
@@ -206,10 +207,9 @@ if __name__ == "__main__":
         depth_df = append_GO_clusters_to_depth_df(
             sim_matrix_cache_folder, depth_df, figpath, lib, project_name, max_thresh=go_sem_sim_max_distance
         )
-        depth_df.to_csv(depth_df_file)
+        write_result_table(depth_df, depth_df_file)
 
-        summary_dict_file = os.path.join(savepath, f"syn.summary_dict.{project_name}.txt")
-        with open(summary_dict_file, "rb") as f:
-            summary_dict = pickle.load(f)
-        summary_dict[lib]["depth_df"] = depth_df
-        pickler(summary_dict, summary_dict_file)
+        # Only the depth table of this library is rewritten
+        store_path = summary_store_path(savepath, project_name)
+        if os.path.isdir(store_path):
+            SummaryStore(store_path)[lib]["depth_df"] = depth_df
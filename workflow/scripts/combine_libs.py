@@ -3,9 +3,34 @@
 import os
 import yaml
 import pandas as pd
-from typing import List, Dict
-from explore_results import get_sig_dict, create_intersection_depth_df
-from utils import pickler, read_enrichr, read_gmt
+from typing import List, Dict, Optional
+from explore_results import (
+    ResultStore,
+    count_significant_by_threshold,
+    create_store_depth_df,
+    create_threshold_sweep_df,
+)
+from gene_set_index import load_gene_set_index
+from summary_store import SummaryStore, summary_store_path
+from utils import file_digest, load_cached_table, read_result_table, save_cached_table, write_result_table
+from warehouse import append_library
+
+
+ENRICHR_GO_GMT = "resources/Ontologies/GO_Enrichr_2023.gmt"  # TO DO: pass as arg
+
+
+def find_gmt_file(library: str) -> Optional[str]:
+    """Path of the gmt file of a library, if it is one"""
+    if library.endswith(".gmt") and os.path.isfile(library):
+        return library
+    elif os.path.isfile(os.path.join("resources/Ontologies", library)):
+        return os.path.join("resources/Ontologies", library)
+    return None
+
+
+def depth_inputs(library: str) -> List[str]:
+    """Gene set files read by format_depth_df besides the combined table"""
+    return [f for f in [ENRICHR_GO_GMT, find_gmt_file(library)] if f is not None and os.path.isfile(f)]
 
 
 def create_summary_dict(
@@ -17,23 +42,66 @@ def create_summary_dict(
     qval: float = 0.05,
     save: bool = False,
     go_sem_sim: bool = False,
+    result_format: str = "csv",
+    qval_sweep: Optional[List[float]] = None,
+    warehouse: Optional[str] = None,
 ) -> Dict:
+    """
+    :param qval_sweep: Optional qvalue cutoffs; if given, the depth of every term at each cutoff is also written to
+                       syn.sweep.{lib}.{project_name} and kept as "sweep_df" (plus "sweep_counts", the significant terms
+                       per configuration and cutoff) in the summary dict
+    :param warehouse: Optional path of the cross-project SQLite warehouse (see warehouse.py), the term statistics and
+                      depth of each library replace those of earlier runs of this project
+    """
     libs = lib_names.keys()
     summary_dict: Dict = {lib: {} for lib in libs}
+    cache_dir = os.path.join(os.path.dirname(os.path.normpath(savepath)), ".cache", "combine")
     for lib in libs:
-        summary_df = pd.read_csv(f"{savepath}/syn.combined.{lib}.{project_name}.csv", index_col=0, header=[0, 1, 2])
-        summary_df.sort_values(by=("Combined", "nan", "Combined FDR"))
-        summary_dict[lib]["summary_df"] = summary_df
-        sig_dict = get_sig_dict(summary_df, tools, metrics, qval=qval, verbose=True)
-        depth_df = create_intersection_depth_df(sig_dict)
-        depth_df = format_depth_df(depth_df, project_name, savepath, lib, lib_names, summary_df, go_sem_sim)
+        combined_file = f"{savepath}/syn.combined.{lib}.{project_name}.{result_format}"
+        store = ResultStore.from_summary_df(read_result_table(combined_file, header_levels=3))
+        summary_dict[lib].update(store.to_dict())
+
+        # Depth tables only change with the combined table, the thresholds or the gene sets
+        depth_cache_file = os.path.join(cache_dir, f"depth.{lib}.pkl")
+        depth_key = {
+            "combined": file_digest(combined_file),
+            "tools": list(tools),
+            "metrics": list(metrics),
+            "qval": qval,
+            "inputs": {f: file_digest(f) for f in depth_inputs(lib_names[lib])},
+        }
+        depth_df = load_cached_table(depth_cache_file, depth_key)
+        if depth_df is not None and len(depth_df) > 0:
+            print(f"No changes for {lib}, using cached depth table")
+            write_result_table(depth_df, os.path.join(savepath, f"syn.depth.{lib}.{project_name}.{result_format}"))
+        else:
+            depth_df = create_store_depth_df(store, tools, metrics, qval=qval, verbose=True)
+            depth_df = format_depth_df(
+                depth_df, project_name, savepath, lib, lib_names, store, go_sem_sim, result_format
+            )
+            save_cached_table(depth_df, depth_cache_file, depth_key)
         summary_dict[lib]["depth_df"] = depth_df
 
-    # Store results in dictionary for meta-analysis
+        if qval_sweep:
+            sweep_df = create_threshold_sweep_df(store, tools, metrics, qval_sweep)
+            write_result_table(sweep_df, os.path.join(savepath, f"syn.sweep.{lib}.{project_name}.{result_format}"))
+            summary_dict[lib]["sweep_df"] = sweep_df
+            summary_dict[lib]["sweep_counts"] = count_significant_by_threshold(store, tools, metrics, qval_sweep)
+
+        if warehouse:
+            print(f"Appending {lib} to warehouse {warehouse}")
+            append_library(warehouse, project_name, lib, store.records, depth_df, qval, len(tools) * len(metrics))
+
+    # Store results per library and table for meta-analysis, see summary_store.load_summary
     if save:
-        print(f"Saving summary dict with qval threshold = {qval}")
-        outfile = os.path.join(savepath, f"syn.summary_dict.{project_name}.txt")
-        pickler(summary_dict, outfile)
+        print(f"Saving summary store with qval threshold = {qval}")
+        SummaryStore.from_summary_dict(
+            summary_dict,
+            summary_store_path(savepath, project_name),
+            table_format="parquet" if result_format == "parquet" else "pickle",
+            project_name=project_name,
+            qval=qval,
+        )
 
     return summary_dict
 
@@ -44,30 +112,30 @@ def format_depth_df(
     savepath: str,
     lib: str,
     lib_names: Dict[str, str],
-    summary_df: pd.DataFrame,
+    store: ResultStore,
     go_sem_sim: bool = False,
+    result_format: str = "csv",
 ) -> pd.DataFrame:
-    outfile = os.path.join(savepath, f"syn.depth.{lib}.{project_name}.csv")
+    outfile = os.path.join(savepath, f"syn.depth.{lib}.{project_name}.{result_format}")
     d = depth_df
     if len(d) < 1:
         print(f"No terms found for {lib}")
-        pd.DataFrame([f"No terms found for {lib}"]).to_csv(outfile)
+        write_result_table(pd.DataFrame([f"No terms found for {lib}"]), outfile)
         return d
 
     is_go = d.index[0].startswith("GO:")
 
-    # Append GO sub-ontology
-    if is_go:
-        d["ID"] = d.index.str.split("_").str[0]
-        ont = pd.DataFrame(summary_df[("nan", "nan", "ONTOLOGY")].values, index=summary_df.index, columns=["ONTOLOGY"])
-        d = d.merge(ont["ONTOLOGY"], left_on="ID", right_index=True, how="left")
-
+    # Index "ID_Direction " as from create_intersection_depth_df, else term IDs with a Direction column
     if "Direction" not in d:
         d["Direction"] = d.index.str.split("_").str[1].str.strip()
+        d.index = d.index.str.split("_").str[0]
+
+    # Append GO sub-ontology
+    if is_go:
+        d["ONTOLOGY"] = store.catalog["ONTOLOGY"].astype(object).reindex(d.index).to_numpy()
 
-    d.index = d.index.str.split("_").str[0]
     d.rename({"Factors": "Configurations"}, axis=1, inplace=True)
-    d["Combined FDR"] = summary_df.loc[d.index, ("Combined", "nan", "Combined FDR")]
+    d["Combined FDR"] = store.combined.loc[d.index, "Combined FDR"]
 
     d.sort_values(by=["Depth", "Combined FDR"], ascending=[False, True], inplace=True)
 
@@ -78,11 +146,11 @@ def format_depth_df(
         cols.append("ONTOLOGY")
 
     # Check which terms are in Enrichr library
-    enrichr = "resources/Ontologies/GO_Enrichr_2023.gmt"  # TO DO: pass as arg
+    enrichr = ENRICHR_GO_GMT
     if os.path.isfile(enrichr):
         print("Enrichr gmt file found, adding info to depth df")
-        enrichr_df = read_enrichr(enrichr)
-        d["Enrichr"] = d.index.isin(enrichr_df.index)
+        enrichr_index = load_gene_set_index(enrichr, fmt="enrichr")
+        d["Enrichr"] = d.index.isin(enrichr_index.ids)
         cols.append("Enrichr")
 
     # Needs different conda env!
@@ -96,26 +164,18 @@ def format_depth_df(
     cols.append("Configurations")
 
     # Check if genes from gmt file can be appended
-    gmt_file = lib_names[lib]
-    gmt_found = False
-    if gmt_file.endswith(".gmt") and os.path.isfile(gmt_file):
-        gmt_found = True
-    elif os.path.isfile(os.path.join("resources/Ontologies", gmt_file)):
-        gmt_file = os.path.join("resources/Ontologies", gmt_file)
-        gmt_found = True
-    if gmt_found:
+    gmt_file = find_gmt_file(lib_names[lib])
+    if gmt_file is not None:
         print("Attempting to append genes from .gmt to depth df")
-        gmt = read_gmt(gmt_file)
-        if "Genes" in gmt:
-            gmt.set_index("ID", inplace=True)
-            d = d.merge(gmt["Genes"], left_index=True, right_index=True, how="left")
-            d["Genes"] = d["Genes"].apply(lambda s: "; ".join(g for g in s))
+        gmt = load_gene_set_index(gmt_file)
+        if len(gmt.genes) > 0:
+            d["Genes"] = ["; ".join(genes) for genes in gmt.get_genes(d.index)]
             cols.append("Genes")
         else:
-            print("No 'Genes' column found in gmt file...")
+            print("No genes found in gmt file...")
 
     d = d[cols]
-    d.to_csv(outfile)
+    write_result_table(d, outfile)
     return d
 
 
@@ -131,6 +191,9 @@ if __name__ == "__main__":
     project_name = config.get("project_name")
     qval = config.get("qval")
     save = config.get("save_summary_dict")
+    result_format = config.get("result_format", "csv")
+    qval_sweep = config.get("qval_sweep") or []
+    warehouse = config.get("warehouse")
     savepath = os.path.join("results", project_name, "combined")
 
     # GoSemSim
@@ -149,4 +212,16 @@ if __name__ == "__main__":
             case _:
                 raise Exception(f"Organism not supported: {organismKEGG}")
 
-    create_summary_dict(savepath, lib_names, tools, metrics, project_name, qval, save, go_sem_sim=go_sem_sim)
+    create_summary_dict(
+        savepath,
+        lib_names,
+        tools,
+        metrics,
+        project_name,
+        qval,
+        save,
+        go_sem_sim,
+        result_format=result_format,
+        qval_sweep=qval_sweep,
+        warehouse=warehouse,
+    )
@@ -4,19 +4,32 @@ import os
 import sys
 import argparse
 import glob
-from typing import Optional, List, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple, Union
 import numpy as np
 import pandas as pd
-from scipy.stats import norm
+from scipy.stats import chi2, norm
 from statsmodels.stats.multitest import fdrcorrection
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from scripts.utils import load_config
+from scripts.explore_results import ResultStore
+from scripts.utils import (
+    file_digest,
+    load_cached_table,
+    load_config,
+    read_result_table,
+    save_cached_table,
+    write_result_table,
+)
 
 
 def stouffer_combined_p_value(
     p_values: Union[List[float], np.ndarray], weights: Optional[Union[List[float], np.ndarray]] = None
 ) -> np.ndarray:
+    """
+    Weighted Z combination of one list of p-values. Unlike combine_pvalues(..., "stouffer"), p-values of 0 and 1 are
+    not imputed, so any p-value of 0 gives a combined p-value of 0.
+    """
     if weights is None:
         weights = [1] * len(p_values)
     else:
@@ -28,77 +41,82 @@ def stouffer_combined_p_value(
     return combined_p_value
 
 
-def mean_pval(pvals):
-    pv = pvals.copy()  # pvals is read-only
-    pv[pv == 0] = 1e-30  # Impute zeros with a small number; TO DO: change to 1/n_perms or something
-    pv = pv.astype(float)  # else np.log10 might complain
-    return 10 ** np.nanmean(np.log10(pv))
+PVAL_METHODS = ["geometric", "stouffer", "fisher", "cauchy", "harmonic"]
 
 
-# TO DO: refactor
-def combine_results(dfs, is_go: bool = False) -> pd.DataFrame:
-    combined_df = pd.concat(dfs, axis=1, keys=[d.index.name for d in dfs])
-    combined_df.columns = pd.MultiIndex.from_product([combined_df.columns.levels[0], combined_df.columns.levels[1]])
-
-    # Calculate combined pvals only for common terms
-    combined_df_common = combined_df  # .dropna(axis=0)
-    summary_df = pd.DataFrame(index=combined_df_common.index)
-    summary_df["enrichmentScore Mean"] = combined_df_common.xs("enrichmentScore", axis=1, level=1).apply(
-        np.nanmean, axis=1
-    )
-    summary_df["enrichmentScore SD"] = combined_df_common.xs("enrichmentScore", axis=1, level=1).apply(
-        np.nanstd, axis=1
+def combine_pvalues(
+    pvalues: np.ndarray, method: str = "geometric", weights: Optional[Union[List[float], np.ndarray]] = None
+) -> np.ndarray:
+    """
+    Combine the p-values of each row (term) across columns (configurations) at once; NaN entries are ignored.
+
+    :param pvalues: Array of shape (n_terms, n_configurations)
+    :param method: "geometric" (geometric mean), "stouffer" (weighted Z), "fisher", "cauchy" (ACAT, Liu & Xie 2020)
+                   or "harmonic" (weighted harmonic mean p-value, Wilson 2019)
+    :param weights: Weight of each configuration, used by stouffer, cauchy and harmonic
+    :returns: Combined p-values, NaN for rows without any p-value
+    """
+    pv = np.array(pvalues, dtype=float)  # copy
+    pv[pv == 0] = 1e-30  # Impute zeros with a small number, for all tools alike
+    pv = np.clip(pv, 0, 1)
+    valid = ~np.isnan(pv)
+    n_valid = valid.sum(axis=1)
+    w = np.ones(pv.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+    w = np.where(valid, w[None, :], 0)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        match method:
+            case "geometric":
+                combined = 10 ** (np.where(valid, np.log10(pv), 0).sum(axis=1) / n_valid)
+            case "stouffer":
+                z = np.where(valid, norm.isf(np.clip(pv, None, 1 - 1e-16)), 0)
+                combined = norm.sf((w * z).sum(axis=1) / np.sqrt((w**2).sum(axis=1)))
+            case "fisher":
+                combined = chi2.sf(-2 * np.where(valid, np.log(pv), 0).sum(axis=1), 2 * n_valid)
+            case "cauchy":
+                pv = np.clip(pv, None, 1 - 1e-16)
+                # tan((0.5 - p) * pi) ~ 1 / (p * pi) for tiny p, avoids loss of precision
+                t = np.where(pv < 1e-15, 1 / (pv * np.pi), np.tan((0.5 - pv) * np.pi))
+                stat = np.where(valid, w * t, 0).sum(axis=1) / w.sum(axis=1)
+                combined = np.where(stat > 1e15, 1 / (stat * np.pi), 0.5 - np.arctan(stat) / np.pi)
+            case "harmonic":
+                combined = np.minimum(w.sum(axis=1) / np.where(valid, w / pv, 0).sum(axis=1), 1)
+            case _:
+                raise Exception(f"Invalid p-value combination method: {method}, choose from {PVAL_METHODS}")
+
+    return np.where(n_valid > 0, combined, np.nan)
+
+
+def configuration_weights(configurations: List[str], weights: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """Weights of configurations named tool.metric, looked up by configuration or by tool (default 1)"""
+    weights = weights or {}
+    return np.array([weights.get(c, weights.get(c.split(".")[0], 1.0)) for c in configurations], dtype=float)
+
+
+def combine_results(
+    tables: Dict[str, pd.DataFrame], pval_method: str = "geometric", pval_weights: Optional[Dict[str, float]] = None
+) -> ResultStore:
+    """
+    :param tables: Formatted result tables keyed by configuration (tool.metric), see read_configuration
+    :param pval_method: p-value combination method, see combine_pvalues
+    :param pval_weights: Configuration weights keyed by tool.metric or tool, see configuration_weights
+    :returns: ResultStore of all configurations with the combined statistics of each term
+    """
+    store = ResultStore.from_tables(tables)
+    combined = pd.DataFrame(index=store.terms)
+    es = store.pivot("enrichmentScore").astype(float)
+    combined["enrichmentScore Mean"] = es.mean(axis=1)
+    combined["enrichmentScore SD"] = es.std(axis=1, ddof=0)
+    pvalues = store.pivot("pvalue").astype(float)
+    configurations = [f"{tool}.{metric}" for tool, metric in pvalues.columns]
+    combined["Combined pvalue"] = combine_pvalues(
+        pvalues.to_numpy(dtype=float), pval_method, configuration_weights(configurations, pval_weights)
     )
-    summary_df["Combined pvalue"] = combined_df_common.xs("pvalue", axis=1, level=1).apply(mean_pval, axis=1)
-    summary_df["Combined FDR"] = fdrcorrection(
-        summary_df["Combined pvalue"],
+    combined["Combined FDR"] = fdrcorrection(
+        combined["Combined pvalue"],
     )[1]
-    summary_df.columns = pd.MultiIndex.from_product([["Combined"], summary_df.columns])
-    summary_df = pd.concat([combined_df_common, summary_df], axis=1)
-
-    # Add remaining terms that are not common to all tools
-    # combined_df_uncommon = combined_df.loc[combined_df.index.difference(combined_df_common.index)]
-    # summary_df_uncommon = pd.DataFrame(index=combined_df_uncommon.index)
-    # summary_df_uncommon["enrichmentScore Mean"] = combined_df_uncommon.xs("enrichmentScore", axis=1, level=1).mean(axis=1)
-    # summary_df_uncommon["enrichmentScore SD"] = combined_df_uncommon.xs("enrichmentScore", axis=1, level=1).std(axis=1)
-    # summary_df_uncommon["Combined pvalue"] = np.nan
-    # summary_df_uncommon["Combined pvalue"] = np.nan
-    # summary_df_uncommon.columns = pd.MultiIndex.from_product([["Combined"], summary_df_uncommon.columns])
-    # summary_df_uncommon = pd.concat([combined_df_uncommon,summary_df_uncommon], axis=1)
-
-    # summary_df = pd.concat([summary_df, summary_df_uncommon], axis=0)
-
-    def combine_col(row):
-        vals = row.dropna().unique()
-        return vals[0] if vals.size > 0 else np.nan
-
-    summary_df["Description"] = summary_df.loc[:, pd.IndexSlice[:, "Description"]].apply(combine_col, axis=1)
-    summary_df.drop("Description", level=1, axis=1, inplace=True)
-
-    if is_go:
-        summary_df["ONTOLOGY"] = summary_df.loc[:, pd.IndexSlice[:, "ONTOLOGY"]].apply(combine_col, axis=1)
-        summary_df.drop("ONTOLOGY", level=1, axis=1, inplace=True)
-
-    # Better multiindex
-    lvl0 = summary_df.columns.get_level_values(level=0)
-    lvl0 = [val.split(".")[0] for val in lvl0]
-    lvl00 = summary_df.columns.get_level_values(level=0)
-    lvl1 = [val.split(".")[1] if len(val.split(".")) > 1 else "nan" for val in lvl00]
-    lvl2 = list(summary_df.columns.get_level_values(level=1))
-
-    lvl0[-1] = "nan"
-
-    if is_go:
-        lvl0[-2] = "nan"
-        lvl2[-2] = "Description"
-        lvl2[-1] = "ONTOLOGY"
-    else:
-        lvl2[-1] = "Description"
-
-    tuples = list(zip(*[lvl0, lvl1, lvl2], strict=True))
-    summary_df.columns = pd.MultiIndex.from_tuples(tuples, names=["Tool", "Metric", "Value"])
-
-    return summary_df
+    store.combined = combined
+    return store
 
 
 def format_table(tab: pd.DataFrame, tool: str, metric: str, library: str) -> pd.DataFrame:
@@ -125,7 +143,107 @@ def format_table(tab: pd.DataFrame, tool: str, metric: str, library: str) -> pd.
     return tab
 
 
-def main(savepath: str, output_files: List[str], project_name: str) -> None:
+# Bump to invalidate cached configuration tables after changing read_configuration or format_table
+CACHE_VERSION = 1
+CONFIGURATION_COLS = ["enrichmentScore", "pvalue", "qvalue", "Description", "Direction", "ONTOLOGY", "Permutations"]
+
+
+def read_configuration(file: str, tool: str, metric: str, library: str) -> pd.DataFrame:
+    """Read and format the result table of one configuration, keeping only the columns used for combining"""
+    tab = read_result_table(file)
+    tab = format_table(tab, tool, metric, library)
+
+    # string (and string-local, see run_string_local.py) contains terms enriched in "both" directions;
+    # also top refers to negative value rankings and vice versa
+    if tool.lower() in ["string", "string-local"]:
+        tab["Direction"] = tab["direction"].apply(lambda x: "Up" if x == "bottom" else "Down" if x == "top" else "Both")
+    else:
+        tab["Direction"] = tab["enrichmentScore"].apply(lambda x: "Up" if x > 0 else "Down")
+
+    if library == "GO" and "Ontology" in tab:
+        tab.rename({"Ontology": "ONTOLOGY"}, axis=1, inplace=True)
+
+    return tab[[c for c in CONFIGURATION_COLS if c in tab.columns]]
+
+
+def load_configuration(file: str, tool: str, metric: str, library: str, cache_dir: str, digest: str) -> pd.DataFrame:
+    """Formatted result table of one configuration, only parsed again if the content hash (digest) changed"""
+    cache_file = os.path.join(cache_dir, f"{tool}.{metric}.{library}.pkl")
+    key = {"digest": digest, "version": CACHE_VERSION}
+    tab = load_cached_table(cache_file, key)
+    if tab is None:
+        print(f"Parsing {file}")
+        tab = read_configuration(file, tool, metric, library)
+        save_cached_table(tab, cache_file, key)
+    tab.index.name = f"{tool}.{metric}"
+    return tab
+
+
+def index_input_files(input_files: List[str]) -> Dict[Tuple[str, str, str], str]:
+    """Result files keyed by (tool, metric, library) parsed from their names syn.{tool}.{metric}.{library}.*"""
+    index = {}
+    for file in input_files:
+        tool, metric, library = os.path.basename(file).split("syn.")[1].split(".")[:3]
+        index[(tool, metric, library)] = file
+    return index
+
+
+def combine_library(
+    library: str,
+    configurations: List[Tuple[str, str, str]],
+    output_file: str,
+    cache_dir: str,
+    pval_method: str = "geometric",
+    pval_weights: Optional[Dict[str, float]] = None,
+    read_threads: int = 4,
+) -> None:
+    """
+    Read the result tables of one library on a thread pool and write their combined table, unless none changed.
+    :param configurations: (tool, metric, file) of each configuration, in output order
+    :param read_threads: Threads reading and parsing the configuration tables
+    """
+    pval_weights = pval_weights or {}
+
+    def load(configuration: Tuple[str, str, str]) -> Tuple[pd.DataFrame, str]:
+        tool, metric, file = configuration
+        digest = file_digest(file)
+        return load_configuration(file, tool, metric, library, cache_dir, digest), digest
+
+    with ThreadPoolExecutor(max_workers=read_threads) as pool:
+        loaded = list(pool.map(load, configurations))
+    tab_dict = {tab.index.name: tab for tab, _ in loaded}
+    digests = {tab.index.name: digest for tab, digest in loaded}
+
+    # Skip combining if no configuration changed since the last run
+    combined_cache_file = os.path.join(cache_dir, f"combined.{library}.pkl")
+    combined_key = {
+        "configurations": digests,
+        "pval_combination": pval_method,
+        "pval_weights": pval_weights,
+        "version": CACHE_VERSION,
+    }
+    if os.path.isfile(output_file) and load_cached_table(combined_cache_file, combined_key) is not None:
+        print(f"No configuration changed for {library}, keeping {output_file}")
+        os.utime(output_file)
+        return
+
+    # Combine results
+    cols = ["enrichmentScore", "pvalue", "qvalue", "Description", "Direction"]
+    if library == "GO":
+        cols += ["ONTOLOGY"]
+    if any("Permutations" in d for d in tab_dict.values()):
+        cols += ["Permutations"]
+
+    store = combine_results({c: d.reindex(columns=cols) for c, d in tab_dict.items()}, pval_method, pval_weights)
+    write_result_table(store.to_summary_df(), output_file)
+    save_cached_table(store.combined, combined_cache_file, combined_key)
+
+
+def main(savepath: str, output_files: List[str], project_name: str, threads: Optional[int] = None) -> None:
+    """
+    :param threads: Threads granted by Snakemake, shared out between the combine_workers processes and the
+                    combine_read_threads of each; None to use both settings as configured
+    """
     # Get latest config file
     config_file = os.path.join(savepath, "config.yaml")
     orig_config_file = os.path.join("config", "config.yaml")
@@ -135,8 +253,17 @@ def main(savepath: str, output_files: List[str], project_name: str) -> None:
     # metrics = config.get("metrics", [])
     libraries = config.get("libraries", [])
     tools = config.get("tools", [])
-
-    input_files = glob.glob(f"{savepath}/syn.*[tc]sv")
+    pval_method = config.get("pval_combination", "geometric")
+    pval_weights = config.get("pval_weights") or {}
+    workers = config.get("combine_workers", 1)
+    read_threads = config.get("combine_read_threads", 4)
+    if threads is not None:
+        workers = max(1, min(workers, threads))
+        read_threads = max(1, min(read_threads, threads // workers))
+    cache_dir = os.path.join(savepath, ".cache", "combine")
+
+    result_format = config.get("result_format", "csv")
+    input_files = glob.glob(f"{savepath}/syn.*.{result_format}") + glob.glob(f"{savepath}/syn.*.tsv")
 
     if len(input_files) < 2:
         print("Savepath:", savepath)
@@ -145,52 +272,34 @@ def main(savepath: str, output_files: List[str], project_name: str) -> None:
     else:
         print(f"Found {len(input_files)} input files:\n", *[o + "\n" for o in input_files])
 
+    input_index = index_input_files(input_files)
+    jobs = []
     for library in libraries:
         if library.endswith(".gmt"):
             library = library.split(".gmt")[0]
         if library.startswith("GO_"):
             library = "GO"  # TO DO: careful
 
-        tab_dict = {}
         output_files_lib = next(o for o in output_files if library in o)  # TO DO: careful
-
-        is_go = library == "GO"
-
-        for tool in tools:
-            for file in input_files:
-                filename = os.path.basename(file)
-                file_tool, file_metric, file_lib = filename.split("syn.")[1].split(".")[:3]
-
-                if library != file_lib or tool != file_tool:
-                    continue
-
-                metric = file_metric
-
-                sep = "\t" if os.path.splitext(file)[-1] == ".tsv" else ","
-                tab = pd.read_csv(file, index_col=0, sep=sep)
-                tab = format_table(tab, tool, metric, library)
-                tab_dict[tab.index.name] = tab
-
-                # string contains terms enriched in "both" directions;
-                # also top refers to negative value rankings and vice versa
-                if tool.lower() == "string":
-                    tab["Direction"] = tab["direction"].apply(
-                        lambda x: "Up" if x == "bottom" else "Down" if x == "top" else "Both"
-                    )
-                else:
-                    tab["Direction"] = tab["enrichmentScore"].apply(lambda x: "Up" if x > 0 else "Down")
-
-                if is_go and "Ontology" in tab:
-                    tab.rename({"Ontology": "ONTOLOGY"}, axis=1, inplace=True)
-
-        # Combine results
-        cols = ["enrichmentScore", "pvalue", "qvalue", "Description", "Direction"]
-        if is_go:
-            cols += ["ONTOLOGY"]
-
-        dfs = [d[cols] for d in tab_dict.values()]
-        summary_df = combine_results(dfs, is_go)
-        summary_df.to_csv(output_files_lib, index=True)
+        configurations = [
+            (tool, file_metric, file)
+            for tool in tools
+            for (file_tool, file_metric, file_lib), file in input_index.items()
+            if file_tool == tool and file_lib == library
+        ]
+        jobs.append((library, configurations, output_files_lib))
+
+    # One worker process per library, the largest library bounds the run time
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            futures = [
+                pool.submit(combine_library, *job, cache_dir, pval_method, pval_weights, read_threads) for job in jobs
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for job in jobs:
+            combine_library(*job, cache_dir, pval_method, pval_weights, read_threads)
 
 
 if __name__ == "__main__":
@@ -204,9 +313,11 @@ if __name__ == "__main__":
     # Positional argument for a variable number of final outputs
     parser.add_argument("final_outputs", nargs="+", help="List of final output files.")
 
+    parser.add_argument("--threads", type=int, default=None, help="Threads granted by Snakemake.")
+
     args = parser.parse_args()
     savepath = args.savepath
     output_files = args.final_outputs
     project_name = savepath.split("results/")[1]
 
-    main(savepath, output_files, project_name)
+    main(savepath, output_files, project_name, args.threads)
@@ -1,29 +1,203 @@
+import numpy as np
 import pandas as pd
-from collections import defaultdict
-from typing import List, Dict, Set, Any, DefaultDict
+from functools import cached_property
+from typing import List, Dict, Set, Any, Mapping, Optional, Tuple
+
+
+CATALOG_COLS = ["Description", "ONTOLOGY"]
+COMBINED_COLS = ["enrichmentScore Mean", "enrichmentScore SD", "Combined pvalue", "Combined FDR"]
+
+
+class ResultStore:
+    """
+    Results of all configurations of one library in long format, pivoted to wide tables only on demand.
+
+    records: one row per term tested in a configuration; categorical Term, Tool, Metric and Direction columns plus
+        enrichmentScore, pvalue, qvalue (and Permutations if any tool reports them)
+    catalog: Description (and ONTOLOGY for GO) per term, indexed by term in the order of the Term categories
+    combined: combined statistics per term (see combine_results.combine_results), same index as catalog
+    """
+
+    def __init__(self, records: pd.DataFrame, catalog: pd.DataFrame, combined: Optional[pd.DataFrame] = None) -> None:
+        self.records = records
+        self.catalog = catalog
+        self.combined = combined if combined is not None else pd.DataFrame(index=catalog.index, columns=COMBINED_COLS)
+
+    @classmethod
+    def from_tables(cls, tables: Dict[str, pd.DataFrame]) -> "ResultStore":
+        """
+        :param tables: Formatted result tables indexed by term, keyed by configuration (tool.metric)
+        :returns: ResultStore with the first non-missing Description/ONTOLOGY of each term in configuration order
+        """
+        term_ids = np.concatenate([t.index.to_numpy(dtype=object) for t in tables.values()])
+        terms = pd.Index(pd.unique(term_ids))
+        sizes = [len(t) for t in tables.values()]
+        tools = [c.split(".")[0] for c in tables]
+        metrics = [c.split(".")[1] if len(c.split(".")) > 1 else "nan" for c in tables]
+
+        records = pd.concat([t.reset_index(drop=True) for t in tables.values()], ignore_index=True)
+        records.insert(0, "Term", pd.Categorical.from_codes(terms.get_indexer(term_ids), terms))
+        records.insert(1, "Tool", pd.Categorical(np.repeat(tools, sizes), categories=pd.unique(np.array(tools))))
+        records.insert(2, "Metric", pd.Categorical(np.repeat(metrics, sizes), categories=pd.unique(np.array(metrics))))
+        if "Direction" in records:
+            records["Direction"] = records["Direction"].astype("category")
+
+        catalog_cols = [c for c in CATALOG_COLS if c in records]
+        catalog = records.groupby(records["Term"].cat.codes)[catalog_cols].first().set_axis(terms)
+        if "ONTOLOGY" in catalog:
+            catalog["ONTOLOGY"] = catalog["ONTOLOGY"].astype("category")
+        return cls(records.drop(columns=catalog_cols), catalog)
+
+    @classmethod
+    def from_summary_df(cls, summary_df: pd.DataFrame) -> "ResultStore":
+        """Store of a wide table with (Tool, Metric, Value) columns, e.g. read from a syn.combined.* file"""
+        tools = summary_df.columns.get_level_values(0)
+        metrics = summary_df.columns.get_level_values(1)
+
+        def block(tool: str, metric: str) -> pd.DataFrame:
+            tab = summary_df.loc[:, (tools == tool) & (metrics == metric)]
+            return tab.set_axis(tab.columns.get_level_values(2), axis=1)
+
+        catalog = block("nan", "nan")
+        tables = {}
+        for tool, metric in summary_df.columns.droplevel(2).unique():
+            if tool not in ["Combined", "nan"]:
+                tab = block(tool, metric).dropna(how="all")
+                tables[f"{tool}.{metric}"] = pd.concat([tab, catalog.loc[tab.index]], axis=1)
+        records = cls.from_tables(tables).records
+        records["Term"] = records["Term"].cat.set_categories(summary_df.index)
+        catalog = catalog.astype({"ONTOLOGY": "category"}) if "ONTOLOGY" in catalog else catalog
+        combined = block("Combined", "nan") if "Combined" in tools else None
+        return cls(records, catalog, combined)
+
+    @classmethod
+    def from_summary_dict(cls, entry: Mapping[str, Any]) -> "ResultStore":
+        """
+        Store of one library of a summary_dict or SummaryStore (see combine_libs.create_summary_dict), of an older
+        pickled summary_dict with the tables under "store", or of one with a summary_df
+        """
+        if "records" in entry:
+            return cls(entry["records"], entry["catalog"], entry["combined"])
+        if "store" in entry:
+            return cls(**entry["store"])
+        return cls.from_summary_df(entry["summary_df"])
+
+    def to_dict(self) -> Dict[str, pd.DataFrame]:
+        """Plain tables, stored in the summary_dict regardless of whether this module was imported as scripts.*"""
+        return {"records": self.records, "catalog": self.catalog, "combined": self.combined}
+
+    @property
+    def terms(self) -> pd.Index:
+        return self.catalog.index
+
+    @property
+    def values(self) -> List[str]:
+        return [c for c in self.records.columns if c not in ["Term", "Tool", "Metric"]]
+
+    @cached_property
+    def _rows(self) -> Dict[Tuple[str, str], np.ndarray]:
+        """Row positions of the records of each (Tool, Metric), in the order the configurations were added"""
+        tool_codes = self.records["Tool"].cat.codes.to_numpy().astype(np.int64)
+        metric_codes = self.records["Metric"].cat.codes.to_numpy().astype(np.int64)
+        n_metrics = len(self.records["Metric"].cat.categories)
+        _, first, inverse = np.unique(tool_codes * n_metrics + metric_codes, return_index=True, return_inverse=True)
+        groups = np.split(np.argsort(inverse.ravel(), kind="stable"), np.cumsum(np.bincount(inverse.ravel()))[:-1])
+        tools, metrics = self.records["Tool"].cat.categories, self.records["Metric"].cat.categories
+        return {
+            (tools[tool_codes[first[g]]], metrics[metric_codes[first[g]]]): groups[g] for g in np.argsort(first)
+        }
+
+    @property
+    def configurations(self) -> List[Tuple[str, str]]:
+        """(Tool, Metric) pairs in the order they were added"""
+        return list(self._rows)
+
+    def _records(self, tool: str, metric: str) -> pd.DataFrame:
+        if (tool, metric) not in self._rows:
+            raise KeyError(f"Configuration not found: {tool}.{metric}")
+        return self.records.iloc[self._rows[tool, metric]]
+
+    def _expand(self, rec: pd.DataFrame, value: str) -> np.ndarray:
+        """Values of one configuration at the positions of their terms in the catalog, NaN for untested terms"""
+        values = pd.Series(rec[value].to_numpy(), index=rec["Term"].cat.codes.to_numpy())
+        return values.reindex(range(len(self.terms))).to_numpy()
+
+    def configuration(self, tool: str, metric: str) -> pd.DataFrame:
+        """Values of the terms tested in one configuration, indexed by term"""
+        rec = self._records(tool, metric)
+        return pd.DataFrame({v: rec[v].to_numpy() for v in self.values}, index=self.terms[rec["Term"].cat.codes])
+
+    def pivot(self, value: str, tools: Optional[List[str]] = None, metrics: Optional[List[str]] = None) -> pd.DataFrame:
+        """Wide table of one value: terms x (Tool, Metric), NaN where a term was not tested"""
+        configurations = [
+            (t, m)
+            for t, m in self.configurations
+            if (tools is None or t in tools) and (metrics is None or m in metrics)
+        ]
+        columns = pd.MultiIndex.from_tuples(configurations, names=["Tool", "Metric"])
+        data = {c: self._expand(self._records(*c), value) for c in configurations}
+        return pd.DataFrame(data, index=self.terms, columns=columns)
+
+    def to_summary_df(self) -> pd.DataFrame:
+        """Wide table with (Tool, Metric, Value) columns as written to the syn.combined.* files"""
+        data = {}
+        for tool, metric in self.configurations:
+            rec = self._records(tool, metric)
+            for value in self.values:
+                data[(tool, metric, value)] = self._expand(rec, value)
+        for col in self.combined:
+            data[("Combined", "nan", col)] = self.combined[col].to_numpy()
+        for col in self.catalog:
+            data[("nan", "nan", col)] = self.catalog[col].to_numpy(dtype=object)
+        columns = pd.MultiIndex.from_tuples(list(data), names=["Tool", "Metric", "Value"])
+        return pd.DataFrame(data, index=self.terms.rename(None), columns=columns)
+
+    def subset(self, terms: pd.Index) -> "ResultStore":
+        """Store restricted to the given terms"""
+        terms = self.terms[self.terms.isin(terms)]
+        records = self.records[self.records["Term"].isin(terms)].copy()
+        records["Term"] = records["Term"].cat.set_categories(terms)
+        return ResultStore(records, self.catalog.loc[terms], self.combined.loc[terms])
+
+    @classmethod
+    def concat(cls, stores: Dict[str, "ResultStore"]) -> "ResultStore":
+        """Stores of several projects in one, with terms suffixed by .{project} (e.g. for meta-analysis)"""
+        records, catalogs, combined = [], [], []
+        for project, store in stores.items():
+            rec = store.records.copy()
+            rec["Term"] = rec["Term"].astype(object) + "." + project
+            records.append(rec)
+            catalogs.append(store.catalog.set_axis(store.terms + "." + project))
+            combined.append(store.combined.set_axis(store.terms + "." + project))
+
+        catalog = pd.concat(catalogs)
+        records = pd.concat(records, ignore_index=True)
+        records["Term"] = pd.Categorical(records["Term"], categories=catalog.index)
+        for col in ["Tool", "Metric", "Direction"]:
+            if col in records:
+                records[col] = records[col].astype("category")
+        if "ONTOLOGY" in catalog:
+            catalog["ONTOLOGY"] = catalog["ONTOLOGY"].astype("category")
+        return cls(records, catalog, pd.concat(combined))
 
 
 def get_sig_dict(
-    summary_df: pd.DataFrame, tools: List[str], metrics: List[str], qval: float, verbose: bool = False
+    store: ResultStore, tools: List[str], metrics: List[str], qval: float, verbose: bool = False
 ) -> Dict[Any, Any]:
     sig_dict: Dict = {t: {m: set() for m in metrics} for t in tools}
+    descriptions = store.catalog["Description"]
 
     for tool in tools:
         for metric in metrics:
-            terms = summary_df[(tool, metric, "qvalue")].dropna()
-            direction = summary_df[(tool, metric, "Direction")].dropna()
+            tab = store.configuration(tool, metric)
+            terms = tab["qvalue"].dropna()
+            direction = tab["Direction"].dropna()
 
             sig = terms[terms < qval]
             if verbose:
                 print(tool, metric, "Terms tested:", len(terms), "Significant:", len(sig))
             sig_dict[tool][metric] = set(
-                (
-                    sig.index
-                    + "_"
-                    + direction.loc[sig.index]
-                    + " | "
-                    + summary_df.loc[sig.index, ("nan", "nan", "Description")]
-                )
+                (sig.index + "_" + direction.loc[sig.index] + " | " + descriptions.loc[sig.index].astype(object))
             )
 
     return sig_dict
@@ -35,6 +209,145 @@ def count_combinations(d) -> int:
     return sum(count_combinations(v) for v in d.values())
 
 
+def _configuration_ids(store: ResultStore, tools: List[str], metrics: List[str]) -> Tuple[np.ndarray, List[str]]:
+    """
+    :returns: Position of the configuration (tool.metric) of each record of the store in tools x metrics order (-1 for
+              other configurations), and the configuration names
+    """
+    records = store.records
+    tool_names, metric_names = records["Tool"].cat.categories, records["Metric"].cat.categories
+    lookup = np.full((len(tool_names) + 1, len(metric_names) + 1), -1)  # last row/column: code -1 (missing)
+    configurations = []
+    for tool in tools:
+        for metric in metrics:
+            if (tool, metric) not in store.configurations:
+                raise KeyError(f"Configuration not found: {tool}.{metric}")
+            lookup[tool_names.get_loc(tool), metric_names.get_loc(metric)] = len(configurations)
+            configurations.append(f"{tool}.{metric}")
+    return lookup[records["Tool"].cat.codes.to_numpy(), records["Metric"].cat.codes.to_numpy()], configurations
+
+
+def _intern_keys(store: ResultStore, mask: np.ndarray) -> Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Intern the (term, direction) pairs of the masked records of the store to key ids.
+    :returns: Keys with Term, Direction and Description, and the key id of each masked record
+    """
+    records = store.records
+    n_directions = len(records["Direction"].cat.categories)
+    terms = records["Term"].cat.codes.to_numpy().astype(np.int64)[mask]
+    directions = records["Direction"].cat.codes.to_numpy().astype(np.int64)[mask]
+    codes, key_ids = np.unique(terms * n_directions + directions, return_inverse=True)
+    keys = pd.DataFrame(
+        {
+            "Term": store.terms[codes // n_directions],
+            "Direction": records["Direction"].cat.categories[codes % n_directions],
+            "Description": store.catalog["Description"].to_numpy(dtype=object)[codes // n_directions],
+        }
+    )
+    return keys, key_ids.ravel()
+
+
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class SignificanceMatrix:
+    """
+    Bit-packed key x configuration membership matrix for intersection depths.
+
+    keys: one row per interned key (e.g. Term and Direction, plus Description), key ids are the row positions
+    configurations: names of the configurations (e.g. tool.metric), bit j of a row belongs to configurations[j]
+    bits: uint8 array (keys, ceil(configurations / 8)) from np.packbits, bit order little
+    Depth is the popcount of a row; strings such as the "; "-separated configurations are only built for export.
+    """
+
+    def __init__(self, keys: pd.DataFrame, configurations: List[str], bits: np.ndarray) -> None:
+        self.keys = keys
+        self.configurations = configurations
+        self.bits = bits
+
+    @classmethod
+    def from_indicators(
+        cls, keys: pd.DataFrame, configurations: List[str], indicators: np.ndarray
+    ) -> "SignificanceMatrix":
+        """:param indicators: bool array (keys, configurations)"""
+        return cls(keys, configurations, np.packbits(indicators, axis=1, bitorder="little"))
+
+    @classmethod
+    def from_memberships(
+        cls, key_ids: np.ndarray, config_ids: np.ndarray, keys: pd.DataFrame, configurations: List[str]
+    ) -> "SignificanceMatrix":
+        """Matrix from (key id, configuration id) pairs, e.g. the significant records of a ResultStore"""
+        indicators = np.zeros((len(keys), len(configurations)), dtype=bool)
+        indicators[key_ids, config_ids] = True
+        return cls.from_indicators(keys, configurations, indicators)
+
+    @classmethod
+    def from_store(
+        cls, store: ResultStore, tools: List[str], metrics: List[str], qval: float, verbose: bool = False
+    ) -> "SignificanceMatrix":
+        """Terms with qvalue < qval in each configuration (tool.metric), keyed by term and direction"""
+        records = store.records
+        config_ids, configurations = _configuration_ids(store, tools, metrics)
+        qvalues = records["qvalue"].to_numpy(dtype=float)
+        sig = (qvalues < qval) & (config_ids >= 0) & (records["Direction"].cat.codes.to_numpy() >= 0)
+        if verbose:
+            tested = np.bincount(config_ids[~np.isnan(qvalues) & (config_ids >= 0)], minlength=len(configurations))
+            significant = np.bincount(config_ids[sig], minlength=len(configurations))
+            pairs = [(t, m) for t in tools for m in metrics]
+            for (tool, metric), n_tested, n_sig in zip(pairs, tested, significant, strict=True):
+                print(tool, metric, "Terms tested:", n_tested, "Significant:", n_sig)
+
+        keys, key_ids = _intern_keys(store, sig)
+        return cls.from_memberships(key_ids, config_ids[sig], keys, configurations)
+
+    @classmethod
+    def from_sets(cls, nested_dict: Dict) -> "SignificanceMatrix":
+        """Matrix of a nested dict of factors with sets at the deepest level; configurations are the joined factors"""
+        sets: Dict[str, Set] = {}
+
+        def flatten(d: Dict, factors: List[str]) -> None:
+            for factor, sub in d.items():
+                if isinstance(sub, set):
+                    sets[".".join(factors + [factor])] = sub
+                else:
+                    flatten(sub, factors + [factor])
+
+        flatten(nested_dict, [])
+        elements = [e for s in sets.values() for e in s]
+        key_ids, uniques = pd.factorize(pd.Series(elements, dtype=object))
+        config_ids = np.repeat(np.arange(len(sets)), [len(s) for s in sets.values()])
+        return cls.from_memberships(key_ids, config_ids, pd.DataFrame({"Key": uniques}), list(sets))
+
+    def indicators(self) -> np.ndarray:
+        """bool array (keys, configurations)"""
+        return np.unpackbits(self.bits, axis=1, count=len(self.configurations), bitorder="little").astype(bool)
+
+    def depth(self) -> np.ndarray:
+        """Number of configurations each key is significant in"""
+        return POPCOUNT[self.bits].sum(axis=1, dtype=np.int64)
+
+    def configuration_strings(self, sep: str = "; ") -> np.ndarray:
+        """Configurations of each key joined by sep, built once per distinct membership bitmask"""
+        if len(self.keys) == 0:
+            return np.array([], dtype=object)
+        masks, inverse = np.unique(self.bits, axis=0, return_inverse=True)
+        names = np.array(self.configurations, dtype=object)
+        unpacked = np.unpackbits(masks, axis=1, count=len(self.configurations), bitorder="little").astype(bool)
+        strings = np.array([sep.join(names[row]) for row in unpacked], dtype=object)
+        return strings[inverse.ravel()]
+
+    def to_depth_df(self) -> pd.DataFrame:
+        """
+        Keys with their Depth, RelativeDepth (Depth / number of configurations) and Configurations, by Depth descending
+        """
+        depth_df = self.keys.copy()
+        depth_df["Depth"] = self.depth()
+        depth_df["RelativeDepth"] = depth_df["Depth"] / len(self.configurations)
+        depth_df["Configurations"] = self.configuration_strings()
+        return depth_df.sort_values(by="Depth", ascending=False, kind="stable")
+
+
 def create_intersection_depth_df(nested_dict: Dict[Dict, Set]) -> pd.DataFrame:
     """
     Counts intersection depth of each element of a nested dict containing sets to be compared. Each level of the dict correpsodns to e.g. experimental factor.
@@ -45,37 +358,9 @@ def create_intersection_depth_df(nested_dict: Dict[Dict, Set]) -> pd.DataFrame:
     RelativeDepth: Depth divided by total number of factor combinations
     Factors: String listing all the factors a given element appears in
     """
-
-    intersection_depth: DefaultDict = defaultdict(int)
-    factors_for_element: DefaultDict = defaultdict(list)
-
-    def calculate_depth_factors(nested_dict, factor_list):
-        for factor, sub_dict in nested_dict.items():
-            new_factors = factor_list + [factor]
-            if isinstance(sub_dict, set):
-                for elem in sub_dict:
-                    intersection_depth[elem] += 1
-                    factors_for_element[elem].append(new_factors)
-            else:
-                calculate_depth_factors(sub_dict, new_factors)
-
-    calculate_depth_factors(nested_dict, [])
-
-    # Cleanup
-    for f in factors_for_element:
-        for i, ll in enumerate(factors_for_element[f]):
-            factors_for_element[f][i] = ".".join(ll)
-        factors_for_element[f] = "; ".join(factors_for_element[f])
-
-    depth_df = pd.DataFrame(intersection_depth.values(), index=intersection_depth.keys(), columns=["Depth"])
-    depth_df.sort_values(by="Depth", ascending=False, inplace=True)
-    factors_df = pd.DataFrame(
-        factors_for_element.values(), index=factors_for_element.keys(), columns=["Configurations"]
-    )
-    depth_df = pd.concat([depth_df, factors_df], axis=1)
-
-    combos = count_combinations(nested_dict)
-    depth_df["RelativeDepth"] = depth_df["Depth"] / combos
+    depth_df = SignificanceMatrix.from_sets(nested_dict).to_depth_df().set_index("Key")
+    depth_df.index.name = None
+    depth_df["RelativeDepth"] = depth_df["Depth"] / count_combinations(nested_dict)
 
     if len(depth_df) < 1:
         print("No significant terms found!")
@@ -87,3 +372,82 @@ def create_intersection_depth_df(nested_dict: Dict[Dict, Set]) -> pd.DataFrame:
         return depth_df[["Description", "Depth", "RelativeDepth", "Configurations"]]
 
     return depth_df[["Depth", "RelativeDepth", "Configurations"]]
+
+
+def create_store_depth_df(
+    store: ResultStore, tools: List[str], metrics: List[str], qval: float, verbose: bool = False
+) -> pd.DataFrame:
+    """
+    Intersection depth of the significant terms of a ResultStore, see SignificanceMatrix.
+    :returns: pd.DataFrame indexed by term ID with Description, Depth, RelativeDepth, Configurations and Direction
+    """
+    depth_df = SignificanceMatrix.from_store(store, tools, metrics, qval, verbose).to_depth_df()
+    if len(depth_df) < 1:
+        print("No significant terms found!")
+    depth_df = depth_df.set_index("Term")
+    depth_df.index.name = None
+    return depth_df[["Description", "Depth", "RelativeDepth", "Configurations", "Direction"]]
+
+
+def _sweep_records(
+    store: ResultStore, tools: List[str], metrics: List[str], thresholds: List[float]
+) -> Tuple[np.ndarray, pd.DataFrame, np.ndarray, np.ndarray, np.ndarray, List[str]]:
+    """
+    Records of the configurations (tool.metric) that are significant at the largest threshold, one per key and
+    configuration (the smallest qvalue if a term is listed twice).
+    :returns: Sorted thresholds, keys (see _intern_keys), and the key id, configuration id and threshold bin of each
+              record (the number of thresholds <= qvalue, i.e. the record is significant from that sorted threshold on),
+              and the configuration names
+    """
+    cutoffs = np.unique(np.asarray(thresholds, dtype=float))
+    if len(cutoffs) < 1:
+        raise Exception("No qvalue thresholds given")
+    records = store.records
+    config_ids, configurations = _configuration_ids(store, tools, metrics)
+    qvalues = records["qvalue"].to_numpy(dtype=float)
+    mask = (qvalues < cutoffs[-1]) & (config_ids >= 0) & (records["Direction"].cat.codes.to_numpy() >= 0)
+    keys, key_ids = _intern_keys(store, mask)
+    qvalues, config_ids = qvalues[mask], config_ids[mask]
+
+    pairs = key_ids * len(configurations) + config_ids
+    order = np.lexsort((qvalues, pairs))
+    first = order[np.r_[True, pairs[order][1:] != pairs[order][:-1]]] if len(order) > 0 else order
+    bins = np.searchsorted(cutoffs, qvalues[first], side="right")
+    return cutoffs, keys, key_ids[first], config_ids[first], bins, configurations
+
+
+def create_threshold_sweep_df(
+    store: ResultStore, tools: List[str], metrics: List[str], thresholds: List[float]
+) -> pd.DataFrame:
+    """
+    Intersection depth of each significant term at every qvalue cutoff in one pass: records are binned by the sorted
+    cutoffs and the depths are cumulative counts over the bins, so the cost does not grow with the number of cutoffs.
+    :param thresholds: qvalue cutoffs, a term is significant in a configuration if qvalue < cutoff
+    :returns: Long pd.DataFrame indexed by term ID with one row per qval and (term, Direction) with Depth > 0;
+              columns qval, Description, Depth, RelativeDepth and Direction
+    """
+    cutoffs, keys, key_ids, config_ids, bins, configurations = _sweep_records(store, tools, metrics, thresholds)
+    n_bins = len(cutoffs)
+    depth = np.bincount(key_ids * n_bins + bins, minlength=len(keys) * n_bins)
+    depth = depth.reshape(len(keys), n_bins).cumsum(axis=1)
+    rows, cols = np.nonzero(depth)
+    sweep_df = keys.iloc[rows].reset_index(drop=True)
+    sweep_df.insert(0, "qval", cutoffs[cols])
+    sweep_df["Depth"] = depth[rows, cols]
+    sweep_df["RelativeDepth"] = sweep_df["Depth"] / len(configurations)
+    sweep_df = sweep_df.sort_values(by=["qval", "Depth"], ascending=[True, False], kind="stable").set_index("Term")
+    sweep_df.index.name = None
+    return sweep_df[["qval", "Description", "Depth", "RelativeDepth", "Direction"]]
+
+
+def count_significant_by_threshold(
+    store: ResultStore, tools: List[str], metrics: List[str], thresholds: List[float]
+) -> pd.DataFrame:
+    """
+    :returns: Number of significant (Term, Direction) keys per qvalue cutoff (index qval) and configuration (columns)
+    """
+    cutoffs, _, _, config_ids, bins, configurations = _sweep_records(store, tools, metrics, thresholds)
+    n_bins = len(cutoffs)
+    counts = np.bincount(config_ids * n_bins + bins, minlength=len(configurations) * n_bins)
+    counts = counts.reshape(len(configurations), n_bins).cumsum(axis=1)
+    return pd.DataFrame(counts.T, index=pd.Index(cutoffs, name="qval"), columns=configurations)
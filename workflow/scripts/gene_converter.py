@@ -0,0 +1,211 @@
+# scripts/gene_converter.py
+
+import os
+import json
+import argparse
+import shutil
+import tempfile
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from utils import file_digest
+
+
+MAPPING_VERSION = 1
+
+
+def _encode(values) -> np.ndarray:
+    return np.char.encode(np.asarray(values, dtype=str), "utf-8")
+
+
+def _decode(values: np.ndarray) -> np.ndarray:
+    return np.char.decode(values, "utf-8").astype(object)
+
+
+class GeneMapping:
+    """
+    Prebuilt identifier mapping opened with mmap: Entrez IDs and symbols of all genes, plus for each keytype the sorted
+    unique identifiers and CSR arrays (indptr, genes) listing the genes (positions in entrez) of each identifier.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        meta_file = os.path.join(path, "meta.json")
+        if not os.path.isfile(meta_file):
+            raise Exception(f"No gene mapping found at {path}, build it with: gene_converter.py build")
+        with open(meta_file) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != MAPPING_VERSION:
+            raise Exception(f"Unsupported gene mapping version in {meta_file}: {self.meta.get('version')}")
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    @property
+    def keytypes(self) -> List[str]:
+        return self.meta["keytypes"]
+
+    def convert(self, ids: List[str], keytype: str) -> pd.DataFrame:
+        """
+        Map identifiers to Entrez IDs and symbols like clusterProfiler::bitr: one row per identifier and gene, in order
+        of first appearance of the identifiers, identifiers without a gene are dropped.
+
+        :returns: pd.DataFrame with columns keytype, ENTREZID and SYMBOL (as in bitr, each column appears once)
+        """
+        if keytype not in self.keytypes:
+            raise Exception(f"Keytype not in gene mapping {self.path}: {keytype}, choose from {self.keytypes}")
+
+        ids = pd.unique(pd.Series(ids, dtype=object).dropna().astype(str).to_numpy())
+        keys = self._load(f"{keytype}.keys")
+        indptr = self._load(f"{keytype}.indptr")
+        genes = self._load(f"{keytype}.genes")
+
+        query = _encode(ids)
+        pos = np.searchsorted(keys, query)
+        found = np.flatnonzero(keys[np.minimum(pos, len(keys) - 1)] == query) if len(keys) else np.zeros(0, int)
+        starts, ends = indptr[pos[found]], indptr[pos[found] + 1]
+        counts = ends - starts
+        rows = np.repeat(found, counts)
+        # Position of each (identifier, gene) pair in genes: start of its identifier plus offset within it
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        gene_pos = np.asarray(genes[np.repeat(starts, counts) + offsets])
+
+        symbols = _decode(self._load("symbol")[gene_pos])
+        df = pd.DataFrame(
+            {
+                keytype: ids[rows],
+                "ENTREZID": _decode(self._load("entrez")[gene_pos]),
+                "SYMBOL": np.where(symbols == "", None, symbols),
+            }
+        )
+        columns = [keytype] + [c for c in ["ENTREZID", "SYMBOL"] if c != keytype]
+        return df[columns].drop_duplicates().reset_index(drop=True)
+
+    def identifiers(self, entrez: List[str], keytype: str) -> np.ndarray:
+        """First identifier of keytype (in sorted order) of each Entrez ID, NaN for genes without one"""
+        if keytype not in self.keytypes:
+            raise Exception(f"Keytype not in gene mapping {self.path}: {keytype}, choose from {self.keytypes}")
+
+        keys = self._load(f"{keytype}.keys")
+        indptr = np.asarray(self._load(f"{keytype}.indptr"))
+        genes = np.asarray(self._load(f"{keytype}.genes"))
+        # Keys are sorted, so the first pair of each gene holds its first identifier
+        gene_pos, first = np.unique(genes, return_index=True)
+        key_pos = np.searchsorted(indptr, first, side="right") - 1
+        first_key = pd.Series(_decode(keys[key_pos]), index=gene_pos)
+
+        pos = pd.Index(_decode(self._load("entrez"))).get_indexer(pd.Series(entrez, dtype=object).astype(str))
+        return first_key.reindex(pos).to_numpy(dtype=object)
+
+
+def read_gene_info(source: str) -> pd.DataFrame:
+    """Entrez ID, symbol and Ensembl gene IDs (dbXrefs) of an NCBI gene_info file, one row per Ensembl ID"""
+    tab = pd.read_csv(source, sep="\t", usecols=["GeneID", "Symbol", "dbXrefs"], dtype=str)
+    tab = pd.DataFrame(
+        {
+            "ENTREZID": tab["GeneID"],
+            "SYMBOL": tab["Symbol"],
+            "ENSEMBL": tab["dbXrefs"].str.findall(r"Ensembl:(ENS\w+)"),
+        }
+    )
+    return tab.explode("ENSEMBL")
+
+
+def build_gene_mapping(source: str, outdir: str, fmt: str = "gene_info") -> None:
+    """
+    Build the gene mapping read by GeneMapping, once per organism.
+
+    :param fmt: "gene_info" (NCBI gene_info file, keytypes ENTREZID, SYMBOL and ENSEMBL) or "orgdb" (csv export of an
+                org DB with an ENTREZID column and one column per keytype, e.g. AnnotationDbi::select(org.Hs.eg.db,
+                keys(org.Hs.eg.db), c("SYMBOL", "ENSEMBL", "UNIPROT")))
+    """
+    match fmt:
+        case "gene_info":
+            tab = read_gene_info(source)
+        case "orgdb":
+            tab = pd.read_csv(source, dtype=str)
+        case _:
+            raise Exception(f"Unknown gene mapping source format: {fmt}")
+    if "ENTREZID" not in tab or "SYMBOL" not in tab:
+        raise Exception(f"ENTREZID and SYMBOL columns required in {source}")
+
+    tab = tab.dropna(subset=["ENTREZID"]).drop_duplicates()
+    gene_ids, entrez = pd.factorize(tab["ENTREZID"])  # genes in order of the source
+    symbols = tab.dropna(subset=["SYMBOL"]).drop_duplicates("ENTREZID").set_index("ENTREZID")["SYMBOL"]
+    arrays = {"entrez": _encode(entrez), "symbol": _encode(symbols.reindex(entrez).fillna(""))}
+
+    keytypes = list(tab.columns)
+    for keytype in keytypes:
+        pairs = pd.DataFrame({"key": tab[keytype].to_numpy(), "gene": gene_ids}).dropna().drop_duplicates()
+        keys = pairs["key"].astype(str).to_numpy()
+        order = np.argsort(_encode(keys), kind="stable")  # sorted as bytes for searchsorted, genes in source order
+        uniques, starts = np.unique(_encode(keys)[order], return_index=True)
+        arrays[f"{keytype}.keys"] = uniques
+        arrays[f"{keytype}.indptr"] = np.append(starts, len(keys)).astype(np.int64)
+        arrays[f"{keytype}.genes"] = pairs["gene"].to_numpy()[order].astype(np.int32)
+
+    meta = {
+        "version": MAPPING_VERSION,
+        "source": os.path.basename(source),
+        "format": fmt,
+        "digest": file_digest(source),
+        "keytypes": keytypes,
+        "n_genes": len(entrez),
+    }
+
+    # Write to a temporary folder and move it into place, so that readers never see a partial mapping
+    parent = os.path.dirname(os.path.abspath(outdir))
+    os.makedirs(parent, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=parent)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmpdir, f"{name}.npy"), arr)
+    with open(os.path.join(tmpdir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.rename(tmpdir, outdir)
+    print(f"Saved gene mapping of {len(entrez)} genes ({', '.join(keytypes)}) to {outdir}")
+
+
+def write_r_csv(df: pd.DataFrame, outfile: str) -> None:
+    """Write a table of strings as write.csv(df, row.names=FALSE) in R: quoted fields, missing values as NA unquoted"""
+
+    def quote(value) -> str:
+        return "NA" if pd.isna(value) else '"' + str(value).replace('"', '""') + '"'
+
+    with open(outfile, "w") as f:
+        f.write(",".join(quote(c) for c in df.columns) + "\n")
+        for row in df.itertuples(index=False, name=None):
+            f.write(",".join(quote(v) for v in row) + "\n")
+
+
+def create_gene_converter(input_file: str, keytype: str, outfile: str, mapping_dir: str) -> None:
+    """Write the gene converter table (keytype, ENTREZID, SYMBOL) of the IDs in the first column of input_file"""
+    ids = pd.read_csv(input_file, usecols=[0], dtype=str).iloc[:, 0]
+    df = GeneMapping(mapping_dir).convert(ids, keytype)
+    print(f"Mapped {df[keytype].nunique()} of {ids.nunique()} {keytype} IDs")
+    write_r_csv(df, outfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gene converter table from a prebuilt gene mapping")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert", help="Write the gene converter table of an input file")
+    convert.add_argument("input_file")
+    convert.add_argument("keytype")
+    convert.add_argument("outfile")
+    convert.add_argument("--mapping", required=True, help="Gene mapping folder (see build)")
+
+    build = subparsers.add_parser("build", help="Build a gene mapping from an NCBI gene_info file or org DB csv")
+    build.add_argument("source")
+    build.add_argument("outdir")
+    build.add_argument("--format", default="gene_info", choices=["gene_info", "orgdb"])
+
+    args = parser.parse_args()
+    match args.command:
+        case "convert":
+            create_gene_converter(args.input_file, args.keytype, args.outfile, args.mapping)
+        case "build":
+            build_gene_mapping(args.source, args.outdir, args.format)
@@ -0,0 +1,199 @@
+# scripts/gene_set_index.py
+
+import os
+import glob
+import json
+import shutil
+import tempfile
+from functools import cached_property
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils import file_digest, read_enrichr, read_enrichr_library, read_gmt
+
+
+INDEX_VERSION = 1
+INDEX_DIR = ".index"  # created next to the gmt file
+
+
+class GeneSetIndex:
+    """
+    Compiled gene set library opened with mmap: term and gene string tables plus CSR integer membership arrays.
+    Row i of (indptr, indices) lists the ids (into genes) of the members of term i, sorted.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.indptr = self._load("indptr")
+        self.indices = self._load("indices")
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def _strings(self, name: str) -> np.ndarray:
+        return np.char.decode(self._load(name), "utf-8").astype(object)
+
+    @cached_property
+    def ids(self) -> pd.Index:
+        return pd.Index(self._strings("ids"), name="ID")
+
+    @cached_property
+    def descriptions(self) -> np.ndarray:
+        return self._strings("descriptions")
+
+    @cached_property
+    def categories(self) -> np.ndarray:
+        return self._strings("categories")
+
+    @cached_property
+    def genes(self) -> pd.Index:
+        return pd.Index(self._strings("genes"))
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def get_genes(self, terms: Optional[List[str]] = None) -> List[List[str]]:
+        """Member genes of the given term IDs (all terms if None); unknown terms get an empty list"""
+        if terms is None:
+            rows = np.arange(len(self))
+        else:
+            first = np.flatnonzero(~self.ids.duplicated())  # first occurrence of each term ID
+            found = self.ids[first].get_indexer(terms)
+            rows = np.where(found >= 0, first[found], -1)
+        genes = self.genes.to_numpy()
+        return [genes[self.indices[self.indptr[r] : self.indptr[r + 1]]].tolist() if r >= 0 else [] for r in rows]
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        return dict(zip(self.ids, self.get_genes(), strict=True))
+
+    def to_frame(self, genes: bool = True) -> pd.DataFrame:
+        """Same layout as utils.read_gmt; Genes are only materialised if requested"""
+        df = pd.DataFrame({"ID": self.ids, "Description": self.descriptions, "Category": self.categories})
+        if genes:
+            df["Genes"] = self.get_genes()
+        return df
+
+    def membership(self, ranked_genes: pd.Index) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Remap memberships onto positions in a ranked gene list (must be unique), dropping genes not in the ranking.
+
+        :returns: indptr, indices of the terms x ranked genes CSR matrix, sorted within rows
+        """
+        n_genes = len(ranked_genes)
+        gene_pos = ranked_genes.get_indexer(self.genes)
+        cols = gene_pos[self.indices]
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), self.sizes)
+
+        found = cols >= 0
+        keys = np.sort(rows[found] * n_genes + cols[found])
+        rows, cols = np.divmod(keys, n_genes)
+
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self)), out=indptr[1:])
+        return indptr, cols
+
+
+def _encode(values) -> np.ndarray:
+    return np.char.encode(np.asarray(values, dtype=str), "utf-8")
+
+
+def compile_gmt(gmt_file: str, outdir: str, fmt: str = "gmt") -> None:
+    """
+    Parse a gmt file once and write it as a binary gene set index to outdir.
+
+    :param fmt: "gmt" (ID, Category, Description, genes...), "enrichr" (Enrichr GO library keyed by GO ID,
+                see utils.read_enrichr) or "library" (Enrichr library keyed by term name, see utils.read_enrichr_library)
+    """
+    match fmt:
+        case "gmt":
+            df = read_gmt(gmt_file)
+        case "enrichr":
+            df = read_enrichr(gmt_file).reset_index()
+            df["Category"] = ""
+        case "library":
+            df = read_enrichr_library(gmt_file)
+        case _:
+            raise Exception(f"Unknown gmt format: {fmt}")
+
+    sizes = df["Genes"].str.len().to_numpy(dtype=np.int64)
+    gene_ids, genes = pd.factorize(pd.Series([g for genes in df["Genes"] for g in genes], dtype=object))
+    rows = np.repeat(np.arange(len(df), dtype=np.int64), sizes)
+    keys = np.sort(rows * len(genes) + gene_ids)  # by row, then by column
+    keys = keys[np.diff(keys, prepend=-1) != 0]  # drop duplicated genes within a term
+    rows, indices = np.divmod(keys, len(genes))
+    indptr = np.zeros(len(df) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(df)), out=indptr[1:])
+
+    arrays = {
+        "ids": _encode(df["ID"]),
+        "descriptions": _encode(df["Description"]),
+        "categories": _encode(df["Category"]),
+        "genes": _encode(genes),
+        "indptr": indptr,
+        "indices": indices.astype(np.int32),
+    }
+    os.makedirs(outdir, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(outdir, f"{name}.npy"), arr)
+
+    stat = os.stat(gmt_file)
+    meta = {
+        "version": INDEX_VERSION,
+        "source": os.path.basename(gmt_file),
+        "format": fmt,
+        "digest": file_digest(gmt_file),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "n_terms": len(df),
+        "n_genes": len(genes),
+    }
+    with open(os.path.join(outdir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def load_gene_set_index(gmt_file: str, fmt: str = "gmt") -> GeneSetIndex:
+    """
+    Open the compiled index of a gmt file, compiling it first if needed.
+    Indexes are cached in a .index folder next to the gmt file, keyed by the content hash of the gmt file.
+    """
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(gmt_file)), INDEX_DIR)
+    prefix = f"{os.path.basename(gmt_file)}.{fmt}.v{INDEX_VERSION}"
+
+    # Skip hashing if the gmt file is unchanged since an index was compiled
+    stat = os.stat(gmt_file)
+    for path in glob.glob(os.path.join(cache_dir, f"{prefix}.*")):
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta["size"] == stat.st_size and meta["mtime_ns"] == stat.st_mtime_ns:
+            return GeneSetIndex(path)
+
+    path = os.path.join(cache_dir, f"{prefix}.{file_digest(gmt_file)}")
+    meta_file = os.path.join(path, "meta.json")
+    if os.path.isfile(meta_file):
+        # Same content, new timestamp (e.g. copied or touched): refresh the stat fast path
+        with open(meta_file) as f:
+            meta = json.load(f)
+        meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        with open(meta_file, "w") as f:
+            json.dump(meta, f, indent=4)
+    else:
+        print(f"Compiling gene set index for {gmt_file}")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=cache_dir)
+        compile_gmt(gmt_file, tmpdir, fmt=fmt)
+        try:
+            os.rename(tmpdir, path)
+        except OSError:  # compiled concurrently by another job
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return GeneSetIndex(path)
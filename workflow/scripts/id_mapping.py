@@ -0,0 +1,207 @@
+# scripts/id_mapping.py
+
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import mygene
+except ModuleNotFoundError:
+    mygene = None
+
+
+ID_MAPPING_VERSION = 1
+# Shared by all projects, independent of the working directory
+ID_MAPPING_DB = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources", "Ontologies", "id_mapping.sqlite"
+)
+
+# Identifier types, with their mygene.info query scopes and result fields
+MYGENE_SCOPES = {"ENSP": "ensembl.protein", "ENSG": "ensembl.gene", "ENTREZ": "entrezgene", "SYMBOL": "symbol"}
+MYGENE_FIELDS = {"ENSP": "ensembl.protein", "ENSG": "ensembl.gene", "ENTREZ": "entrezgene", "SYMBOL": "symbol"}
+MYGENE_BATCH = 1000  # IDs per request
+MYGENE_WORKERS = 4  # parallel requests
+
+# value is NULL for IDs that were queried but not found, so that they are not queried again
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS mapping (
+    species TEXT NOT NULL,
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    query TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (species, source, target, query)
+) WITHOUT ROWID;
+"""
+
+
+class IdMappingStore:
+    """
+    On-disk cache of identifier mappings (ENSP, ENSG, ENTREZ, SYMBOL) of all species in SQLite.
+    The mappings of one (species, source, target) are read once into a pd.Series, so lookups are vectorized.
+    """
+
+    def __init__(self, path: str = ID_MAPPING_DB) -> None:
+        self.path = path
+        self._tables: Dict[Tuple[str, str, str], pd.Series] = {}
+
+    def connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=120)
+        con.executescript(SCHEMA)
+        version = con.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if version is None:
+            con.execute("INSERT INTO meta VALUES ('version', ?)", (str(ID_MAPPING_VERSION),))
+            con.commit()
+        elif int(version[0]) != ID_MAPPING_VERSION:
+            raise Exception(f"Unsupported ID mapping store version in {self.path}: {version[0]}")
+        return con
+
+    def table(self, species: str, source: str, target: str) -> pd.Series:
+        """All cached mappings from source to target IDs, indexed by source ID (missing if not found)"""
+        key = (str(species), source, target)
+        if key not in self._tables:
+            con = self.connect()
+            try:
+                sql = "SELECT query, value FROM mapping WHERE species = ? AND source = ? AND target = ?"
+                df = pd.read_sql_query(sql, con, params=key)
+            finally:
+                con.close()
+            self._tables[key] = pd.Series(
+                df["value"].to_numpy(dtype=object), index=pd.Index(df["query"].to_numpy(dtype=object))
+            )
+        return self._tables[key]
+
+    def lookup(self, ids: pd.Index, species: str, source: str, target: str) -> Tuple[pd.Series, np.ndarray]:
+        """
+        :returns: Cached target IDs indexed by ids (missing if unknown or not found), mask of the ids not in the store
+        """
+        table = self.table(species, source, target)
+        pos = table.index.get_indexer(ids)
+        values = np.append(table.to_numpy(), None)[pos]  # position -1 (not in the store) picks the appended None
+        return pd.Series(values, index=ids, dtype=object), pos < 0
+
+    def add(self, species: str, source: str, target: str, mapping: Dict[str, Optional[str]]) -> None:
+        """Store mappings of source IDs to target IDs, None for IDs that were not found"""
+        con = self.connect()
+        try:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO mapping VALUES (?, ?, ?, ?, ?)",
+                    ((str(species), source, target, k, v) for k, v in mapping.items()),
+                )
+        finally:
+            con.close()
+        self._tables.pop((str(species), source, target), None)
+
+
+def _get_field(item: Any, field: str) -> Any:
+    """Value of a dotted mygene field such as "ensembl.gene", taking the first of several hits"""
+    for part in field.split("."):
+        if isinstance(item, list):
+            item = item[0] if item else None
+        if not isinstance(item, dict):
+            return None
+        item = item.get(part)
+    if isinstance(item, list):
+        item = item[0] if item else None
+    return item
+
+
+def query_mygene(client: Any, ids: List[str], species: str, source: str, target: str) -> Dict[str, Optional[str]]:
+    """Map one batch of ids with a mygene.MyGeneInfo-like client, ids not found map to None"""
+    field = MYGENE_FIELDS[target]
+    result = client.querymany(ids, scopes=MYGENE_SCOPES[source], fields=field, species=species, verbose=False)
+    mapped: Dict[str, Optional[str]] = dict.fromkeys(ids)
+    for item in result:
+        if item.get("notfound") or mapped.get(item["query"]) is not None:
+            continue  # keep the first hit of a query
+        value = _get_field(item, field)
+        if value is not None:
+            mapped[item["query"]] = str(value)
+    return mapped
+
+
+def map_ids(
+    ids: Iterable[str],
+    species: str,
+    source: str,
+    target: str,
+    store: Optional[IdMappingStore] = None,
+    client: Any = None,
+    batch_size: int = MYGENE_BATCH,
+    workers: int = MYGENE_WORKERS,
+) -> pd.Series:
+    """
+    Map identifiers through the ID mapping store. Only the ids missing from the store are queried, in batches of
+    batch_size on parallel requests, and each batch is added to the store as it arrives.
+
+    :param source: Identifier type of ids, a key of MYGENE_SCOPES
+    :param target: Identifier type to map to
+    :param client: mygene.MyGeneInfo-like client (e.g. LocalGeneInfo), default mygene.MyGeneInfo()
+    :returns: pd.Series of target IDs indexed by ids, missing (NaN) if not found
+    """
+    for id_type in [source, target]:
+        if id_type not in MYGENE_SCOPES:
+            raise Exception(f"Invalid identifier type: {id_type}, choose from {list(MYGENE_SCOPES)}")
+
+    store = store or IdMappingStore()
+    ids = pd.Index(list(ids), dtype=object)
+    unique = ids.unique()
+    mapped, missing = store.lookup(unique, species, source, target)
+
+    if missing.any():
+        if client is None:
+            if mygene is None:
+                raise Exception(f"{missing.sum()} {source} IDs are not in {store.path} and mygene is not installed")
+            client = mygene.MyGeneInfo()
+        todo = unique[missing].tolist()
+        batches = [todo[i : i + batch_size] for i in range(0, len(todo), batch_size)]
+        print(f"Querying {len(todo)} {source} IDs ({species}) in {len(batches)} batches")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(lambda batch: query_mygene(client, batch, species, source, target), batches):
+                store.add(species, source, target, result)
+        mapped, _ = store.lookup(unique, species, source, target)
+
+    return mapped.reindex(ids)
+
+
+class LocalGeneInfo:
+    """
+    Offline stand-in for mygene.MyGeneInfo (querymany only), answering from a table with one column per identifier
+    type (ENSP, ENSG, ENTREZ, SYMBOL) and optionally species, e.g. for tests or an export of an org DB
+    """
+
+    def __init__(self, table: pd.DataFrame) -> None:
+        self.table = table
+        self.queries: List[str] = []  # every queried ID, in order
+
+    def querymany(self, qterms: List[str], scopes: str, fields: str, species: Any = None, **kwargs) -> List[Dict]:
+        source = {v: k for k, v in MYGENE_SCOPES.items()}[scopes]
+        target = {v: k for k, v in MYGENE_FIELDS.items()}[fields]
+        self.queries += list(qterms)
+
+        tab = self.table
+        if species is not None and "species" in tab:
+            tab = tab[tab["species"].astype(str) == str(species)]
+        hits = tab.dropna(subset=[source, target]).drop_duplicates(source)
+        hits = pd.Series(hits[target].astype(str).to_numpy(), index=hits[source].astype(str))
+
+        result = []
+        for q in qterms:
+            if q in hits.index:
+                item: Dict[str, Any] = {"query": q}
+                node = item
+                *parents, leaf = fields.split(".")
+                for part in parents:
+                    node = node.setdefault(part, {})
+                node[leaf] = hits[q]
+                result.append(item)
+            else:
+                result.append({"query": q, "notfound": True})
+        return result
@@ -0,0 +1,161 @@
+# scripts/library_store.py
+
+import os
+import sys
+import json
+import fcntl
+import argparse
+import datetime
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List
+
+import requests
+
+from gene_set_index import GeneSetIndex, load_gene_set_index
+from utils import file_digest, parse_gene_sets
+
+
+ENRICHR_URL = "https://maayanlab.cloud/Enrichr/geneSetLibrary"
+STORE_DIR = os.path.join("resources", "Ontologies", "enrichr")
+MANIFEST = "manifest.json"
+MANIFEST_LOCK = ".manifest.lock"
+
+# Enrichr libraries used for the built-in ontologies
+GO_LIBRARIES = ["GO_Biological_Process_2023", "GO_Cellular_Component_2023", "GO_Molecular_Function_2023"]
+KEGG_LIBRARIES = {"hsa": "KEGG_2021_Human", "mmu": "KEGG_2019_Mouse"}
+
+
+def enrichr_library_names(ontology: str, organism_kegg: str = "") -> List[str]:
+    """Enrichr libraries backing the "GO" and "KEGG" ontologies"""
+    if ontology == "GO":
+        return GO_LIBRARIES
+    elif ontology == "KEGG" and organism_kegg in KEGG_LIBRARIES:
+        return [KEGG_LIBRARIES[organism_kegg]]
+    raise Exception(f"No Enrichr library for ontology {ontology} and organism {organism_kegg}")
+
+
+def library_file(name: str, store_dir: str = STORE_DIR) -> str:
+    return os.path.join(store_dir, f"{name}.gmt")
+
+
+def read_manifest(store_dir: str = STORE_DIR) -> Dict[str, Dict]:
+    manifest_file = os.path.join(store_dir, MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def store_library(name: str, lines: Iterable[str], store_dir: str = STORE_DIR, url: str = "") -> str:
+    """
+    Write an Enrichr library in text format into the store, compile its gene set index and record it in the manifest.
+    Enrichr library names carry their release (e.g. KEGG_2021_Human), so a stored library never goes stale.
+
+    :param lines: Lines of the library (term, empty column, genes with optional weights)
+    :param url: Source of the library, recorded in the manifest
+    """
+    # Write atomically, several jobs may request the same library
+    os.makedirs(store_dir, exist_ok=True)
+    outfile = library_file(name, store_dir)
+    n_terms = 0
+    with tempfile.NamedTemporaryFile("w", dir=store_dir, suffix=".tmp", delete=False) as f:
+        for fields, genes in parse_gene_sets(lines):
+            f.write("\t".join([fields[0], ""] + genes) + "\n")
+            n_terms += 1
+    if n_terms == 0:
+        os.remove(f.name)
+        raise Exception(f"Empty Enrichr library: {name}")
+    os.replace(f.name, outfile)
+
+    index = load_gene_set_index(outfile, fmt="library")
+
+    entry = {
+        "file": os.path.basename(outfile),
+        "url": url,
+        "retrieved": datetime.date.today().isoformat(),
+        "digest": file_digest(outfile),
+        "n_terms": len(index),
+        "n_genes": len(index.genes),
+    }
+    # Merge into the manifest on disk, which other jobs storing libraries may have updated
+    with _manifest_lock(store_dir):
+        manifest = read_manifest(store_dir)
+        manifest[name] = entry
+        with tempfile.NamedTemporaryFile("w", dir=store_dir, suffix=".tmp", delete=False) as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(f.name, os.path.join(store_dir, MANIFEST))
+    return outfile
+
+
+@contextmanager
+def _manifest_lock(store_dir: str) -> Iterator[None]:
+    """Exclusive lock on the manifest of the store, held by one writing process at a time (as in summary_store.py)"""
+    with open(os.path.join(store_dir, MANIFEST_LOCK), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def download_library(name: str, store_dir: str = STORE_DIR, url: str = ENRICHR_URL) -> str:
+    """Download an Enrichr library into the store, see store_library"""
+    print(f"Downloading Enrichr library: {name}")
+    response = requests.get(url, params={"mode": "text", "libraryName": name}, timeout=300)
+    response.raise_for_status()
+    return store_library(name, response.text.splitlines(), store_dir, url=response.url)
+
+
+def import_library(name: str, source: str, store_dir: str = STORE_DIR) -> str:
+    """Add an Enrichr library file in text format (e.g. downloaded on another machine) to the store, see store_library"""
+    with open(source) as f:
+        return store_library(name, f, store_dir, url=os.path.abspath(source))
+
+
+def get_library_file(name: str, store_dir: str = STORE_DIR, download: bool = True) -> str:
+    """Path of an Enrichr library in the local store; only downloaded if missing"""
+    path = library_file(name, store_dir)
+    if os.path.isfile(path):
+        return path
+    if not download:
+        raise Exception(f"Enrichr library {name} not found in {store_dir} and downloads are disabled")
+    return download_library(name, store_dir)
+
+
+def get_library(name: str, store_dir: str = STORE_DIR, download: bool = True) -> GeneSetIndex:
+    """Compiled gene set index of an Enrichr library, keyed by full term name as in gseapy"""
+    return load_gene_set_index(get_library_file(name, store_dir, download), fmt="library")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Populate the local Enrichr library store.")
+    parser.add_argument("libraries", nargs="+", help="Enrichr library names, or GO / KEGG")
+    parser.add_argument("--organism", default="hsa", help="KEGG organism code used to resolve KEGG")
+    parser.add_argument("--store", default=STORE_DIR, help="Library store folder")
+    parser.add_argument("--force", action="store_true", help="Download again even if already stored")
+    parser.add_argument("--from-file", default="", help="Import a single library from this Enrichr text file")
+    parser.add_argument("--outfile", default="", help="Write resolved library files to this json file")
+
+    args = parser.parse_args()
+
+    resolved = {}
+    if args.from_file:
+        if len(args.libraries) != 1:
+            raise Exception("--from-file imports exactly one library")
+        resolved[args.libraries[0]] = import_library(args.libraries[0], args.from_file, args.store)
+        args.libraries = []
+    for lib in args.libraries:
+        names = enrichr_library_names(lib, args.organism) if lib in ["GO", "KEGG"] else [lib]
+        for name in names:
+            if args.force:
+                resolved[name] = download_library(name, args.store)
+            else:
+                resolved[name] = get_library_file(name, args.store)
+            get_library(name, args.store, download=False)  # make sure the index is compiled
+
+    if args.outfile:
+        with open(args.outfile, "w") as f:
+            json.dump(resolved, f, indent=4)
+    else:
+        json.dump(resolved, sys.stdout, indent=4)
@@ -2,8 +2,7 @@ import os
 import sys
 import warnings
 import yaml
-import pickle
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import numpy as np
 import pandas as pd
@@ -14,11 +13,12 @@ from matplotlib.ticker import MaxNLocator
 from mpl_toolkits.axes_grid1.axes_divider import make_axes_locatable
 import seaborn as sns
 
-from upsetplot import from_memberships
+from upsetplot import from_indicators
 from upsetplot import UpSet
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from scripts.explore_results import get_sig_dict
+from scripts.explore_results import ResultStore, SignificanceMatrix
+from scripts.summary_store import load_summary
 
 
 def npg_palette():
@@ -37,7 +37,8 @@ def npg_palette():
     return sns.color_palette(palette, len(palette))
 
 
-def plot_venn(sig_dict, tools, metrics, ax=None, pretty_print=None):
+def plot_venn(matrix: SignificanceMatrix, tools, metrics, ax=None, pretty_print=None):
+    """Venn diagram of the significant terms of the configurations tools x metrics of a SignificanceMatrix"""
     if not isinstance(tools, list):
         tools = [tools]
     if not isinstance(metrics, list):
@@ -52,24 +53,27 @@ def plot_venn(sig_dict, tools, metrics, ax=None, pretty_print=None):
 
     tool_is_top_level = len(tools) < len(metrics)
 
-    sets, labels = [], []
+    columns, labels = [], []
     for tool in tools:
         for metric in metrics:
-            s = sig_dict[tool][metric]
-            sets.append(s)
+            columns.append(matrix.configurations.index(f"{tool}.{metric}"))
             labels.append(metric if tool_is_top_level else tool)
             if pretty_print:  # pretty print labels
                 if labels[-1] in pretty_print:
                     labels[-1] = pretty_print[labels[-1]]
 
+    # Subset sizes in the order of matplotlib_venn (Ab, aB, AB, ...): terms counted by their membership bitmask
+    masks = matrix.indicators()[:, columns] @ (1 << np.arange(n_sets))
+    subsets = tuple(np.bincount(masks, minlength=2**n_sets)[1:].tolist())
+
     if not ax:
         fig, ax = plt.subplots(1, 1, figsize=(4, 4))
 
     with warnings.catch_warnings(action="ignore"):
-        if len(sets) == 2:
-            venn2(sets, set_labels=labels, ax=ax)
-        elif len(sets) == 3:
-            venn3(sets, set_labels=labels, ax=ax)
+        if n_sets == 2:
+            venn2(subsets, set_labels=labels, ax=ax)
+        elif n_sets == 3:
+            venn3(subsets, set_labels=labels, ax=ax)
 
     plt.title(tool if tool_is_top_level else metric)
 
@@ -123,9 +127,7 @@ def make_bar_plots(
     # Number of terms
 
     for ax, lib in zip(axes[nlib:], lib_names.keys(), strict=False):
-        summary_df = summary_dict[lib]["summary_df"]
-        qv = summary_df.drop(["Combined", "nan"], axis=1, level=0)
-        qv = qv.xs("qvalue", level=2, axis=1)
+        qv = ResultStore.from_summary_dict(summary_dict[lib]).pivot("qvalue")
         qv = qv.replace(np.nan, 1)
         qv = qv < qval
 
@@ -171,6 +173,51 @@ def make_bar_plots(
         fig.savefig(f"{figpath}/bars.{project_name}.{ext}")
 
 
+def make_sweep_plots(
+    summary_dict: Dict,
+    figpath: str | None,
+    project_name: str,
+    lib_names: Dict,
+    qval: float = 0.05,
+    palette=None,
+    max_depth: int = 0,
+    ext: str = "pdf",
+):
+    """Robustness curves: number of terms with at least a given depth per qvalue cutoff, see combine_libs qval_sweep"""
+    sns.set_theme(font_scale=1.2)
+    if palette is None:
+        palette = npg_palette()
+
+    nlib = len(lib_names.keys())
+
+    with sns.axes_style("whitegrid"):
+        fig, axes = plt.subplots(1, nlib, figsize=(nlib * 5, 5), squeeze=False)
+    axes = axes.flatten()
+
+    for ax, lib in zip(axes, lib_names.keys(), strict=True):
+        sweep_df = summary_dict[lib].get("sweep_df")
+        ax.set(title=lib, xlabel="Q-value cutoff", ylabel="Terms")
+        if sweep_df is None or len(sweep_df) < 1:
+            print(f"No threshold sweep found for {lib}")
+            continue
+        cutoffs = np.unique(sweep_df["qval"])
+        depths = range(1, (max_depth if max_depth else sweep_df["Depth"].max()) + 1)
+
+        # Terms with Depth >= d at each cutoff, from the counts of each (qval, Depth)
+        counts = sweep_df.groupby(["qval", "Depth"]).size().unstack(fill_value=0)
+        counts = counts.reindex(index=cutoffs, columns=depths, fill_value=0)
+        at_least = counts.iloc[:, ::-1].cumsum(axis=1).iloc[:, ::-1]
+        for depth in depths:
+            ax.plot(cutoffs, at_least[depth], marker="o", color=palette[(depth - 1) % len(palette)], label=depth)
+        ax.axvline(qval, color="gray", linestyle="--")
+        ax.set_xscale("log")
+        ax.legend(title="Robustness ≥", fontsize="small", ncols=2)
+
+    fig.tight_layout()
+    if figpath:
+        fig.savefig(f"{figpath}/sweep.{project_name}.{ext}")
+
+
 def make_venn_plots(
     summary_dict,
     figpath: str,
@@ -193,11 +240,11 @@ def make_venn_plots(
             ax = np.expand_dims(ax, axis=1)
 
         for i, lib in enumerate(lib_names.keys()):
-            summary_df = summary_dict[lib]["summary_df"]
-            sig_dict = get_sig_dict(summary_df, tools, metrics, qval=qval)
+            store = ResultStore.from_summary_dict(summary_dict[lib])
+            matrix = SignificanceMatrix.from_store(store, tools, metrics, qval=qval)
             for j, metric in enumerate(metrics):
                 print(tools, metric)
-                plot_venn(sig_dict, tools, metric, ax[i][j], pretty_print)
+                plot_venn(matrix, tools, metric, ax[i][j], pretty_print)
                 ax[i][j].set_title(f"{pretty_print[metric] if pretty_print else metric} ({lib})", fontweight="bold")
 
         fig.tight_layout()
@@ -212,10 +259,10 @@ def make_venn_plots(
             ax = np.expand_dims(ax, axis=0).T
 
         for i, lib in enumerate(lib_names.keys()):
-            summary_df = summary_dict[lib]["summary_df"]
-            sig_dict = get_sig_dict(summary_df, tools, metrics, qval=0.05)
+            store = ResultStore.from_summary_dict(summary_dict[lib])
+            matrix = SignificanceMatrix.from_store(store, tools, metrics, qval=0.05)
             for j, tool in enumerate(tools):
-                plot_venn(sig_dict, tool, metrics, ax[i][j], pretty_print)
+                plot_venn(matrix, tool, metrics, ax[i][j], pretty_print)
                 ax[i][j].set_title(f"{pretty_print[tool] if pretty_print else tool} ({lib})", fontweight="bold")
 
         fig.tight_layout()
@@ -223,18 +270,33 @@ def make_venn_plots(
 
 
 def make_upset_plots(
-    summary_dict: Dict, lib_names: Dict, figpath: str, project_name: str, pretty_print: Dict, ext: str = "pdf"
+    summary_dict: Dict,
+    lib_names: Dict,
+    figpath: str,
+    project_name: str,
+    pretty_print: Dict,
+    ext: str = "pdf",
+    tools: Optional[List] = None,
+    metrics: Optional[List] = None,
+    qval: float = 0.05,
 ):
+    """
+    Upset plot of the terms with qvalue < qval per configuration (tools x metrics, all configurations of the store if
+    None), as counted in the depth_df
+    """
     for lib in lib_names.keys():
         outfile = f"{figpath}/upset.{lib}.{project_name}.{ext}"
-        depth_df = summary_dict[lib]["depth_df"]
-        if len(depth_df) < 1:
+        store = ResultStore.from_summary_dict(summary_dict[lib])
+        lib_tools = tools or list(dict.fromkeys(t for t, _ in store.configurations))
+        lib_metrics = metrics or list(dict.fromkeys(m for _, m in store.configurations))
+        matrix = SignificanceMatrix.from_store(store, lib_tools, lib_metrics, qval=qval)
+        if len(matrix.keys) < 1:
             print(f"No terms found for {lib}")
             save_empty(outfile, lib)
             continue
-        memberships = depth_df["Configurations"]
-        memberships_list = [categories.split("; ") for categories in memberships.values]
-        upset_ready = from_memberships(memberships_list)
+        # Configuration indicators (terms x configurations) of the significance matrix
+        memberships = pd.DataFrame(matrix.indicators(), columns=matrix.configurations)
+        upset_ready = from_indicators(memberships)
         upset_ready.index.names = [
             " ".join([pretty_print[i] if pretty_print else i for i in u.split(".")]) for u in upset_ready.index.names
         ]  # pretty print
@@ -476,10 +538,8 @@ if __name__ == "__main__":
     if isinstance(fig_formats, str):
         fig_formats = [fig_formats]
 
-    summary_dict_file = os.path.join("results", project_name, "combined", f"syn.summary_dict.{project_name}.txt")
-
-    with open(summary_dict_file, "rb") as f:
-        summary_dict = pickle.load(f)
+    # Tables of each library are only read when a plot needs them
+    summary_dict = load_summary(os.path.join("results", project_name, "combined"), project_name)
 
     for ext in fig_formats:
         make_bar_plots(
@@ -488,7 +548,19 @@ if __name__ == "__main__":
         make_venn_plots(
             summary_dict, figpath, project_name, lib_names, metrics, tools, pretty_print, qval=qval, ext=ext
         )
-        make_upset_plots(summary_dict, lib_names, figpath, project_name, pretty_print, ext=ext)
+        make_upset_plots(
+            summary_dict,
+            lib_names,
+            figpath,
+            project_name,
+            pretty_print,
+            ext=ext,
+            tools=tools,
+            metrics=metrics,
+            qval=qval,
+        )
+        if config.get("qval_sweep"):
+            make_sweep_plots(summary_dict, figpath, project_name, lib_names, qval=qval, max_depth=max_depth, ext=ext)
         make_lollipop_plots(
             summary_dict,
             lib_names,
@@ -0,0 +1,79 @@
+# scripts/prepare_ranks.py
+
+import sys
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+from gene_converter import GeneMapping
+from utils import write_ranks
+
+
+# Keytype of the gene mapping holding Ensembl protein IDs (org DB column, see export_orgdb.R)
+ENSP_KEYTYPE = "ENSEMBLPROT"
+
+
+def prepare_ranks(
+    tab: pd.DataFrame,
+    metric: str,
+    keytype: str,
+    gene_table: Optional[pd.DataFrame] = None,
+    mapping: Optional[GeneMapping] = None,
+) -> pd.DataFrame:
+    """
+    Rank vector of one metric shared by all tools, sorted in decreasing order
+
+    :param tab: Input table indexed by keytype
+    :param gene_table: Gene converter table (keytype, ENTREZID, SYMBOL), only used if tab lacks SYMBOL or ENTREZID
+    :param mapping: Gene mapping the Ensembl protein ID (ENSP) of each Entrez ID is taken from, if it has them
+    :returns: pd.DataFrame with columns keytype, SYMBOL (upper case), ENTREZID, ENSP and metric;
+              input genes missing from the gene converter are kept with NA identifiers
+    """
+    if metric not in tab.columns:
+        if metric == "neg_signed_logpval":
+            tab["neg_signed_logpval"] = -np.sign(tab["logFC"]) * np.log10(tab["PValue"])
+        else:
+            raise Exception(f"Metric not in input table: {metric}")
+
+    id_cols = [c for c in ["SYMBOL", "ENTREZID"] if c != keytype]
+    ranks = tab[[c for c in id_cols if c in tab.columns] + [metric]].copy()
+    ranks.index = tab.index.astype(str)
+    ranks.index.name = keytype
+    ranks = ranks.reset_index()
+
+    missing = [c for c in id_cols if c not in ranks.columns]
+    if missing:
+        if gene_table is None:
+            raise Exception(f"Gene converter table required to add {missing}")
+        gene_table = gene_table[[keytype] + missing].drop_duplicates().astype({keytype: str})
+        ranks = ranks.merge(gene_table, how="left", on=keytype)
+
+    ranks = ranks[[keytype] + id_cols + [metric]].dropna(subset=[metric])
+
+    # https://gseapy.readthedocs.io/en/latest/faq.html#q-why-gene-symbols-in-enrichr-library-are-all-upper-cases-for-mouse-fly-fish-worm
+    ranks["SYMBOL"] = ranks["SYMBOL"].str.upper()  # Enrichr supports only upper case
+    if "ENTREZID" in id_cols:
+        ranks["ENTREZID"] = pd.to_numeric(ranks["ENTREZID"], errors="coerce").astype("Int64")
+
+    ensp = None
+    if mapping is not None and ENSP_KEYTYPE in mapping.keytypes:
+        ensp = mapping.identifiers(ranks["ENTREZID"].astype(str), ENSP_KEYTYPE)
+    else:
+        print(f"No {ENSP_KEYTYPE} in the gene mapping, ENSP is left empty")
+    ranks.insert(len(ranks.columns) - 1, "ENSP", ensp)
+
+    return ranks.sort_values(metric, ascending=False, kind="mergesort").reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    input_file = sys.argv[1]
+    keytype = sys.argv[2]
+    gene_table_file = sys.argv[3]
+    metric = sys.argv[4]
+    outfile = sys.argv[5]
+    mapping_dir = sys.argv[6] if len(sys.argv) > 6 else None
+
+    tab = pd.read_csv(input_file, index_col=0)
+    gene_table = pd.read_csv(gene_table_file)
+    mapping = GeneMapping(mapping_dir) if mapping_dir else None
+    write_ranks(prepare_ranks(tab, metric, keytype, gene_table, mapping), outfile)
@@ -0,0 +1,502 @@
+# scripts/prerank.py
+
+import numpy as np
+import pandas as pd
+from scipy.special import polygamma
+from scipy.stats import beta
+from typing import Dict, List, Optional, Tuple, Union
+
+from gene_set_index import GeneSetIndex
+
+
+RES2D_COLUMNS = ["Name", "Term", "ES", "NES", "NOM p-val", "FDR q-val", "FWER p-val", "Tag %", "Gene %", "Lead_genes"]
+
+
+def membership_matrix(gene_sets: Dict[str, List[str]], genes: pd.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build a sparse (CSR) terms x genes membership matrix for a ranked gene list.
+    Column indices are positions in the ranking and are sorted within each row; duplicates are dropped.
+
+    :returns: indptr, indices
+    """
+    n_genes = len(genes)
+    sizes = np.fromiter((len(g) for g in gene_sets.values()), dtype=np.int64, count=len(gene_sets))
+    flat = [gene for g in gene_sets.values() for gene in g]
+    cols = genes.get_indexer(pd.Index(flat, dtype=object)) if flat else np.empty(0, dtype=np.int64)
+    rows = np.repeat(np.arange(len(gene_sets), dtype=np.int64), sizes)
+
+    found = cols >= 0
+    keys = np.sort(rows[found] * n_genes + cols[found])  # by row, then by column
+    keys = keys[np.diff(keys, prepend=-1) != 0]  # drop duplicated genes within a term
+    rows, cols = np.divmod(keys, n_genes)
+
+    indptr = np.zeros(len(gene_sets) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(gene_sets)), out=indptr[1:])
+    return indptr, cols
+
+
+def csr_rows(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Subset of rows of a CSR matrix"""
+    sizes = np.diff(indptr)[rows]
+    sub_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=sub_indptr[1:])
+    take = np.repeat(indptr[rows] - sub_indptr[:-1], sizes) + np.arange(sub_indptr[-1])
+    return sub_indptr, indices[take]
+
+
+def running_sum(
+    positions: np.ndarray, weights: np.ndarray, indptr: np.ndarray, n_genes: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Weighted running-sum statistic of every gene set, evaluated only where it can attain an extremum:
+    right after each hit (candidate maxima) and right before each hit (candidate minima).
+    Works on a single CSR matrix (1d arrays) or a stack of them sharing indptr (2d arrays, one per permutation).
+
+    :returns: after, before (same shape as positions)
+    """
+    starts, ends = indptr[:-1], indptr[1:]
+    sizes = np.diff(indptr)
+    rows = np.repeat(np.arange(len(sizes)), sizes)
+    rank_in_set = np.arange(positions.shape[-1]) - starts[rows]
+
+    cum = np.cumsum(weights, axis=-1)
+    cum -= (cum - weights)[..., starts][..., rows]  # restart the cumulative sum for each gene set
+    norm_hit = cum[..., ends - 1][..., rows]
+    norm_miss = (n_genes - sizes)[rows]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        misses = (positions - rank_in_set) / norm_miss
+        after = cum / norm_hit - misses
+        before = after - weights / norm_hit
+    return after, before
+
+
+def enrichment_scores(after: np.ndarray, before: np.ndarray, indptr: np.ndarray) -> np.ndarray:
+    """Maximum deviation from zero of the running sum of each gene set"""
+    starts = indptr[:-1]
+    es_max = np.maximum.reduceat(after, starts, axis=-1)
+    es_min = np.minimum.reduceat(before, starts, axis=-1)
+    return np.where(es_max > -es_min, es_max, es_min)
+
+
+def permutation_null(
+    weights: np.ndarray,
+    positions: np.ndarray,
+    indptr: np.ndarray,
+    permutation_num: int,
+    rng: np.random.Generator,
+    block_size: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Null distribution of enrichment scores from gene label permutations. Each permutation shuffles the ranked
+    gene list once and is shared by all gene sets; permutations are evaluated in blocks to bound memory.
+
+    :param weights: Weight of each position in the ranked list, i.e. abs(ranking metric) ** weight
+    :returns: Array of shape (n_sets, permutation_num)
+    """
+    n_genes = len(weights)
+    nnz = max(len(positions), 1)
+    if block_size is None:
+        block_size = max(1, min(permutation_num, 10_000_000 // max(nnz, n_genes)))
+
+    sizes = np.diff(indptr)
+    offsets = np.repeat(np.arange(len(sizes), dtype=np.int64), sizes) * n_genes
+
+    esnull = np.empty((len(sizes), permutation_num))
+    for first in range(0, permutation_num, block_size):
+        n_block = min(block_size, permutation_num - first)
+        perms = rng.permuted(np.broadcast_to(np.arange(n_genes), (n_block, n_genes)), axis=1)
+        keys = perms[:, positions] + offsets
+        keys.sort(axis=1)  # offsets keep hits inside their own gene set
+        perm_positions = keys - offsets
+        after, before = running_sum(perm_positions, weights[perm_positions], indptr, n_genes)
+        esnull[:, first : first + n_block] = enrichment_scores(after, before, indptr).T
+    return esnull
+
+
+def pvalue_interval(k: np.ndarray, n: np.ndarray, confidence: float = 0.99) -> Tuple[np.ndarray, np.ndarray]:
+    """Two-sided Clopper-Pearson interval of binomial proportions k / n, [0, 1] where n is 0"""
+    tail = (1 - confidence) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower = np.where(k > 0, beta.ppf(tail, k, n - k + 1), 0.0)
+        upper = np.where(k < n, beta.ppf(1 - tail, k + 1, n - k), 1.0)
+    return np.nan_to_num(lower, nan=0.0), np.nan_to_num(upper, nan=1.0)
+
+
+def adaptive_permutation_null(
+    es: np.ndarray,
+    weights: np.ndarray,
+    positions: np.ndarray,
+    indptr: np.ndarray,
+    rng: np.random.Generator,
+    permutation_num: int = 1000,
+    min_permutations: int = 100,
+    max_permutations: int = 100_000,
+    exceedances: int = 10,
+    alpha: float = 0.05,
+    confidence: float = 0.99,
+    block_size: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sequential Monte Carlo permutation test (Besag & Clifford 1991). A gene set stops being permuted once the
+    Clopper-Pearson interval of its p-value (at the given confidence) lies entirely below the significance threshold
+    alpha, or lies entirely above it and `exceedances` null scores were at least as extreme as its observed score. Sets
+    far from alpha thus stop after a few rounds, and only borderline sets keep going up to max_permutations. Sets with
+    very small p-values stop as soon as they are known to be significant; use the multilevel method to resolve those.
+    Permutations run in rounds that double in size and are shared by all gene sets still active. The p-value is
+    estimated as (exceedances + 1) / (permutations + 1), which is never zero.
+
+    :param alpha: Significance threshold of the nominal p-values that each set is resolved against
+    :param confidence: Confidence level of the p-value intervals
+    :returns: esnull (n_sets x permutation_num, NaN beyond the permutations a set used), pval, n_perm
+    """
+    n_sets = len(es)
+    is_pos = es >= 0
+    esnull = np.full((n_sets, permutation_num), np.nan)
+    n_same = np.zeros(n_sets, dtype=np.int64)  # null scores with the sign of the observed score
+    n_ext = np.zeros(n_sets, dtype=np.int64)  # null scores at least as extreme as the observed score
+    n_perm = np.zeros(n_sets, dtype=np.int64)
+
+    active = np.arange(n_sets)
+    n_done = 0
+    while len(active) > 0:
+        n_round = min(max(min_permutations, n_done), max_permutations - n_done)
+        sub_indptr, sub_positions = csr_rows(indptr, positions, active)
+        null = permutation_null(weights, sub_positions, sub_indptr, n_round, rng, block_size)
+
+        stored = max(0, min(n_round, permutation_num - n_done))
+        esnull[active, n_done : n_done + stored] = null[:, :stored]
+
+        obs = es[active, None]
+        pos = is_pos[active, None]
+        n_same[active] += np.where(pos, null >= 0, null < 0).sum(axis=1)
+        n_ext[active] += np.where(pos, null >= obs, null < obs).sum(axis=1)
+        n_done += n_round
+        n_perm[active] = n_done
+
+        lower, upper = pvalue_interval(n_ext[active], n_same[active], confidence)
+        significant = upper < alpha
+        not_significant = (lower > alpha) & (n_ext[active] >= exceedances)
+        settled = (n_done >= min_permutations) & (significant | not_significant)
+        active = active[~settled] if n_done < max_permutations else active[:0]
+
+    pval = (n_ext + 1) / (n_same + 1)
+    return esnull, pval, n_perm
+
+
+def random_set_scores(positions: np.ndarray, weights: np.ndarray, sign: int) -> np.ndarray:
+    """Signed enrichment scores of a sample of random gene sets of equal size (rows of sorted positions)"""
+    size = positions.shape[1]
+    hits = weights[positions]
+    cum = np.cumsum(hits, axis=1)
+    norm_hit = cum[:, -1:]
+    misses = (positions - np.arange(size)) / (len(weights) - size)
+    after = cum / norm_hit - misses
+    es_max = after.max(axis=1)
+    es_min = (after - hits / norm_hit).min(axis=1)
+    return sign * np.where(es_max > -es_min, es_max, es_min)
+
+
+def multilevel_pvalues(
+    targets: np.ndarray,
+    size: int,
+    weights: np.ndarray,
+    sign: int,
+    rng: np.random.Generator,
+    sample_size: int = 101,
+    eps: float = 1e-50,
+    moves: float = 0.5,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Adaptive multilevel splitting estimate of P(sign * ES >= target) for random gene sets of a given size
+    (Korotkevich et al. 2021, fgsea). The sample of random sets is repeatedly cut at its median score and
+    regenerated above the cut with an MCMC of single gene swaps, so each level halves the probability at the cost
+    of sample_size * moves * size score evaluations. All targets of one size share a single run.
+
+    :param targets: Positive observed scores (sign * ES)
+    :param eps: Lower bound of the estimated probabilities
+    :param moves: MCMC swaps attempted per level, relative to the gene set size
+    :returns: pval, log2err
+    """
+    n_genes = len(weights)
+    order = np.argsort(targets)
+    targets = targets[order]
+    pval = np.full(len(targets), eps)
+    levels = np.zeros(len(targets))
+
+    sample = np.sort(rng.permuted(np.broadcast_to(np.arange(n_genes), (sample_size, n_genes)), axis=1)[:, :size])
+    scores = random_set_scores(sample, weights, sign)
+    log_p = 0.0
+    n_levels = 0
+    first = 0  # targets before first are resolved
+    rows = np.arange(sample_size)
+
+    while first < len(targets):
+        threshold = np.median(scores)
+        above = scores >= threshold
+        if above.all():  # ties at the median, cut strictly above it
+            above = scores > threshold
+        # Targets below the cut are estimated from the current sample, all of them once eps is reached
+        done = not above.any() or log_p + np.log(above.mean()) < np.log(eps)
+        last = len(targets) if done else np.searchsorted(targets, threshold, side="right")
+        if last > first:
+            frac = (scores[None, :] >= targets[first:last, None]).mean(axis=1)
+            pval[first:last] = np.maximum(np.exp(log_p) * frac, eps)
+            levels[first:last] = n_levels
+            first = last
+        if done or first == len(targets):
+            break
+
+        log_p += np.log(above.mean())
+        n_levels += 1
+
+        # Resample from the survivors and let them diffuse above the threshold
+        keep = rng.choice(np.flatnonzero(above), size=sample_size)
+        sample, scores = sample[keep], scores[keep]
+        for _ in range(max(1, int(moves * size))):
+            proposal = sample.copy()
+            new_genes = rng.integers(n_genes, size=sample_size)
+            proposal[rows, rng.integers(size, size=sample_size)] = new_genes
+            proposal.sort(axis=1)
+            valid = ~(sample == new_genes[:, None]).any(axis=1)
+            proposal_scores = random_set_scores(proposal, weights, sign)
+            accept = valid & (proposal_scores >= threshold)
+            sample[accept], scores[accept] = proposal[accept], proposal_scores[accept]
+
+    # Expected error of log2(pval), see fgsea
+    trigamma = polygamma(1, (sample_size + 1) / 2) - polygamma(1, sample_size + 1)
+    log2err = np.sqrt((levels + 1) * trigamma) / np.log(2)
+
+    out_pval, out_err = np.empty_like(pval), np.empty_like(log2err)
+    out_pval[order], out_err[order] = pval, log2err
+    return out_pval, out_err
+
+
+def multilevel_null_pvalues(
+    es: np.ndarray,
+    esnull: np.ndarray,
+    weights: np.ndarray,
+    indptr: np.ndarray,
+    rng: np.random.Generator,
+    exceedances: int = 10,
+    sample_size: int = 101,
+    eps: float = 1e-50,
+    moves: float = 0.5,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Refine the permutation p-values of gene sets with fewer than `exceedances` permutations at least as extreme
+    as the observed score with multilevel_pvalues, conditioned on the sign of ES as in GSEA.
+
+    :returns: pval, log2err (NaN for p-values taken from the permutations)
+    """
+    is_pos = es >= 0
+    n_same = np.where(is_pos, (esnull >= 0).sum(axis=1), (esnull < 0).sum(axis=1))
+    n_ext = np.where(is_pos, (esnull >= es[:, None]).sum(axis=1), (esnull < es[:, None]).sum(axis=1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pval = n_ext / n_same
+    log2err = np.full(len(es), np.nan)
+
+    sizes = np.diff(indptr)
+    refine = (n_ext < exceedances) & (n_same > 0) & np.isfinite(es)
+    groups = pd.DataFrame({"size": sizes, "pos": is_pos})[refine].groupby(["size", "pos"]).groups
+    for (size, pos), rows in groups.items():
+        rows = rows.to_numpy()
+        sign = 1 if pos else -1
+        p, err = multilevel_pvalues(sign * es[rows], size, weights, sign, rng, sample_size, eps, moves)
+        pval[rows] = np.clip(p / (n_same[rows] / esnull.shape[1]), eps, 1)
+        log2err[rows] = err
+    return pval, log2err
+
+
+def gsea_significance(es: np.ndarray, esnull: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Nominal p-values, normalized enrichment scores, FDR and FWER as in GSEA (Subramanian et al. 2005),
+    using the positive or negative part of the null matching the sign of each observed score.
+    NaN entries of esnull are ignored, so gene sets may have different numbers of permutations.
+
+    :returns: nes, pval, fdr, fwer
+    """
+    is_pos = es >= 0
+    null_pos = esnull >= 0
+    null_neg = esnull < 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_pos = np.where(null_pos, esnull, 0).sum(axis=1) / null_pos.sum(axis=1)
+        mean_neg = -np.where(null_neg, esnull, 0).sum(axis=1) / null_neg.sum(axis=1)
+
+        pval = np.where(
+            is_pos,
+            (esnull >= es[:, None]).sum(axis=1) / null_pos.sum(axis=1),
+            (esnull < es[:, None]).sum(axis=1) / null_neg.sum(axis=1),
+        )
+        nes = np.where(is_pos, es / mean_pos, es / mean_neg)
+        nesnull = np.where(null_pos, esnull / mean_pos[:, None], esnull / mean_neg[:, None])
+
+    # FDR: fraction of all (set, permutation) pairs at least as extreme, relative to the observed fraction
+    null_sorted = np.sort(nesnull[np.isfinite(nesnull)])
+    obs_sorted = np.sort(nes[np.isfinite(nes)])
+    null_zero = np.searchsorted(null_sorted, 0, side="left")
+    obs_zero = np.searchsorted(obs_sorted, 0, side="left")
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        null_frac = np.where(
+            is_pos,
+            (len(null_sorted) - np.searchsorted(null_sorted, nes, side="left")) / (len(null_sorted) - null_zero),
+            np.searchsorted(null_sorted, nes, side="right") / null_zero,
+        )
+        obs_frac = np.where(
+            is_pos,
+            (len(obs_sorted) - np.searchsorted(obs_sorted, nes, side="left")) / (len(obs_sorted) - obs_zero),
+            np.searchsorted(obs_sorted, nes, side="right") / obs_zero,
+        )
+        fdr = np.minimum(null_frac / obs_frac, 1)
+
+        # FWER: fraction of permutations whose most extreme NES over all gene sets exceeds the observed one
+        max_null = np.nanmax(np.where(null_pos, nesnull, 0), axis=0, initial=0)
+        min_null = np.nanmin(np.where(null_neg, nesnull, 0), axis=0, initial=0)
+        fwer = np.where(
+            is_pos, (max_null[None, :] >= nes[:, None]).mean(axis=1), (min_null[None, :] <= nes[:, None]).mean(axis=1)
+        )
+
+    return nes, pval, fdr, fwer
+
+
+def leading_edge(
+    after: np.ndarray, before: np.ndarray, es: np.ndarray, positions: np.ndarray, indptr: np.ndarray, n_genes: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Locate the peak of the running sum of each gene set.
+
+    :returns: first, last (slice into positions with the leading-edge hits), gene_frac
+    """
+    starts, ends = indptr[:-1], indptr[1:]
+    rows = np.repeat(np.arange(len(starts)), np.diff(indptr))
+    is_pos = es >= 0
+
+    # Index of the first hit attaining the extremum of its gene set
+    at_peak = np.where(is_pos[rows], after == es[rows], before == es[rows])
+    peak = np.full(len(starts), -1, dtype=np.int64)
+    hits = np.flatnonzero(at_peak)
+    first_rows, first_idx = np.unique(rows[hits], return_index=True)
+    peak[first_rows] = hits[first_idx]
+
+    first = np.where(is_pos, starts, peak)
+    last = np.where(is_pos, peak + 1, ends)
+    gene_frac = np.where(is_pos, positions[peak] + 1, n_genes - positions[peak] + 1) / n_genes
+    return first, last, gene_frac
+
+
+def prerank(
+    rnk: pd.Series,
+    gene_sets: Union[Dict[str, List[str]], GeneSetIndex],
+    min_size: int = 10,
+    max_size: int = 500,
+    permutation_num: int = 1000,
+    weight: float = 1.0,
+    seed: int = 123,
+    block_size: Optional[int] = None,
+    pval_method: str = "permutation",
+    min_permutations: int = 100,
+    max_permutations: int = 100_000,
+    exceedances: int = 10,
+    alpha: float = 0.05,
+    sample_size: int = 101,
+    eps: float = 1e-50,
+) -> pd.DataFrame:
+    """
+    Preranked GSEA for all gene sets at once over a shared sparse membership matrix.
+    Drop-in for gseapy.prerank(...).res2d with gene set permutations.
+
+    :param rnk: Ranking metric indexed by gene
+    :param gene_sets: Dict mapping term to list of genes, or a compiled GeneSetIndex
+    :param block_size: Number of permutations evaluated at once, chosen from the library size if None
+    :param alpha: Significance threshold that "adaptive" resolves borderline p-values against
+    :param pval_method: "permutation" (permutation_num permutations for every gene set) or "adaptive"
+                        (per gene set early stopping, see adaptive_permutation_null; NES and FDR use the first
+                        permutation_num permutations) or "multilevel" (permutation p-values, refined down to eps
+                        by adaptive multilevel splitting for gene sets with fewer than `exceedances` permutations at
+                        least as extreme, see multilevel_pvalues)
+    :returns: pd.DataFrame with the columns of gseapy's res2d plus the number of permutations used per term
+              (and the expected error of log2 p-values for "multilevel"), sorted by absolute NES
+    """
+    if isinstance(rnk, pd.DataFrame):
+        rnk = rnk.iloc[:, 0]
+    rnk = rnk.dropna().sort_values(ascending=False, kind="mergesort")
+    rnk = rnk[~rnk.index.duplicated(keep="first")]
+    genes = pd.Index(rnk.index.astype(str))
+    n_genes = len(genes)
+
+    if isinstance(gene_sets, GeneSetIndex):
+        terms = gene_sets.ids.to_numpy()
+        indptr, positions = gene_sets.membership(genes)
+    else:
+        terms = np.array(list(gene_sets.keys()), dtype=object)
+        indptr, positions = membership_matrix(gene_sets, genes)
+
+    sizes = np.diff(indptr)
+    keep = (sizes >= min_size) & (sizes <= max_size)
+    if not keep.any():
+        raise Exception(f"No gene sets passed through filtering condition: min_size={min_size}, max_size={max_size}")
+
+    terms = terms[keep]
+    indptr, positions = csr_rows(indptr, positions, np.flatnonzero(keep))
+
+    weights = np.abs(rnk.to_numpy(dtype=float)) ** weight
+    after, before = running_sum(positions, weights[positions], indptr, n_genes)
+    es = enrichment_scores(after, before, indptr)
+
+    rng = np.random.default_rng(seed)
+    match pval_method:
+        case "permutation":
+            esnull = permutation_null(weights, positions, indptr, permutation_num, rng, block_size)
+            nes, pval, fdr, fwer = gsea_significance(es, esnull)
+            n_perm = np.full(len(es), permutation_num)
+        case "adaptive":
+            esnull, pval, n_perm = adaptive_permutation_null(
+                es,
+                weights,
+                positions,
+                indptr,
+                rng,
+                permutation_num=permutation_num,
+                min_permutations=min_permutations,
+                max_permutations=max_permutations,
+                exceedances=exceedances,
+                alpha=alpha,
+                block_size=block_size,
+            )
+            nes, _, fdr, fwer = gsea_significance(es, esnull)
+        case "multilevel":
+            esnull = permutation_null(weights, positions, indptr, permutation_num, rng, block_size)
+            nes, _, fdr, fwer = gsea_significance(es, esnull)
+            pval, log2err = multilevel_null_pvalues(
+                es, esnull, weights, indptr, rng, exceedances=exceedances, sample_size=sample_size, eps=eps
+            )
+            n_perm = np.full(len(es), permutation_num)
+        case _:
+            raise Exception(f"Invalid p-value method: {pval_method}")
+
+    first, last, gene_frac = leading_edge(after, before, es, positions, indptr, n_genes)
+    lead_genes = [
+        ";".join(genes[positions[f:la]][:: 1 if e >= 0 else -1]) for f, la, e in zip(first, last, es, strict=True)
+    ]
+
+    res2d = pd.DataFrame(
+        {
+            "Name": "prerank",
+            "Term": terms,
+            "ES": es,
+            "NES": nes,
+            "NOM p-val": pval,
+            "FDR q-val": fdr,
+            "FWER p-val": fwer,
+            "Tag %": [f"{la - f}/{k}" for f, la, k in zip(first, last, np.diff(indptr), strict=True)],
+            "Gene %": [f"{g:.2%}" for g in gene_frac],
+            "Lead_genes": lead_genes,
+            "Permutations": n_perm,
+        },
+        columns=RES2D_COLUMNS + ["Permutations"],
+    )
+    if pval_method == "multilevel":
+        res2d["log2err"] = log2err
+    return res2d.reindex(res2d["NES"].abs().sort_values(ascending=False).index).reset_index(drop=True)
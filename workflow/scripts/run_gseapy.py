@@ -2,12 +2,19 @@
 
 import os
 import sys
+import zlib
+import argparse
 import numpy as np
 import pandas as pd
 import gseapy
-from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
 
-from utils import read_gmt
+from gene_set_index import GeneSetIndex, load_gene_set_index
+from library_store import KEGG_LIBRARIES, STORE_DIR, enrichr_library_names, get_library, get_library_file
+from prerank import prerank
+from utils import load_config, parse_gene_sets, read_ranks, write_result_table
 
 
 def convert_gseapy_table(tab: pd.DataFrame, ont_id: str) -> None:
@@ -21,7 +28,7 @@ def convert_gseapy_table(tab: pd.DataFrame, ont_id: str) -> None:
     if ont_id == "KEGG":
         tab.rename({"Term": "Description"}, axis=1, inplace=True)
         tab["ID"] = tab["Description"]  # gseapy doesn't save KEGG id, hence use description
-    elif ont_id == "GO" and not tab["Term"].iloc[0].str.startswith("GO:"):
+    elif ont_id == "GO" and not tab["Term"].iloc[0].startswith("GO:"):
         tab["ID"] = "GO:" + tab["Term"].str.split("\\(GO:").str[1].str[:-1]
     else:
         try:
@@ -43,8 +50,15 @@ def run_gseapy_multi(
     outdir: str = "",
     outfile: str = "",
     overwrite: bool = False,
+    processes: int = 1,
+    seed: int = 123,
     **kwargs,
 ) -> None:
+    """
+    Run GSEA for one metric and ontology and write the merged results table
+    :param processes: Worker processes for the GO sub-libraries, which are run in parallel if > 1
+    :param seed: Base seed; each GO sub-library gets its own seed (see library_seed)
+    """
     if metric not in tab.columns:
         if metric == "neg_signed_logpval":
             tab["neg_signed_logpval"] = -np.sign(tab["logFC"]) * np.log10(tab["PValue"])
@@ -58,13 +72,10 @@ def run_gseapy_multi(
 
     if ontology == "GO":
         ont_id = "GO"
-        ontology = ["GO_Biological_Process_2023", "GO_Cellular_Component_2023", "GO_Molecular_Function_2023"]
-    elif ontology == "KEGG" and organism_kegg == "hsa":
+        ontology = enrichr_library_names("GO")
+    elif ontology == "KEGG" and organism_kegg in KEGG_LIBRARIES:
         ont_id = "KEGG"
-        ontology = "KEGG_2021_Human"
-    elif ontology == "KEGG" and organism_kegg == "mmu":
-        ont_id = "KEGG"
-        ontology = "KEGG_2019_Mouse"
+        ontology = enrichr_library_names("KEGG", organism_kegg)[0]
     elif isinstance(ontology, str) and ontology.endswith(".gmt"):
         ont_id = ontology.split("/")[-1].split(".gmt")[0]
         if not os.path.isfile(ontology):
@@ -76,20 +87,26 @@ def run_gseapy_multi(
 
     if not isinstance(ontology, list) and ontology.endswith(".gmt"):
         print(f"Running GSEApy with provided gmt file: {ontology}")
-        res = run_gseapy(input, ontology, outdir, **kwargs)
-        res_merged = res.res2d
-        gmt_df = read_gmt(ontology)
+        res_merged = run_gseapy(input, ontology, outdir, seed=seed, **kwargs)
+        gmt_df = load_gene_set_index(ontology).to_frame(genes=False)
         gmt_df.set_index("ID", inplace=True)
         res_merged = res_merged.merge(gmt_df[["Description", "Category"]], left_on="Term", right_index=True, how="left")
         res_merged.drop("Ontology", axis=1, inplace=True)
         res_merged.rename({"Category": "ONTOLOGY"}, axis=1, inplace=True)
 
     elif ont_id == "GO":
-        res_list = []
-        for ont in ontology:
-            print(f"Running GSEApy with Enrichr library: {ont}")
-            res = run_gseapy(input, ont, outdir, **kwargs)
-            res_list.append(res.res2d)
+        lib_kwargs = [{**kwargs, "seed": library_seed(seed, ont)} for ont in ontology]
+        if processes > 1:
+            print(f"Running GSEApy with Enrichr libraries: {ontology} ({processes} processes)")
+            with ProcessPoolExecutor(
+                max_workers=min(processes, len(ontology)), initializer=_init_worker, initargs=(input,)
+            ) as pool:
+                res_list = list(pool.map(_run_gseapy_worker, ontology, [outdir] * len(ontology), lib_kwargs))
+        else:
+            res_list = []
+            for ont, ont_kwargs in zip(ontology, lib_kwargs, strict=True):
+                print(f"Running GSEApy with Enrichr library: {ont}")
+                res_list.append(run_gseapy(input, ont, outdir, **ont_kwargs))
 
         if len(res_list) > 0:
             res_merged = pd.concat(res_list)
@@ -98,12 +115,48 @@ def run_gseapy_multi(
     else:
         assert isinstance(ontology, str)
         print(f"Running GSEApy with Enrichr library: {ontology}")
-        res = run_gseapy(input, ontology, outdir, **kwargs)
-        res_merged = res.res2d
+        res_merged = run_gseapy(input, ontology, outdir, seed=seed, **kwargs)
 
     assert isinstance(res_merged, pd.DataFrame)
     convert_gseapy_table(res_merged, ont_id)
-    res_merged.to_csv(outfile)
+    write_result_table(res_merged, outfile)
+
+
+def library_seed(seed: int, library: str) -> int:
+    """Seed for one library derived from the base seed, independent of library order and worker count"""
+    return (seed + zlib.crc32(library.encode())) % 2**32
+
+
+_worker_input: Optional[pd.Series] = None
+
+
+def _init_worker(input_: pd.Series) -> None:
+    """Hand the rank vector to a pool worker once instead of with every task"""
+    global _worker_input
+    _worker_input = input_
+
+
+def _run_gseapy_worker(ontology: str, outdir: str, kwargs: Dict) -> pd.DataFrame:
+    print(f"Running GSEApy with Enrichr library: {ontology}")
+    return run_gseapy(_worker_input, ontology, outdir, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def read_gene_sets(gmt_file: str) -> Dict[str, List[str]]:
+    """
+    Gene sets of a gmt file parsed as by gseapy.prerank, once per process and shared by all metrics of a batch
+    (gseapy copies the dict and does not modify the gene lists)
+    """
+    with open(gmt_file) as f:
+        return {fields[0]: genes for fields, genes in parse_gene_sets(f)}
+
+
+@lru_cache(maxsize=None)
+def load_gene_sets(ontology: str, store_dir: str = STORE_DIR) -> GeneSetIndex:
+    """Compiled gene sets of a gmt file or of an Enrichr library from the local library store"""
+    if ontology.endswith(".gmt"):
+        return load_gene_set_index(ontology)
+    return get_library(ontology, store_dir)
 
 
 def run_gseapy(
@@ -113,44 +166,191 @@ def run_gseapy(
     min_size: int = 10,
     max_size: int = 500,
     permutation_num: int = 1000,
+    engine: str = "gseapy",
+    store_dir: str = STORE_DIR,
     **kwargs,
-) -> gseapy.Prerank:
-    res = gseapy.prerank(
-        rnk=input_,
-        gene_sets=ontology,
-        outdir=None,
-        min_size=min_size,
-        max_size=max_size,
-        permutation_num=permutation_num,
-        **kwargs,
+) -> pd.DataFrame:
+    """
+    Run preranked GSEA and return the results table (res2d)
+    :param engine: "gseapy" or "native" (batched in-repo engine, see prerank.py)
+    :param store_dir: Local store of Enrichr libraries, resolved before any download (see library_store.py)
+    """
+    match engine:
+        case "gseapy":
+            gmt_file = ontology if ontology.endswith(".gmt") else get_library_file(ontology, store_dir)
+            res = gseapy.prerank(
+                rnk=input_,
+                gene_sets=read_gene_sets(gmt_file),
+                outdir=None,
+                min_size=min_size,
+                max_size=max_size,
+                permutation_num=permutation_num,
+                **kwargs,
+            )
+            res2d = res.res2d
+            res2d["Permutations"] = permutation_num
+        case "native":
+            res2d = prerank(
+                input_,
+                load_gene_sets(ontology, store_dir),
+                min_size=min_size,
+                max_size=max_size,
+                permutation_num=permutation_num,
+                **kwargs,
+            )
+        case _:
+            raise Exception(f"Invalid GSEA engine: {engine}")
+
+    assert res2d is not None
+    res2d["Ontology"] = ontology
+    return res2d
+
+
+# Arguments of prerank.prerank that gseapy.prerank does not take
+NATIVE_KWARGS = [
+    "pval_method",
+    "min_permutations",
+    "max_permutations",
+    "exceedances",
+    "alpha",
+    "sample_size",
+    "eps",
+    "block_size",
+]
+
+
+def configuration_kwargs(kwargs: Dict, overrides: Optional[Dict[str, Dict]], metric: str, library: str) -> Dict:
+    """
+    Settings of one configuration: gseapy_kwargs updated with the matching gseapy_overrides, from least to most
+    specific, i.e. keyed by library name, by metric, then by "metric.library"
+    (e.g. {"KEGG": {"pval_method": "multilevel"}, "logFC.GO": {"permutation_num": 2000}} with engine "native")
+    """
+    overrides = overrides or {}
+    kwargs = dict(kwargs)
+    for key in [library, metric, f"{metric}.{library}"]:
+        kwargs.update(overrides.get(key) or {})
+
+    native_only = [k for k in NATIVE_KWARGS if k in kwargs]
+    if kwargs.get("engine", "gseapy") != "native" and native_only:
+        raise Exception(f"{', '.join(native_only)} of configuration {metric}.{library} require engine: native")
+    return kwargs
+
+
+def read_rank_table(ranks_file: str) -> pd.DataFrame:
+    """Rank vector from prepare_ranks.py indexed by symbol (already upper case)"""
+    tab = read_ranks(ranks_file).drop(columns="ENSP").dropna()
+    tab.set_index("SYMBOL", inplace=True)
+    return tab
+
+
+_batch_state: Tuple[Dict[str, pd.DataFrame], str] = ({}, "")
+
+
+def _init_batch_worker(tabs: Dict[str, pd.DataFrame], organism_kegg: str) -> None:
+    """Hand the rank vectors to a batch worker once instead of with every configuration"""
+    global _batch_state
+    _batch_state = (tabs, organism_kegg)
+
+
+def _run_batch_job(job: Tuple[str, str, str, Dict]) -> str:
+    metric, ontology, outfile, kwargs = job
+    tabs, organism_kegg = _batch_state
+    run_gseapy_multi(
+        tabs[metric], metric=metric, ontology=ontology, organism_kegg=organism_kegg, outfile=outfile, **kwargs
     )
-    assert res.res2d is not None
-    res.res2d["Ontology"] = ontology
-    return res
+    return outfile
 
 
-def main() -> None:
-    tab = pd.read_csv(input_file, index_col=0)
+def run_batch(
+    ranks_files: List[str],
+    metrics: List[str],
+    libraries: Dict[str, str],
+    outfile_template: str,
+    organism_kegg: str = "",
+    workers: int = 1,
+    overrides: Optional[Dict[str, Dict]] = None,
+    **kwargs,
+) -> None:
+    """
+    Run all (metric, library) configurations of a project in one call. Rank vectors are read once, gene sets are parsed
+    once per process (see read_gene_sets), and configurations run on workers processes. Every configuration uses the
+    same seeds as when run on its own (the base seed, offset per GO sub-library by library_seed), so the results do not
+    depend on workers or on the order of the configurations.
+
+    :param ranks_files: Rank vector of each metric
+    :param libraries: Ontology ("GO", "KEGG", Enrichr library or gmt file) by library name, as in lib_names
+    :param outfile_template: Output path with placeholders _METRIC_ and _LIBRARY_ (library name)
+    :param workers: Worker processes granted to the batch (Snakemake threads), used instead of "processes" in kwargs
+    :param overrides: gseapy_overrides of the config, see configuration_kwargs
+    :param kwargs: gseapy_kwargs of the config, passed to run_gseapy_multi
+    """
+    tabs = {metric: read_rank_table(file) for metric, file in zip(metrics, ranks_files, strict=True)}
+    jobs = [
+        (
+            metric,
+            ontology,
+            outfile_template.replace("_METRIC_", metric).replace("_LIBRARY_", name),
+            configuration_kwargs(kwargs, overrides, metric, name),
+        )
+        for metric in metrics
+        for name, ontology in libraries.items()
+    ]
+
+    if workers > 1 and len(jobs) > 1:
+        print(f"Running {len(jobs)} GSEApy configurations on {min(workers, len(jobs))} processes")
+        # Configurations run in parallel instead of the GO sub-libraries
+        jobs = [(*job[:3], {**job[3], "processes": 1}) for job in jobs]
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(jobs)), initializer=_init_batch_worker, initargs=(tabs, organism_kegg)
+        ) as pool:
+            for outfile in pool.map(_run_batch_job, jobs):
+                print(f"Saved {outfile}")
+    else:
+        # A single configuration runs its GO sub-libraries on the workers instead
+        jobs = [(*job[:3], {**job[3], "processes": workers}) for job in jobs]
+        _init_batch_worker(tabs, organism_kegg)
+        for job in jobs:
+            print(f"Saved {_run_batch_job(job)}")
 
-    if tab.index.name != "SYMBOL":
-        gene_table = pd.read_csv(gene_table_file, index_col=0)
-        tab[keytype] = tab.index
-        tab = tab.merge(gene_table, how="left", on=keytype)
-        tab.dropna(axis=0, inplace=True)
-        tab.set_index("SYMBOL", inplace=True)
 
-    # https://gseapy.readthedocs.io/en/latest/faq.html#q-why-gene-symbols-in-enrichr-library-are-all-upper-cases-for-mouse-fly-fish-worm
-    tab.index = tab.index.str.upper()  # Enrichr supports only upper case
-    run_gseapy_multi(tab, metric=metric, ontology=ontology, organism_kegg=organism_kegg, outfile=outfile)
+def main() -> None:
+    tab = read_rank_table(ranks_file)
+    library = os.path.splitext(os.path.basename(ontology))[0]  # library name as in lib_names
+    kwargs = configuration_kwargs(gseapy_kwargs, gseapy_overrides, metric, library)
+    run_gseapy_multi(tab, metric=metric, ontology=ontology, organism_kegg=organism_kegg, outfile=outfile, **kwargs)
 
 
 if __name__ == "__main__":
-    input_file = sys.argv[1]
-    keytype = sys.argv[2]
-    organism_kegg = sys.argv[3]
-    gene_table_file = sys.argv[4]
-    metric = sys.argv[5]
-    ontology = sys.argv[6]  # either "GO", "KEGG", Enrichr library, or path to gmt file
-    outfile = sys.argv[7]
-
-    main()
+    config = load_config(os.path.join("config", "config.yaml"))
+    gseapy_kwargs = config.get("gseapy_kwargs") or {}  # e.g. {"engine": "native", "permutation_num": 1000}
+    gseapy_overrides = config.get("gseapy_overrides") or {}  # per metric and/or library, see configuration_kwargs
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        parser = argparse.ArgumentParser(description="Run all GSEApy configurations of a project")
+        parser.add_argument("--batch", metavar="ORGANISM_KEGG", required=True)
+        parser.add_argument("--ranks", nargs="+", required=True, help="Rank vector of each metric")
+        parser.add_argument("--metrics", nargs="+", required=True)
+        parser.add_argument("--libraries", nargs="+", required=True, help="name=ontology, as in lib_names")
+        parser.add_argument("--outfile-template", required=True, help="Output path with _METRIC_ and _LIBRARY_")
+        parser.add_argument("--workers", type=int, default=1)
+        args = parser.parse_args()
+
+        libraries = dict(lib.split("=", 1) for lib in args.libraries)
+        run_batch(
+            args.ranks,
+            args.metrics,
+            libraries,
+            args.outfile_template,
+            args.batch,
+            args.workers,
+            overrides=gseapy_overrides,
+            **gseapy_kwargs,
+        )
+    else:
+        ranks_file = sys.argv[1]
+        organism_kegg = sys.argv[2]
+        metric = sys.argv[3]
+        ontology = sys.argv[4]  # either "GO", "KEGG", Enrichr library, or path to gmt file
+        outfile = sys.argv[5]
+
+        main()
@@ -2,18 +2,26 @@
 
 import os
 import sys
+import argparse
+import asyncio
+import random
+import hashlib
+import tempfile
 import requests
 import json
 import time
-from pathlib import Path
 
 import pandas as pd
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional
+
+from utils import file_digest, read_ranks, write_result_table
 
 
 def check_api_key(key: Optional[str]) -> str:
 
     if key in ["", "_"] or key is None:
+        if not sys.stdin.isatty():  # e.g. a Snakemake job, which would wait for input forever
+            raise Exception("No STRING API key supplied: set string_api_key in the config. Abborting...")
         print("No STRING API key supplied. Enter key or request one by entering y")
         answer = input()
         if answer.lower() == "y":
@@ -94,78 +102,244 @@ def format_string_table(df: pd.DataFrame, library: str) -> pd.DataFrame:
     df["pvalue"] = df["qvalue"]  # dubious but STRING doesn't save pvalues...
 
     # STRING sort values from negative to positive, hence "top" will be downregulated, hence reverse this here
-    df["enrichmentScore"] = df["enrichmentScore"] * df["direction"].apply(
-        lambda x: -1 if x == "top" else 1 if x == "bottom" else 0
-    )
+    sign = df["direction"].map({"top": -1, "bottom": 1}).fillna(0).astype(float)
+    df["enrichmentScore"] = df["enrichmentScore"] * sign
 
     return df
 
 
-def prepare_string_input(path: str, metric: str) -> None:
-    tab = pd.read_csv(path, index_col=0)
-    tab = tab[metric]
-    formatted_path = Path(path.replace(".csv", ".string.tsv"))
+def prepare_string_input(path: str, metric: str) -> str:
+    """Write the STRING input (identifier and value, tab-separated) next to the rank vector and return its path"""
+    tab = read_ranks(path)  # rank vector from prepare_ranks.py, first column holds the input identifiers
+    tab = tab.drop_duplicates(subset=tab.columns[0]).set_index(tab.columns[0])[metric]
+    formatted_path = os.path.splitext(path)[0] + ".string.tsv"
     tab.to_csv(formatted_path, sep="\t", header=False)
+    return formatted_path
 
 
-def run_string_enrichment(input_path: str, api_key: str, species: int, fdr: float = 0.05) -> str | None:
-    string_api_url = "https://version-12-0.string-db.org/api"
-    output_format = "json"
-    method = "valuesranks_enrichment_submit"
-
-    # Construct the request
-
-    request_url = "/".join([string_api_url, output_format, method])
-
-    # Read the input data as string
+STRING_API_URL = "https://version-12-0.string-db.org/api"
+CALLER_IDENTITY = "www.awesome_app.org"
+STRING_CACHE_DIR = os.path.join("results", ".cache", "string")  # content-addressed, shared by all projects
 
-    identifiers = open(input_path).read()
 
-    # Set parameters
-
-    params = {
-        "species": species,  # NCBI/STRING species identifier (e.g., 9606 for human)
-        "caller_identity": "www.awesome_app.org",
-        "identifiers": identifiers,
-        "api_key": api_key,
-        "ge_fdr": fdr,
-        "ge_enrichment_rank_direction": -1
-    }
-
-    # Call STRING
+class StringClient:
+    """
+    asyncio client for the STRING values/ranks enrichment API. All calls share one pooled requests.Session; the
+    blocking calls run in threads so that the jobs of several metrics are submitted, polled and downloaded concurrently.
+    """
 
-    response = requests.post(request_url, data=params)
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str = STRING_API_URL,
+        poll_interval: float = 5,
+        max_poll_interval: float = 120,
+        timeout: float = 3600,
+        max_connections: int = 8,
+    ) -> None:
+        """
+        :param api_url: Base URL of the API, e.g. of a local stub server with the submit, status and download endpoints
+        :param poll_interval: First delay between status checks, doubled after each check up to max_poll_interval
+        :param timeout: Seconds to wait for a job before giving up
+        """
+        self.api_key = api_key
+        self.api_url = api_url.rstrip("/")
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def _post(self, method: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        url = f"{self.api_url}/json/{method}"
+        response = await asyncio.to_thread(self.session.post, url, data=data, timeout=60)
+        response.raise_for_status()
+        return response.json()[0]
+
+    async def submit(self, identifiers: str, species: int, fdr: float = 0.05) -> str:
+        """Submit a values/ranks enrichment job, identifiers are the tab-separated lines "identifier\tvalue" """
+        params = {
+            "species": species,  # NCBI/STRING species identifier (e.g., 9606 for human)
+            "caller_identity": CALLER_IDENTITY,
+            "identifiers": identifiers,
+            "api_key": self.api_key,
+            "ge_fdr": fdr,
+            "ge_enrichment_rank_direction": -1,
+        }
+        data = await self._post("valuesranks_enrichment_submit", params)
+        if data.get("status") == "error":
+            raise Exception(f"STRING job submission failed: {data.get('message')}")
+        print(f"Job submitted successfully. Job ID: {data['job_id']}")
+        return data["job_id"]
+
+    async def status(self, job_id: str) -> Dict[str, Any]:
+        return await self._post("valuesranks_enrichment_status", {"api_key": self.api_key, "job_id": job_id})
+
+    async def wait(self, job_id: str, on_status: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """
+        Poll the status of a job with exponential backoff and jitter until it succeeded.
+        :param on_status: Called with every status response, e.g. to save it
+        :returns: Final status response holding the download_url
+        """
+        start = time.monotonic()
+        delay = self.poll_interval
+        while True:
+            try:
+                response_dict = await self.status(job_id)
+            except requests.RequestException as e:
+                print(f"Checking STRING job {job_id} failed, retrying: {e}")
+                response_dict = {}
 
-    # Read and parse the result
+            if "status" in response_dict:
+                if on_status is not None:
+                    on_status(response_dict)
+                if response_dict["status"] == "success":
+                    return response_dict
+                if response_dict["status"] in ["failed", "error"]:
+                    raise Exception(f"STRING analysis failed: {response_dict.get('message')}. Abborting...")
 
-    data = json.loads(response.text)[0]
+            elapsed = time.monotonic() - start
+            print(f"Job {job_id}: {elapsed:.0f}s elapsed, status: {response_dict.get('message', 'unknown')}")
+            if elapsed + delay / 2 > self.timeout:
+                raise Exception(f"STRING analysis not completed after {self.timeout} seconds. Abborting...")
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))  # jitter spreads the polls of the jobs
+            delay = min(2 * delay, self.max_poll_interval)
 
-    if 'status' in data and data['status'] == 'error':
-        print("Status:", data['status'])
-        print("Message:", data['message'])
-        raise Exception("Abborting...")
-    else:
-        job_id = data["job_id"]
-        print(f"Job submitted successfully. Job ID: {job_id}")
-        return job_id
+    async def download(self, url: str, path: str) -> None:
+        """Stream the result table at url to path"""
 
+        def fetch() -> None:
+            with self.session.get(url, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1 << 20):
+                        f.write(chunk)
 
-def check_job_status(api_key: str, job_id: str) -> dict:
+        await asyncio.to_thread(fetch)
 
-    url = f"https://version-12-0.string-db.org/api/json/valuesranks_enrichment_status?api_key={api_key}&job_id={job_id}"
-    response = requests.post(url)
-    response_dict = json.loads(response.text)[0]
-    return response_dict
 
+def response_file(outfile: str) -> str:
+    """Saved status response of the STRING job of an outfile with _PLACEHOLDER_ library"""
+    return (os.path.splitext(outfile)[0] + ".response.json").replace("_PLACEHOLDER_.", "")
 
-def main(input_path: str, key: str, metric: str, outfile: str, fdr: float = 0.05) -> None:
 
-    api_key = check_api_key(key)
+def string_cache_key(input_path: str, species: int, fdr: float, api_url: str = STRING_API_URL) -> str:
+    """Hash of everything that determines a STRING result: the .string.tsv payload, species, ge_fdr and API version"""
+    key = {"payload": file_digest(input_path), "species": species, "ge_fdr": fdr, "api_url": api_url}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
 
-    prepare_string_input(input_path, metric)
 
-    input_path = input_path.replace(".csv", ".string.tsv")
+async def fetch_string_table(
+    client: StringClient, input_path: str, species: int, fdr: float, cache_dir: str, outfile_response: str
+) -> str:
+    """
+    Path of the STRING result table of a payload in the cache, downloaded first if it is not cached yet.
+    The job ID of a submitted job is cached as well, so an interrupted run resumes its job instead of resubmitting.
+    """
+    key = string_cache_key(input_path, species, fdr, client.api_url)
+    table_file = os.path.join(cache_dir, f"{key}.tsv")
+    job_file = os.path.join(cache_dir, f"{key}.job.json")
+    if os.path.isfile(table_file):
+        print(f"Using cached STRING result for {input_path}: {table_file}")
+        return table_file
+
+    job_id = None
+    if os.path.isfile(job_file):
+        with open(job_file) as f:
+            job_id = json.load(f)["job_id"]
+        try:
+            status = (await client.status(job_id)).get("status")
+        except requests.RequestException as e:
+            status = "unknown"  # transient error, client.wait polls the job again
+            print(f"Checking cached STRING job {job_id} failed: {e}")
+        if status in [None, "failed", "error"]:
+            print(f"Cached STRING job {job_id} cannot be resumed, submitting a new one")
+            job_id = None
+        else:
+            print(f"Resuming cached STRING job {job_id}")
+    if job_id is None:
+        with open(input_path) as f:
+            job_id = await client.submit(f.read(), species, fdr)
+        _write_json(job_file, {"job_id": job_id, "input": input_path, "species": species, "ge_fdr": fdr})
+
+    response_dict = await client.wait(job_id, on_status=lambda r: _write_json(outfile_response, r))
+
+    # Download next to the cache entry and move it into place once complete
+    fd, download_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{key}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        await client.download(response_dict["download_url"], download_path)
+        os.replace(download_path, table_file)
+    finally:
+        if os.path.isfile(download_path):
+            os.remove(download_path)
+    os.remove(job_file)
+    return table_file
+
+
+def _write_json(file: str, contents: Dict[str, Any]) -> None:
+    with open(file, "w", encoding="utf-8") as f:
+        json.dump(contents, f, ensure_ascii=False, indent=4)
+
+
+async def run_metric(
+    client: StringClient,
+    input_path: str,
+    outfile: str,
+    species: int,
+    fdr: float,
+    cache_dir: str,
+    inflight: Optional[Dict[str, asyncio.Task]] = None,
+) -> None:
+    """
+    Get the STRING result of one metric (cached or from a new job) and write its KEGG and GO tables.
+    :param inflight: Fetches running concurrently by cache key, metrics with identical payloads share one job
+    """
+    inflight = {} if inflight is None else inflight
+    key = string_cache_key(input_path, species, fdr, client.api_url)
+    if key not in inflight:
+        inflight[key] = asyncio.create_task(
+            fetch_string_table(client, input_path, species, fdr, cache_dir, response_file(outfile))
+        )
+    table_file = await inflight[key]
+    df = await asyncio.to_thread(pd.read_csv, table_file, sep="\t", index_col=0)
 
+    for library in ["KEGG", "GO"]:
+        df_lib = format_string_table(df, library=library)
+        outfile_lib = outfile.replace("_PLACEHOLDER_", library)
+        write_result_table(df_lib, outfile_lib)
+        print(f"Saved {outfile_lib}")
+
+
+async def run_metrics(client: StringClient, jobs: List[Dict[str, Any]]) -> None:
+    """Run the jobs (keyword arguments of run_metric) of all metrics concurrently"""
+    inflight: Dict[str, asyncio.Task] = {}
+    try:
+        await asyncio.gather(*[run_metric(client, **job, inflight=inflight) for job in jobs])
+    finally:
+        client.close()
+
+
+def main(
+    ranks_files: List[str],
+    key: str,
+    metrics: List[str],
+    outfile_template: str,
+    organism_kegg: str,
+    fdr: float = 0.05,
+    api_url: str = STRING_API_URL,
+    cache_dir: str = STRING_CACHE_DIR,
+) -> None:
+    """
+    :param ranks_files: Rank vector of each metric, see prepare_ranks.py
+    :param outfile_template: Output path with _METRIC_ and _PLACEHOLDER_ (library) placeholders
+    :param cache_dir: Cache of STRING result tables, keyed by string_cache_key; may be shared by projects
+    """
     match organism_kegg:
         case "hsa":
             species = 9606
@@ -174,68 +348,48 @@ def main(input_path: str, key: str, metric: str, outfile: str, fdr: float = 0.05
         case _:
             raise Exception(f"Organism not supported: {organism_kegg}")
 
-    outfile_response = outfile.replace(".csv", ".response.json").replace("_PLACEHOLDER_.", "")
-    print(outfile_response)
-    if os.path.isfile(outfile_response):
-        with open(outfile_response) as f:
-            response_dict = json.load(f)
-        if "job_id" in response_dict:
-            job_id = response_dict["job_id"]
-
-            while True:
-                print(f"Found existing job_id: {job_id}. Send new STRING Job? [y / n]")
-                res = input()
-                if res.lower() == "y":
-                    job_id = run_string_enrichment(input_path, api_key, species, fdr)
-                    break
-                elif res.lower() == "n":
-                    print("Using existing job id")
-                    break
-
-    else:
-        job_id = run_string_enrichment(input_path, api_key, species, fdr)
-
-    if job_id is None:
-        raise Exception("No job ID found. Abborting...")
-
-    time_waited = 0
-    while time_waited < 3600:
-        if time_waited % 20 == 0:
-            response_dict = check_job_status(api_key, job_id)
-
-            if "status" in response_dict:
-                with open(outfile_response, 'w', encoding='utf-8') as f:
-                    json.dump(response_dict, f, ensure_ascii=False, indent=4)
-                if response_dict["status"] == "success":
-                    break
-            elif "status" in response_dict and response_dict["status"] == "failed":  # TO DO: check if this is correct
-                raise Exception("STRING analysis failed. Abborting...")
-
-        time.sleep(1)
-        time_waited += 1
-        if response_dict and 'message' in response_dict:
-            print(f"\rTime elapsed: {time_waited}s, status: {response_dict['message']}", end='', flush=True)
-
-    else:
-        raise Exception("STRING analysis not completed after 3600 seconds. Abborting...")
-
-    download_url = response_dict['download_url']
-    df = pd.read_csv(download_url, sep='\t', index_col=0)
-
-    for library in ["KEGG", "GO"]:
-        df_lib = format_string_table(df, library=library)
-        outfile_lib = outfile.replace("_PLACEHOLDER_", library)
-        df_lib.to_csv(outfile_lib)
+    os.makedirs(cache_dir, exist_ok=True)
+    jobs = []
+    for ranks_file, metric in zip(ranks_files, metrics, strict=True):
+        jobs.append(
+            {
+                "input_path": prepare_string_input(ranks_file, metric),
+                "outfile": outfile_template.replace("_METRIC_", metric),
+                "species": species,
+                "fdr": fdr,
+                "cache_dir": cache_dir,
+            }
+        )
+
+    # The API key is only needed if a result is not cached
+    cached = [
+        os.path.isfile(os.path.join(cache_dir, f"{string_cache_key(job['input_path'], species, fdr, api_url)}.tsv"))
+        for job in jobs
+    ]
+    api_key = "" if all(cached) else check_api_key(key)
+
+    asyncio.run(run_metrics(StringClient(api_key, api_url), jobs))
 
 
 if __name__ == "__main__":
-    input_file = sys.argv[1]
-    api_key = sys.argv[2]
-    keytype = sys.argv[3]
-    organism_kegg = sys.argv[4]
-    gene_table_file = sys.argv[5]
-    metric = sys.argv[6]
-    outfile = sys.argv[7]
-    fdr = float(sys.argv[8])
-
-    main(input_file, api_key, metric, outfile, fdr)
+    parser = argparse.ArgumentParser(description="Run the STRING values/ranks enrichment of all metrics at once.")
+    parser.add_argument("api_key", type=str, help="STRING API key, path to a .txt file holding it, or _ to request one")
+    parser.add_argument("organism_kegg", type=str, help="KEGG organism code (hsa or mmu)")
+    parser.add_argument("outfile_template", type=str, help="Output path with _METRIC_ and _PLACEHOLDER_ placeholders")
+    parser.add_argument("fdr", type=float, help="FDR threshold of STRING (ge_fdr)")
+    parser.add_argument("--ranks", nargs="+", required=True, help="Rank vector file of each metric")
+    parser.add_argument("--metrics", nargs="+", required=True, help="Metric of each rank vector file")
+    parser.add_argument("--api-url", type=str, default=STRING_API_URL, help="STRING API base URL")
+    parser.add_argument("--cache-dir", type=str, default=STRING_CACHE_DIR, help="Cache of STRING result tables")
+    args = parser.parse_args()
+
+    main(
+        args.ranks,
+        args.api_key,
+        args.metrics,
+        args.outfile_template,
+        args.organism_kegg,
+        args.fdr,
+        args.api_url,
+        args.cache_dir,
+    )
@@ -0,0 +1,122 @@
+# scripts/run_string_local.py
+
+import sys
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from statsmodels.stats.multitest import fdrcorrection
+from typing import List
+
+from gene_set_index import load_gene_set_index
+from run_string import format_string_table
+from utils import read_ranks, write_result_table
+
+
+# Categories of STRING gmt files (see utils.create_string_gmt) as named in STRING result tables
+STRING_CATEGORIES = {"BP": "GO Process", "MF": "GO Function", "CC": "GO Component"}
+# Columns of the result table, indexed by category
+STRING_COLUMNS = [
+    "category",
+    "term ID",
+    "term description",
+    "number of genes",
+    "genes mapped",
+    "enrichment score",
+    "direction",
+    "method",
+    "matching proteins in your input (labels)",
+    "false discovery rate",
+]
+
+
+def string_values_ranks(values: pd.Series, gmt_files: List[str], fdr: float = 0.05, min_size: int = 5) -> pd.DataFrame:
+    """
+    Offline values/ranks enrichment on STRING gene sets, following the aggregate fold change (aFC) test of STRING:
+    the mean value of the members of each term is compared to the mean of all values (z-test with finite population
+    correction). Values are ranked as with ge_enrichment_rank_direction = -1, so terms with low values are enriched at
+    the "top", terms with high values at the "bottom", and terms enriched at "both ends" have large absolute deviations.
+    The direction with the smallest p-value is kept (Bonferroni-corrected for the three tests), the FDR is computed per
+    category as by STRING.
+
+    :param values: Metric indexed by gene, the identifiers of the gmt files (upper case symbols for create_string_gmt)
+    :param gmt_files: STRING gmt files (term, category, description, genes)
+    :param fdr: Only terms with a false discovery rate <= fdr are returned (ge_fdr of STRING)
+    :param min_size: Smallest number of term members in values
+    :returns: pd.DataFrame in the layout of STRING result tables indexed by category, see format_string_table;
+              empty if no gmt file is given or no term is tested
+    """
+    values = values[~values.index.duplicated()].dropna()
+    genes = values.index
+    x = values.to_numpy(dtype=float)
+    n_all = len(x)
+    deviation = np.abs(x - x.mean())
+
+    tables = []
+    for gmt_file in gmt_files:
+        index = load_gene_set_index(gmt_file)
+        indptr, cols = index.membership(genes)
+        n = np.diff(indptr)
+        rows = np.repeat(np.arange(len(index)), n)
+        tested = (n >= min_size) & (n < n_all)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Standard error of the mean of n values drawn without replacement
+            fpc = np.sqrt((n_all - n) / (n * (n_all - 1)))
+            mean_diff = np.bincount(rows, weights=x[cols], minlength=len(index)) / n - x.mean()
+            z = mean_diff / (x.std() * fpc)
+            dev_diff = np.bincount(rows, weights=deviation[cols], minlength=len(index)) / n - deviation.mean()
+            z_both = dev_diff / (deviation.std() * fpc)
+
+        pvalues = np.column_stack([norm.cdf(z), norm.sf(z), norm.sf(z_both)])  # top, bottom, both ends
+        best = np.argmin(np.nan_to_num(pvalues, nan=1), axis=1)
+        scores = np.column_stack([-mean_diff / x.std(), mean_diff / x.std(), dev_diff / deviation.std()])
+        gene_names = genes.to_numpy()
+
+        tab = pd.DataFrame(
+            {
+                "category": [STRING_CATEGORIES.get(c, c) for c in index.categories],
+                "term ID": index.ids,
+                "term description": index.descriptions,
+                "number of genes": index.sizes,
+                "genes mapped": n,
+                "enrichment score": scores[np.arange(len(index)), best],
+                "direction": np.array(["top", "bottom", "both ends"])[best],
+                "pvalue": np.minimum(3 * pvalues[np.arange(len(index)), best], 1),
+                "method": "aFC",
+                "matching proteins in your input (labels)": [
+                    ",".join(gene_names[cols[indptr[i] : indptr[i + 1]]]) for i in range(len(index))
+                ],
+            }
+        )
+        tables.append(tab[tested])
+
+    if sum(len(t) for t in tables) == 0:
+        return pd.DataFrame(columns=STRING_COLUMNS).set_index("category")
+
+    tab = pd.concat(tables, ignore_index=True)
+    tab["false discovery rate"] = tab.groupby("category")["pvalue"].transform(lambda p: fdrcorrection(p)[1])
+    tab = tab[tab["false discovery rate"] <= fdr].drop(columns="pvalue")
+    return tab.sort_values(["category", "false discovery rate"]).set_index("category")
+
+
+def main(ranks_file: str, metric: str, outfile: str, fdr: float, gmt_files: List[str]) -> None:
+    ranks = read_ranks(ranks_file)
+    values = ranks.set_index(ranks["SYMBOL"].str.upper())[metric]  # create_string_gmt stores upper case symbols
+    print(f"Running local STRING values/ranks enrichment for {metric} with {gmt_files}")
+    df = string_values_ranks(values, gmt_files, fdr=fdr)
+
+    for library in ["KEGG", "GO"]:
+        df_lib = format_string_table(df, library=library)
+        outfile_lib = outfile.replace("_PLACEHOLDER_", library)
+        write_result_table(df_lib, outfile_lib)
+        print(f"Saved {outfile_lib}")
+
+
+if __name__ == "__main__":
+    ranks_file = sys.argv[1]
+    metric = sys.argv[2]
+    outfile = sys.argv[3]
+    fdr = float(sys.argv[4])
+    gmt_files = sys.argv[5:]
+
+    main(ranks_file, metric, outfile, fdr, gmt_files)
@@ -0,0 +1,170 @@
+# scripts/summary_store.py
+
+import os
+import json
+import fcntl
+import pickle
+import tempfile
+from collections.abc import Mapping
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+import pandas as pd
+
+
+STORE_VERSION = 1
+MANIFEST = "manifest.json"
+MANIFEST_LOCK = ".manifest.lock"
+TABLE_FORMATS = {"parquet": ".parquet", "pickle": ".pkl"}
+
+
+def summary_store_path(savepath: str, project_name: str) -> str:
+    """Directory of the summary store of a project, savepath is results/{project_name}/combined"""
+    return os.path.join(savepath, f"syn.summary.{project_name}")
+
+
+class LibraryEntry(Mapping):
+    """Tables of one library of a SummaryStore, each read from its file on first access"""
+
+    def __init__(self, store: "SummaryStore", lib: str) -> None:
+        self.store = store
+        self.lib = lib
+        self._tables: Dict[str, pd.DataFrame] = {}
+
+    def __getitem__(self, table: str) -> pd.DataFrame:
+        if table not in self._tables:
+            self._tables[table] = self.store.read_table(self.lib, table)
+        return self._tables[table]
+
+    def __setitem__(self, table: str, df: pd.DataFrame) -> None:
+        """Replace one table on disk, the other tables of the store are not touched"""
+        self.store.write_table(self.lib, table, df)
+        self._tables[table] = df
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.manifest["libraries"].get(self.lib, {}))
+
+    def __len__(self) -> int:
+        return len(self.store.manifest["libraries"].get(self.lib, {}))
+
+
+class SummaryStore(Mapping):
+    """
+    Summary tables of a project (see combine_libs.create_summary_dict) on disk, replacing the pickled summary_dict.
+    One file per library and table plus manifest.json listing them; store[lib][table] reads a single file on first
+    access and store[lib][table] = df rewrites only that file and the manifest.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        if not os.path.isfile(os.path.join(path, MANIFEST)):
+            raise Exception(f"No summary store found at {path}")
+        self.manifest = self.read_manifest()
+        self._entries: Dict[str, LibraryEntry] = {}
+
+    @classmethod
+    def create(cls, path: str, table_format: str = "parquet", **meta: Any) -> "SummaryStore":
+        """
+        Empty store at path, replacing the manifest of an existing one (table files are overwritten when written).
+        :param table_format: "parquet" or "pickle"
+        :param meta: Extra JSON-serializable entries of the manifest, e.g. project_name and qval
+        """
+        if table_format not in TABLE_FORMATS:
+            raise Exception(f"Invalid table format: {table_format}, choose from {list(TABLE_FORMATS)}")
+        os.makedirs(path, exist_ok=True)
+        manifest = {"version": STORE_VERSION, "table_format": table_format, **meta, "libraries": {}}
+        with _manifest_lock(path):
+            _atomic_write(os.path.join(path, MANIFEST), json.dumps(manifest, indent=2).encode())
+        return cls(path)
+
+    @classmethod
+    def from_summary_dict(
+        cls, summary_dict: Dict, path: str, table_format: str = "parquet", **meta: Any
+    ) -> "SummaryStore":
+        """Store holding every table of an in-memory summary_dict"""
+        store = cls.create(path, table_format, **meta)
+        for lib, tables in summary_dict.items():
+            for table, df in tables.items():
+                store[lib][table] = df
+        return store
+
+    def __getitem__(self, lib: str) -> LibraryEntry:
+        if lib not in self._entries:
+            self._entries[lib] = LibraryEntry(self, lib)
+        return self._entries[lib]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.manifest["libraries"])
+
+    def __len__(self) -> int:
+        return len(self.manifest["libraries"])
+
+    def read_manifest(self) -> Dict[str, Any]:
+        manifest_file = os.path.join(self.path, MANIFEST)
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != STORE_VERSION:
+            raise Exception(f"Unsupported summary store version in {manifest_file}: {manifest.get('version')}")
+        return manifest
+
+    def read_table(self, lib: str, table: str) -> pd.DataFrame:
+        try:
+            entry = self.manifest["libraries"][lib][table]
+        except KeyError:
+            raise KeyError(f"Table not found in summary store: {lib}.{table}")
+        file = os.path.join(self.path, entry["file"])
+        if file.endswith(".parquet"):
+            return pd.read_parquet(file)
+        with open(file, "rb") as f:
+            return pickle.load(f)
+
+    def write_table(self, lib: str, table: str, df: pd.DataFrame) -> None:
+        table_format = self.manifest["table_format"]
+        filename = f"{lib}.{table}{TABLE_FORMATS[table_format]}"
+        if table_format == "parquet":
+            with tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False) as tmp:
+                df.to_parquet(tmp.name, compression="zstd")
+            os.replace(tmp.name, os.path.join(self.path, filename))
+        else:
+            _atomic_write(os.path.join(self.path, filename), pickle.dumps(df))
+
+        # Merge into the manifest on disk, which other processes writing to the store may have updated
+        with _manifest_lock(self.path):
+            manifest = self.read_manifest()
+            manifest["libraries"].setdefault(lib, {})[table] = {"file": filename, "rows": len(df)}
+            _atomic_write(os.path.join(self.path, MANIFEST), json.dumps(manifest, indent=2).encode())
+        self.manifest = manifest
+
+
+@contextmanager
+def _manifest_lock(path: str) -> Iterator[None]:
+    """Exclusive lock on the manifest of the store at path, held by one writing process at a time"""
+    with open(os.path.join(path, MANIFEST_LOCK), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _atomic_write(file: str, contents: bytes) -> None:
+    """Write to a temporary file next to file and move it into place, so readers never see a partial file"""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(file) or ".", suffix=".tmp", delete=False) as tmp:
+        tmp.write(contents)
+    os.replace(tmp.name, file)
+
+
+def load_summary(savepath: str, project_name: str) -> Mapping:
+    """
+    Summary of a project, lazily from its SummaryStore or else from a pickled summary_dict of an older run.
+    :param savepath: results/{project_name}/combined
+    """
+    path = summary_store_path(savepath, project_name)
+    if os.path.isdir(path):
+        return SummaryStore(path)
+    legacy_file = os.path.join(savepath, f"syn.summary_dict.{project_name}.txt")
+    if os.path.isfile(legacy_file):
+        with open(legacy_file, "rb") as f:
+            return pickle.load(f)
+    raise Exception(f"No summary found for {project_name} in {savepath}")
+
@@ -1,14 +1,10 @@
 import os
 import pickle
+import hashlib
+import numpy as np
 import pandas as pd
 import yaml
-from typing import Dict, Any
-
-try:
-    import mygene
-except ModuleNotFoundError:
-    print("mygene not found")
-    pass
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple, Union
 
 import subprocess
 
@@ -47,6 +43,34 @@ def pickler(contents, filepath):
         pickle.dump(contents, fp)
 
 
+def file_digest(path: str) -> str:
+    """Content hash of a file"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_cached_table(cache_file: str, key: Dict[str, Any]) -> Optional[pd.DataFrame]:
+    """Table stored by save_cached_table, or None if missing or stored under a different key"""
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        cached = pd.read_pickle(cache_file)
+    except Exception:
+        return None
+    return cached["table"] if cached.get("key") == key else None
+
+
+def save_cached_table(table: pd.DataFrame, cache_file: str, key: Dict[str, Any]) -> None:
+    """Pickle a table together with the key it was derived from (e.g. content hashes of its inputs)"""
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    pd.to_pickle({"key": key, "table": table}, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+
 def format_string_table(df: pd.DataFrame, library: str) -> pd.DataFrame:
     """
     Format table from STRING databse functional scoring results (proteins with values/ranks)
@@ -81,9 +105,8 @@ def format_string_table(df: pd.DataFrame, library: str) -> pd.DataFrame:
     df["pvalue"] = df["qvalue"]  # dubious but STRING doesn't save pvalues...
 
     # STRING sort values from negative to positive, hence "top" will be downregulated, hence reverse this here
-    df["enrichmentScore"] = df["enrichmentScore"] * df["direction"].apply(
-        lambda x: -1 if x == "top" else 1 if x == "bottom" else 0
-    )
+    sign = df["direction"].map({"top": -1, "bottom": 1}).fillna(0).astype(float)
+    df["enrichmentScore"] = df["enrichmentScore"] * sign
 
     return df
 
@@ -94,79 +117,301 @@ def load_config(file_path: str) -> Dict[str, Any]:
     return config
 
 
-def ensp_to_gene_symbol(ensp_ids, species):
-    mg = mygene.MyGeneInfo()
-    print("quering for", species)
-    # Query mygene.info with the list of ENSP IDs
-    result = mg.querymany(ensp_ids, scopes="ensembl.protein", fields="symbol", species=species)
+def write_ranks(ranks: pd.DataFrame, outfile: str) -> None:
+    """
+    Write a rank vector from prepare_ranks.py as parquet (requires pyarrow): identifier columns as strings followed by
+    the metric column as float64
+    """
+    dtypes = {**{c: "string" for c in ranks.columns[:-1]}, ranks.columns[-1]: "float64"}
+    ranks.astype(dtypes).to_parquet(outfile, index=False)
 
-    # Extract gene symbols
-    symbols = {item["query"]: item.get("symbol", "N/A") for item in result}
 
-    return symbols
+def read_ranks(path: str) -> pd.DataFrame:
+    """Read a rank vector written by write_ranks, with identifiers as strings and the metric (last column) as float"""
+    return pd.read_parquet(path)
 
 
-def create_gmt(df, output_file):
-    # Group by term and description (or category), and collect the ensemblprot IDs into lists
-    grouped = df.groupby(["term", "category", "description"])["#string_protein_id"].apply(list).reset_index()
+# Result tables (per configuration, combined, depth) are written as csv or, with result_format: "parquet", as parquet.
+# Parquet files store the index as first column and flatten (Tool, Metric, Value) headers to "Tool|Metric|Value"
+RESULT_FORMATS = ["csv", "parquet"]
+COLUMN_SEP = "|"
 
-    with open(output_file, "w") as f:
-        for _, row in grouped.iterrows():
-            # Write each line in the required GMT format
-            term = row["term"]
-            cat = row["category"]
-            description = row["description"]
-            ensemblprot_list = row["#string_protein_id"]
-            # Format the row: term, cat, description, and list of ensemblprots
-            f.write(f"{term}\t{cat}\t{description}\t" + "\t".join(ensemblprot_list) + "\n")
 
+def write_result_table(table: pd.DataFrame, outfile: str, index: bool = True) -> None:
+    """
+    Write a result table, as parquet if outfile ends with .parquet (requires pyarrow) and as csv otherwise
 
-def create_string_gmt(infile, outfile, orgid, species=""):
+    Strings are dictionary-encoded in parquet files, which keeps repeated values (Direction, ONTOLOGY, ...) small.
+    """
+    if not outfile.endswith(".parquet"):
+        table.to_csv(outfile, index=index, sep="\t" if outfile.endswith(".tsv") else ",")
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = table.copy()
+    if isinstance(table.columns, pd.MultiIndex):
+        table.columns = [COLUMN_SEP.join(str(c) for c in col) for col in table.columns]
+    else:
+        table.columns = table.columns.map(str)
+    if index:
+        table.index.name = table.index.name or ""
+        table = table.reset_index()
+
+    pq.write_table(
+        pa.Table.from_pandas(table, preserve_index=False), outfile, use_dictionary=True, compression="zstd"
+    )
+
+
+def _result_columns(available: List[str], columns: Optional[List[Union[str, Tuple]]]) -> List[str]:
+    """Flat column names matching the requested names or (Tool, Metric, Value) tuples, None matching any level"""
+    if columns is None:
+        return available
+    selected = []
+    for col in columns:
+        if isinstance(col, tuple):
+            matches = [
+                a
+                for a in available
+                if len(a.split(COLUMN_SEP)) == len(col)
+                and all(c is None or str(c) == part for c, part in zip(col, a.split(COLUMN_SEP), strict=True))
+            ]
+        else:
+            matches = [a for a in available if a == col]
+        if len(matches) == 0:
+            raise Exception(f"Column not found: {col}")
+        selected += matches
+    return [a for a in available if a in selected]
+
+
+def read_result_table(
+    path: str, columns: Optional[List[Union[str, Tuple]]] = None, header_levels: int = 1
+) -> pd.DataFrame:
+    """
+    Read a result table written by write_result_table (csv, tsv or parquet), indexed by its first column
+
+    :param columns: columns to load, e.g. [("gseapy", "logFC", "qvalue"), ("Combined", None, None)]; all if None
+    :param header_levels: header rows of csv tables, 3 for combined tables (parquet headers are inferred)
+    :returns: table with (Tool, Metric, Value) MultiIndex columns for combined tables
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        names = pq.read_schema(path).names
+        tab = pd.read_parquet(path, columns=[names[0]] + _result_columns(names[1:], columns))
+        tab = tab.set_index(names[0])
+        tab.index.name = tab.index.name or None
+        if any(COLUMN_SEP in c for c in tab.columns):
+            tab.columns = pd.MultiIndex.from_tuples(
+                [tuple(c.split(COLUMN_SEP)) for c in tab.columns], names=["Tool", "Metric", "Value"]
+            )
+        return tab
+
+    sep = "\t" if path.endswith(".tsv") else ","
+    header = list(range(header_levels)) if header_levels > 1 else 0
+    header_df = pd.read_csv(path, index_col=0, sep=sep, header=header, nrows=0)
+    if columns is None:
+        return pd.read_csv(path, index_col=0, sep=sep, header=header)
+    available = [COLUMN_SEP.join(c) if isinstance(c, tuple) else c for c in header_df.columns]
+    selected = set(_result_columns(available, columns))
+    positions = [i for i, c in enumerate(available) if c in selected]
+    if header_levels == 1:
+        return pd.read_csv(path, index_col=0, sep=sep, usecols=[0] + [i + 1 for i in positions])
+
+    # usecols is not supported with multi-row headers, hence skip the header (and index name row) and relabel
+    skiprows = header_levels + (header_df.index.name is not None)
+    usecols = [0] + [i + 1 for i in positions]
+    tab = pd.read_csv(path, index_col=0, sep=sep, header=None, skiprows=skiprows, usecols=usecols)
+    tab.columns = header_df.columns[positions]
+    tab.index.name = header_df.index.name
+    return tab
+
+
+def read_result_arrow(path: str, columns: Optional[List[Union[str, Tuple]]] = None) -> Any:
+    """
+    Load a parquet result table as a memory-mapped pyarrow.Table, e.g. for notebooks
+
+    Strings stay dictionary-encoded; use read_result_table for pandas DataFrames with (Tool, Metric, Value) columns.
     """
-    Convert STRING db enrichment file to gmt file
+    import pyarrow.parquet as pq
+
+    if not path.endswith(".parquet"):
+        raise Exception(f"Arrow loading requires a parquet result table: {path}")
+    schema = pq.read_schema(path)
+    selected = [schema.names[0]] + _result_columns(schema.names[1:], columns)
+    strings = [f.name for f in schema if f.name in selected and str(f.type) in ["string", "large_string"]]
+    return pq.read_table(path, columns=selected, memory_map=True, read_dictionary=strings)
+
+
+def ensp_to_gene_symbol(ensp_ids, species, client=None):
+    """
+    Gene symbols of Ensembl protein IDs ("N/A" if not found). Mappings are cached in the ID mapping store, only IDs
+    missing from it are queried (see id_mapping.map_ids; client is a mygene.MyGeneInfo-like client)
+    """
+    from id_mapping import map_ids
+
+    symbols = map_ids(ensp_ids, species, "ENSP", "SYMBOL", client=client)
+    return symbols.fillna("N/A").to_dict()
+
+
+# Categories of STRING enrichment.terms files written to the gmt file of each library by create_string_gmts
+STRING_LIBRARIES = {
+    "GO": [
+        "Biological Process (Gene Ontology)",
+        "Cellular Component (Gene Ontology)",
+        "Molecular Function (Gene Ontology)",
+    ],
+    "KEGG": ["KEGG Pathways"],
+    "Reactome": ["Reactome Pathways"],
+    "WikiPathways": ["WikiPathways"],
+}
+# Category column of the gmt files (other categories are written as in STRING)
+STRING_CATEGORY_NAMES = {
+    "Biological Process (Gene Ontology)": "BP",
+    "Cellular Component (Gene Ontology)": "CC",
+    "Molecular Function (Gene Ontology)": "MF",
+    "KEGG Pathways": "KEGG",
+    "Reactome Pathways": "Reactome",
+}
+STRING_CHUNKSIZE = 1_000_000  # rows of the enrichment.terms file held in memory at once
+
+
+def read_string_terms(
+    infile: str, categories: List[str], chunksize: int = STRING_CHUNKSIZE
+) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stream a STRING enrichment.terms file in chunks, keeping the memberships of the given categories as integer codes.
+
+    :returns: terms (term, category, description) and protein IDs, both in order of first appearance, and the term and
+        protein codes of each membership
+    """
+    proteins: Dict[str, int] = {}
+    terms: Dict[str, int] = {}
+    term_info: List[Tuple[str, str, str]] = []
+    term_codes, protein_codes = [], []
+
+    usecols = ["#string_protein_id", "category", "term", "description"]
+    for chunk in pd.read_csv(infile, sep="\t", usecols=usecols, dtype=str, chunksize=chunksize):
+        chunk = chunk[chunk["category"].isin(categories)]
+        if chunk.empty:
+            continue
+
+        # Codes within the chunk, translated to global codes through the (few) unique values
+        codes, uniques = pd.factorize(chunk["#string_protein_id"])
+        to_global = np.array([proteins.setdefault(p, len(proteins)) for p in uniques], dtype=np.int32)
+        protein_codes.append(to_global[codes])
+
+        codes, uniques = pd.factorize(chunk["term"])
+        first = np.unique(codes, return_index=True)[1]
+        chunk_info = zip(uniques, chunk["category"].to_numpy()[first], chunk["description"].to_numpy()[first])
+        for term, category, description in chunk_info:
+            if term not in terms:
+                terms[term] = len(terms)
+                term_info.append((term, category, description))
+        to_global = np.array([terms[t] for t in uniques], dtype=np.int32)
+        term_codes.append(to_global[codes])
+
+    terms_df = pd.DataFrame(term_info, columns=["term", "category", "description"])
+    protein_ids = np.array(list(proteins), dtype=object)
+    if not term_codes:
+        return terms_df, protein_ids, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+    return terms_df, protein_ids, np.concatenate(term_codes), np.concatenate(protein_codes)
+
+
+def string_protein_symbols(protein_ids: List[str], species: str, prot2symbol_file: str) -> Dict[str, str]:
+    """
+    Gene symbols of STRING protein IDs (without organism prefix) from the ID mapping store, which is first seeded
+    with the prot2symbol_file of older runs if present
+    """
+    if os.path.isfile(prot2symbol_file):
+        from id_mapping import IdMappingStore
+
+        gene_symbols = pd.read_csv(prot2symbol_file, index_col=0)["SYMBOL"]
+        gene_symbols = gene_symbols.astype(object).where(gene_symbols.notna(), None)
+        IdMappingStore().add(species, "ENSP", "SYMBOL", gene_symbols.to_dict())
+
+    return ensp_to_gene_symbol(protein_ids, species=species)
+
+
+def create_string_gmts(
+    infile: str,
+    outfiles: Dict[str, str],
+    orgid: str,
+    species: str = "",
+    chunksize: int = STRING_CHUNKSIZE,
+) -> None:
+    """
+    Convert a STRING enrichment.terms file to one gmt file per library in a single streaming pass.
+    Proteins are mapped to upper case gene symbols (protein ID if unknown), duplicated genes of a term are dropped.
+    Lines hold term, category, description and genes, with terms sorted by ID.
+
+    :param outfiles: gmt file of each library, e.g. {"GO": "GO_STRING_human.gmt", "KEGG": "KEGG_STRING_human.gmt"},
+        libraries are keys of STRING_LIBRARIES or STRING category names
+    :param orgid: NCBI taxon ID prefixing the protein IDs, e.g. "9606"
     """
     if species == "":
         species = orgid
 
-    tab = pd.read_csv(infile, sep="\t")
-    tab = tab[tab["term"].str.startswith("GO:")]
+    library_categories = {lib: STRING_LIBRARIES.get(lib, [lib]) for lib in outfiles}
+    categories = sorted({c for cats in library_categories.values() for c in cats})
+    terms, protein_ids, term_codes, protein_codes = read_string_terms(infile, categories, chunksize)
+    print(f"Read {len(protein_codes)} memberships of {len(terms)} terms and {len(protein_ids)} proteins")
 
+    protein_ids = pd.Series(protein_ids, dtype=object).str.replace(f"{orgid}.", "", n=1, regex=False)
     prot2symbol_file = f"../../resources/Ontologies/prot2symbol.{species}.csv"
+    gene_symbols = string_protein_symbols(protein_ids.tolist(), species, prot2symbol_file)
+    symbols = protein_ids.map(gene_symbols).replace("N/A", np.nan).fillna(protein_ids).str.upper()
+    gene_codes, gene_names = pd.factorize(symbols)
+    gene_names = np.asarray(gene_names, dtype=object)
+
+    # First occurrence of each (term, gene), grouped by term in file order
+    keys = term_codes.astype(np.int64) * max(len(gene_names), 1) + gene_codes[protein_codes]
+    first = np.sort(np.unique(keys, return_index=True)[1])
+    first = first[np.argsort(term_codes[first], kind="stable")]
+    genes = gene_codes[protein_codes[first]]
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_codes[first], minlength=len(terms)), out=indptr[1:])
+
+    terms["name"] = terms["category"].map(STRING_CATEGORY_NAMES).fillna(terms["category"])
+    terms = terms.sort_values("term")
+    for lib, outfile in outfiles.items():
+        selected = terms[terms["category"].isin(library_categories[lib])]
+        with open(outfile, "w") as f:
+            for i, term, category, description in zip(
+                selected.index, selected["term"], selected["name"], selected["description"], strict=True
+            ):
+                members = gene_names[genes[indptr[i] : indptr[i + 1]]]
+                f.write(f"{term}\t{category}\t{description}\t" + "\t".join(members) + "\n")
+        print(f"Saved {len(selected)} terms to {outfile}")
 
-    if os.path.isfile(prot2symbol_file):
-        gene_symbols = pd.read_csv(prot2symbol_file, index_col=0)
-        gene_symbols = gene_symbols["SYMBOL"].to_dict()
-    else:
-        print("Retrieving gene symbols...")
-        protids = list(set(tab["#string_protein_id"].str.split(f"{orgid}.").str[1]))
-        gene_symbols = ensp_to_gene_symbol(protids, species=species)
-        df = pd.DataFrame(gene_symbols.values(), index=gene_symbols.keys(), columns=["SYMBOL"])
-        df.to_csv(prot2symbol_file)
 
-    tab["#string_protein_id"] = tab["#string_protein_id"].str.replace(f"{orgid}.", "")
-    tab["#string_protein_id"] = tab["#string_protein_id"].map(gene_symbols).fillna(tab["#string_protein_id"])
-    tab["#string_protein_id"] = tab["#string_protein_id"].str.upper()
+def create_string_gmt(infile, outfile, orgid, species=""):
+    """
+    Convert STRING db enrichment file to gmt file (GO terms only, see create_string_gmts for other libraries)
+    """
+    create_string_gmts(infile, {"GO": outfile}, orgid, species)
 
-    cat_dict = {
-        "Biological Process (Gene Ontology)": "BP",
-        "Cellular Component (Gene Ontology)": "CC",
-        "Molecular Function (Gene Ontology)": "MF",
-    }
 
-    tab["category"] = tab["category"].replace(cat_dict)
+def parse_gene_sets(lines: Iterable[str], n_fields: int = 2) -> Iterator[Tuple[List[str], List[str]]]:
+    """
+    Parse gene set lines (tab-separated, n_fields leading fields then genes), shared by all gmt and Enrichr readers.
+    Optional Enrichr gene weights ("GENE,1.0") and empty entries are dropped, lines without any gene column are skipped.
 
-    create_gmt(tab, outfile)
+    :param lines: Lines of a gmt file or of an Enrichr library in text format
+    :param n_fields: 2 for Enrichr libraries (term, empty column), 3 for gmt files of this workflow (ID, Category,
+                     Description)
+    :returns: Iterator of (fields, genes)
+    """
+    for line in lines:
+        parts = line.strip().split("\t")
+        if len(parts) > n_fields:
+            yield parts[:n_fields], [g.split(",")[0] for g in parts[n_fields:] if g != ""]
 
 
 def read_enrichr(gmt_file):
-    gene_sets = []
     with open(gmt_file) as file:
-        for line in file:
-            parts = line.strip().split("\t")
-            if len(parts) >= 2:
-                description = parts[0]
-                genes = parts[2:]  # 2nd col is empty?
-                gene_sets.append({"Description": description, "Genes": genes})
+        gene_sets = [{"Description": fields[0], "Genes": genes} for fields, genes in parse_gene_sets(file)]
     df = pd.DataFrame(gene_sets)
     df.index = "GO:" + df["Description"].str.split("\(GO:").str[1].str[:-1]
     df.index.name = "ID"
@@ -174,15 +419,20 @@ def read_enrichr(gmt_file):
     return df
 
 
+def read_enrichr_library(gmt_file):
+    """Read Enrichr library in text format (term, empty column, genes) keeping the full term name as ID, as gseapy"""
+    with open(gmt_file) as file:
+        gene_sets = [
+            {"ID": fields[0], "Description": fields[0], "Category": "", "Genes": genes}
+            for fields, genes in parse_gene_sets(file)
+        ]
+    return pd.DataFrame(gene_sets)
+
+
 def read_gmt(gmt_file):
-    gene_sets = []
     with open(gmt_file) as file:
-        for line in file:
-            parts = line.strip().split("\t")
-            if len(parts) >= 4:
-                id = parts[0]
-                category = parts[1]
-                description = parts[2]
-                genes = parts[3:]
-                gene_sets.append({"ID": id, "Description": description, "Category": category, "Genes": genes})
+        gene_sets = [
+            {"ID": fields[0], "Description": fields[2], "Category": fields[1], "Genes": genes}
+            for fields, genes in parse_gene_sets(file, n_fields=3)
+        ]
     return pd.DataFrame(gene_sets)
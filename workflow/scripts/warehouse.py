@@ -0,0 +1,153 @@
+# scripts/warehouse.py
+
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, List, Optional
+
+import pandas as pd
+
+
+WAREHOUSE_VERSION = 1
+
+# term_stats: one row per term tested in a configuration; depth: the depth table of each library (see combine_libs)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS projects (
+    project TEXT NOT NULL,
+    library TEXT NOT NULL,
+    qval REAL,
+    n_configurations INTEGER,
+    updated TEXT,
+    PRIMARY KEY (project, library)
+);
+CREATE TABLE IF NOT EXISTS term_stats (
+    project TEXT NOT NULL,
+    library TEXT NOT NULL,
+    term TEXT NOT NULL,
+    tool TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    direction TEXT,
+    enrichment_score REAL,
+    pvalue REAL,
+    qvalue REAL
+);
+CREATE INDEX IF NOT EXISTS term_stats_term ON term_stats (term, project);
+CREATE INDEX IF NOT EXISTS term_stats_project ON term_stats (project, library);
+CREATE TABLE IF NOT EXISTS depth (
+    project TEXT NOT NULL,
+    library TEXT NOT NULL,
+    term TEXT NOT NULL,
+    direction TEXT,
+    description TEXT,
+    depth INTEGER,
+    relative_depth REAL,
+    combined_fdr REAL,
+    configurations TEXT
+);
+CREATE INDEX IF NOT EXISTS depth_term ON depth (term, depth, project);
+CREATE INDEX IF NOT EXISTS depth_project ON depth (project, library);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open (and create if needed) the warehouse at path; waits for writers of concurrent runs"""
+    con = sqlite3.connect(path, timeout=120)
+    con.executescript(SCHEMA)
+    version = con.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if version is None:
+        con.execute("INSERT INTO meta VALUES ('version', ?)", (str(WAREHOUSE_VERSION),))
+        con.commit()
+    elif int(version[0]) != WAREHOUSE_VERSION:
+        raise Exception(f"Unsupported warehouse version in {path}: {version[0]}")
+    return con
+
+
+def append_library(
+    path: str,
+    project_name: str,
+    library: str,
+    records: pd.DataFrame,
+    depth_df: pd.DataFrame,
+    qval: float,
+    n_configurations: int,
+) -> None:
+    """
+    Replace the rows of one project and library in the warehouse, in a single transaction.
+    :param records: Long-format results, see explore_results.ResultStore.records
+    :param depth_df: Depth table indexed by term ID, see combine_libs.format_depth_df
+    """
+    stats = pd.DataFrame(
+        {
+            "project": project_name,
+            "library": library,
+            "term": records["Term"].astype(object),
+            "tool": records["Tool"].astype(object),
+            "metric": records["Metric"].astype(object),
+            "direction": records["Direction"].astype(object),
+            "enrichment_score": records["enrichmentScore"].astype(float),
+            "pvalue": records["pvalue"].astype(float),
+            "qvalue": records["qvalue"].astype(float),
+        }
+    )
+    depth = pd.DataFrame()
+    if len(depth_df) > 0:
+        depth = pd.DataFrame(
+            {
+                "project": project_name,
+                "library": library,
+                "term": depth_df.index.astype(object),
+                "direction": depth_df["Direction"].astype(object),
+                "description": depth_df["Description"].astype(object),
+                "depth": depth_df["Depth"].astype(int),
+                "relative_depth": depth_df["Depth"] / n_configurations,
+                "combined_fdr": depth_df["Combined FDR"].astype(float),
+                "configurations": depth_df["Configurations"].astype(object),
+            }
+        )
+
+    con = connect(path)
+    try:
+        with con:
+            for table in ["projects", "term_stats", "depth"]:
+                con.execute(f"DELETE FROM {table} WHERE project = ? AND library = ?", (project_name, library))
+            con.execute(
+                "INSERT INTO projects VALUES (?, ?, ?, ?, ?)",
+                (project_name, library, qval, n_configurations, datetime.now(timezone.utc).isoformat()),
+            )
+            con.executemany(
+                "INSERT INTO term_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", stats.itertuples(index=False, name=None)
+            )
+            con.executemany(
+                "INSERT INTO depth VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", depth.itertuples(index=False, name=None)
+            )
+    finally:
+        con.close()
+
+
+def query(path: str, sql: str, params: Any = ()) -> pd.DataFrame:
+    """Run a read query on the warehouse, e.g. query(path, "SELECT * FROM depth WHERE term = ?", ["GO:0006955"])"""
+    con = connect(path)
+    try:
+        return pd.read_sql_query(sql, con, params=params)
+    finally:
+        con.close()
+
+
+def count_robust_projects(
+    path: str, min_depth: int, terms: Optional[List[str]] = None, library: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Number of projects in which each term is significant in at least min_depth configurations (either direction).
+    :returns: pd.DataFrame indexed by term with Projects and Description, most robust terms first
+    """
+    sql = "SELECT term, COUNT(DISTINCT project) AS Projects, MIN(description) AS Description FROM depth"
+    sql += " WHERE depth >= ?"
+    params: List[Any] = [min_depth]
+    if terms is not None:
+        sql += f" AND term IN ({', '.join('?' * len(terms))})"
+        params += list(terms)
+    if library is not None:
+        sql += " AND library = ?"
+        params.append(library)
+    sql += " GROUP BY term ORDER BY Projects DESC, term"
+    return query(path, sql, params).set_index("term").rename_axis(None)